@@ -10,9 +10,51 @@ __date__ = "2 September 2015"
 from bottle import Bottle, template
 from multiprocessing import Process
 from threading import Thread
+from socketserver import ThreadingMixIn # MODIFIED
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler # MODIFIED
 import requests #for http requests
 import json
 import sys
+import io # MODIFIED
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer): # MODIFIED: class added
+    """WSGI server handling each connection in its own thread (a kept-alive connection doesn't block the other clients)."""
+    daemon_threads = True
+
+
+class KeepAliveHandler(WSGIRequestHandler): # MODIFIED: class added
+    """Serves several HTTP/1.1 requests on the same connection, until the client closes it or asks for 'Connection: close'.
+    (the wsgiref handler closes the connection after each request)"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # The headers and the body are written separately, Nagle would delay the body of kept-alive responses
+
+    def handle(self):
+        self.close_connection = False
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline or not self.parse_request():
+            self.close_connection = True
+            return
+
+        if 'Transfer-Encoding' in self.headers:
+            self.close_connection = True # The end of a chunked body is not tracked
+        # The body is read beforehand: the next request must start where this one ends, even if the app ignores it
+        body = io.BytesIO(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+        handler = ServerHandler(body, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.http_version = self.request_version.split('/')[-1]
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def log_request(self, *args, **kw):
+        pass
 
 
 class Server:
@@ -32,7 +74,8 @@ class Server:
 
     def _start(self, quiet=True):
         print("starting... " + self.__class__.__name__ + " at http://" + self._host + ":" + str(self._port))
-        self._app.run(host=self._host, port=self._port, quiet=quiet)
+        self._app.run(host=self._host, port=self._port, quiet=quiet, 
+                        server_class=ThreadingWSGIServer, handler_class=KeepAliveHandler) # MODIFIED: keep-alive support
 
     def start(self):
         """Starts the server in a background process, only if not already started"""
@@ -24,12 +24,17 @@ class ThermometerServer(Server):
         # set up routes. We cannot use the bottle decorators since those only work on functions, not object methods
         # see http://stackoverflow.com/questions/8725605/bottle-framework-and-oop-using-method-instead-of-function
         self._app.route('/temperature', method="GET", callback=self._temperature)
+        self._app.route('/measures', method="GET", callback=self._measures) # MODIFIED: bulk endpoint added
 
     def _temperature(self):
         """Queries temperature"""
         response.content_type="text/plain"
         return str(random.uniform(-10,30))
 
+    def _measures(self):
+        """Queries all the measures at once (MODIFIED: method added)"""
+        return {'temperature': random.uniform(-10,30)}
+
         
 
 
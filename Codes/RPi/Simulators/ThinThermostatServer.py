@@ -28,6 +28,7 @@ class ThinThermostatServer(Server):
         self._app.route('/presence', method="GET", callback=self._presence)
         self._app.route('/valve', method="GET", callback=self._actuation_value)
         self._app.route('/valve', method="PUT", callback=self._actuate_valve)
+        self._app.route('/measures', method="GET", callback=self._measures) # MODIFIED: bulk endpoint added
 
     def _temperature(self):
         """Queries temperature"""
@@ -61,6 +62,12 @@ class ThinThermostatServer(Server):
         self._actuation_value = value
         return HTTPResponse(status=200) #MODIFIED: bottle. removed
 
+    def _measures(self):
+        """Queries all the measures at once (MODIFIED: method added)"""
+        return {'temperature': self.temperature, 
+                'presence': self.presence == 'true', 
+                'valve': self._actuation_value}
+
     def _actuation_value(self):
         """Gets the current actuation value"""
         response.content_type="text/plain"
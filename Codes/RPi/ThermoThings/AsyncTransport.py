@@ -0,0 +1,416 @@
+"""
+    Module used to communicate with the remote devices on a single asyncio event loop.
+
+    This is an alternative to the blocking requests of Sensor and InteractiveSensor
+    (one thread per polled device): all the sensor GETs and valve PUTs of all the
+    RemoteDevices are sent concurrently by the same thread, using only the standard
+    library (asyncio streams). The connection to each device is kept alive between 
+    the requests. The requests sent to a same device (ip:port) are still serialised 
+    and spaced by at least request_gap seconds, by a RequestScheduler that can be shared
+    with the blocking requests (ex: the bulk endpoint detection of a new device).
+
+    The ThermoServer uses it when the 'transport' option of its configuration file is 'async'.
+"""
+
+__version__ = '1.1'
+
+
+import asyncio
+import logging
+import threading
+import time
+
+from Utils import Utils as u
+
+
+class AsyncTransport:
+    """
+        Polls the sensors and actuates the InteractiveSensors of RemoteDevices
+        on its own asyncio event loop.
+    """
+
+    def __init__(self, request_gap=1, timeout=4, scheduler=None):
+        """
+            request_gap: minimal time (in sec.) between 2 requests sent to a same device
+            timeout: maximal time (in sec.) to wait for a device response
+            scheduler (optional): the u.RequestScheduler of the blocking requests to the devices, 
+                the requests to a same device then never overlap (request_gap is then ignored)
+        """
+        self.scheduler = scheduler if scheduler else u.RequestScheduler(request_gap)
+        self.timeout = timeout
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_lock = threading.Lock() # The loop can be run by one thread at a time
+
+        self._connections = {} # {(ip, port):HTTPConnection}
+
+    def poll(self, devices):
+        """
+            Returns the measures of every specified RemoteDevice,
+            as RemoteDevice.get_measures: {device_name:{date:now, measure1:value, ...}, ...}
+        """
+        async def poll_all():
+            measures = await asyncio.gather(*[self._get_measures(device) for device in devices])
+            return {device.name: device_measures for device, device_measures in zip(devices, measures)}
+
+        return self._run(poll_all())
+
+    def set_options(self, actuations):
+        """
+            Sends all the specified values to their InteractiveSensor.
+            actuations is a list of tuples (sensor, value).
+            Returns the list of the response status codes (None for a failed request).
+        """
+        async def set_all():
+            return await asyncio.gather(*[self._set_option(sensor, value) for sensor, value in actuations])
+
+        return self._run(set_all())
+
+    def get_metrics(self):
+        """
+            Returns {(ip, port):number of connections opened} for every device.
+        """
+        return {key: connection.opened for key, connection in self._connections.items()}
+
+    def close(self):
+        with self._loop_lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._loop.run_until_complete(asyncio.sleep(0)) # The transports of the connections are closed
+            self._loop.close()
+
+    def _run(self, coroutine):
+        with self._loop_lock:
+            return self._loop.run_until_complete(coroutine)
+
+    async def _get_measures(self, device):
+        measures = {}
+        if device.bulk_measures: # One request for all the sensors (see RemoteDevice.BULK_PATH)
+            response = await self._request(device.ip, device.port, 'GET', '/' + device.BULK_PATH)
+            if response and response[0] == 200:
+                measures = device.parse_bulk_measures(response[1])
+            elif response:
+                measures = None
+            if measures is None:
+                logging.warning('Bulk endpoint of device %s returned an unexpected response, its sensors will be polled one by one.' % device.name)
+                device.bulk_measures = False
+                measures = {}
+            elif not response:
+                measures = {sensor.measure_name: None for sensor in device.sensors if not sensor.is_local}
+
+        for sensor in device.sensors:
+            if sensor.is_local:
+                measures[sensor.measure_name] = sensor.get_measure()
+            elif sensor.measure_name not in measures:
+                response = await self._request(sensor.ip, sensor.port, 'GET', '/' + sensor.measure_name)
+                measures[sensor.measure_name] = response[1] if response else None
+        measures['date'] = time.time()
+        return measures
+
+    async def _set_option(self, sensor, value):
+        if sensor.is_local:
+            sensor.set_option(value)
+            return 200
+
+        response = await self._request(sensor.ip, sensor.port, 'PUT', '/%s?value=%s' % (sensor.measure_name, str(value)), str(value))
+        return response[0] if response else None
+
+    async def _request(self, ip, port, method, path, content=None):
+        """
+            Sends a request to a device, once the previous request to this device
+            is done and request_gap is elapsed.
+            Returns (status_code, text) or None if the request failed.
+        """
+        key = (str(ip), str(port)) # Same destination as the blocking requests (see device_request)
+        if key not in self._connections:
+            self._connections[key] = HTTPConnection(key[0], int(port))
+        connection = self._connections[key]
+
+        async with self.scheduler.async_slot(key):
+            try:
+                logging.debug('Request will be sent to device on %s : %s %s' % (ip, method, path))
+                return await asyncio.wait_for(connection.request(method, path, content), self.timeout)
+            except asyncio.TimeoutError:
+                logging.error("More than %s seconds elapsed waiting for %s:%s%s." % (str(self.timeout), ip, str(port), path))
+            except (OSError, EOFError) as e:
+                logging.error('Connection with the device %s:%s failed : %s' % (ip, str(port), str(e)))
+            except Exception as e:
+                logging.exception('An unexcpected exception handled during the request %s %s to device %s' % (method, path, ip))
+
+        return None
+
+
+class HTTPConnection:
+    """
+        Minimal HTTP/1.1 client connection to a device, kept alive between the requests.
+        It's (re)opened by the first request and when the device closed it.
+        The requests must be sent one after another.
+    """
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.opened = 0 # Number of connections opened
+
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, content=None):
+        """
+            Sends a request, content is sent as text/plain.
+            Returns (status_code, text).
+        """
+        try:
+            if self._writer != None:
+                try:
+                    return await self._send(method, path, content)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    self.close() # The device closed the idle connection, the request is sent again on a new one
+
+            self._reader, self._writer = await asyncio.open_connection(self.ip, self.port)
+            self.opened += 1
+            return await self._send(method, path, content)
+
+        except BaseException: # Ex: timeout, the rest of the response would be read by the next request
+            self.close()
+            raise
+
+    def close(self):
+        if self._writer != None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def _send(self, method, path, content):
+        body = content.encode('utf-8') if content != None else b''
+        headers = ['%s %s HTTP/1.1' % (method, path),
+                    'Host: %s:%s' % (self.ip, str(self.port))]
+        if content != None:
+            headers += ['Content-Type: text/plain', 'Content-Length: %d' % len(body)]
+
+        self._writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+        await self._writer.drain()
+
+        status_code, response_headers, body = await _read_response(self._reader)
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+
+        return status_code, body.decode('utf-8', 'replace')
+
+
+async def http_request(ip, port, method, path, content=None):
+    """
+        Sends a single HTTP/1.1 request on a new connection (closed after the response).
+        content is sent as text/plain.
+        Returns (status_code, text).
+    """
+    connection = HTTPConnection(ip, port)
+    try:
+        return await connection.request(method, path, content)
+    finally:
+        connection.close()
+
+
+async def _read_response(reader):
+    """
+        Reads a response.
+        Returns (status_code, headers, body), headers being {lower case name:value}.
+        The 'connection' header is 'close' if the end of the body is the end of the connection.
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head[:-4].decode('latin-1').split('\r\n')
+    status_code = int(lines[0].split()[1])
+    headers = {line.split(':', 1)[0].strip().lower(): line.split(':', 1)[1].strip() for line in lines[1:] if ':' in line}
+
+    if status_code < 200 or status_code in (204, 304):
+        body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = await _decode_chunked(reader)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        headers['connection'] = 'close'
+
+    return status_code, headers, body
+
+
+async def _decode_chunked(reader):
+    """
+        Reads and decodes a body sent with 'Transfer-Encoding: chunked' (the trailer is skipped).
+    """
+    rtn = b''
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+        if size == 0:
+            break
+        rtn += await reader.readexactly(size)
+        await reader.readexactly(2) # CRLF of the chunk
+    while await reader.readuntil(b'\r\n') != b'\r\n':
+        pass
+    return rtn
+
+
+def test_decode_chunked(port=9110):
+    print('\n\nTesting the decoding of chunked bodies')
+    async def decode(raw):
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await _decode_chunked(reader), await reader.read()
+
+    assert asyncio.run(decode(b'4\r\n20.5\r\n0\r\n\r\nnext')) == (b'20.5', b'next')
+    assert asyncio.run(decode(b'3;ext=1\r\n{"a\r\nA\r\n": false}\n\r\n0\r\nTrailer: x\r\n\r\n')) == (b'{"a": false}\n', b'')
+
+    async def handle(reader, writer): # Answers every request of the connection with a chunked body
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\n20\r\n2\r\n.5\r\n0\r\n\r\n')
+        except asyncio.IncompleteReadError: # Connection closed by the client
+            writer.close()
+    async def requests():
+        server = await asyncio.start_server(handle, 'localhost', port)
+        connection = HTTPConnection('localhost', port)
+        responses = [await connection.request('GET', '/temperature') for i in range(3)]
+        connection.close()
+        await asyncio.sleep(0.05) # The handler sees the end of the connection
+        server.close()
+        return responses, connection.opened
+
+    assert asyncio.run(requests()) == ([(200, '20.5')]*3, 1), 'The chunked responses must be read on the same connection'
+    print('Chunked bodies correctly decoded.')
+
+
+def test_async_transport(port=9111):
+    print('\n\nTesting the AsyncTransport class with a simulated thin thermostat')
+    from Simulators.ThinThermostatServer import ThinThermostatServer
+    from .ThermoServer import ThermoConfig, RemoteDevice
+
+    simulator = ThinThermostatServer(init_temp=20, port=port)
+    simulator.start()
+    time.sleep(0.5)
+
+    assert asyncio.run(http_request('localhost', port, 'GET', '/temperature')) == (200, '20')
+    assert asyncio.run(http_request('localhost', port, 'PUT', '/valve', '30')) == (200, '')
+    assert asyncio.run(http_request('localhost', port, 'GET', '/valve')) == (200, '30')
+    assert asyncio.run(http_request('localhost', port, 'PUT', '/valve', '300'))[0] == 400
+    assert asyncio.run(http_request('localhost', port, 'GET', '/unknown'))[0] == 404
+
+    sensor_types = ThermoConfig.BASIC_DEVICE_TYPES['thin']
+    device = RemoteDevice([s['constructor']('localhost', port) for s in sensor_types], 'localhost', port, 'device0', 'thin')
+    transport = AsyncTransport(request_gap=0)
+    for bulk_measures in (False, True):
+        device.bulk_measures = bulk_measures
+        for i in range(5):
+            measures = transport.poll([device])['device0']
+            assert measures['temperature'] == '20' and measures['presence'] == 'false', measures
+    assert transport.set_options([(device.get_sensors_by_name('valve'), 40)]) == [200]
+    assert simulator._actuation_value == 40 and transport.poll([device])['device0']['valve'] == '40'
+    assert transport.get_metrics() == {('localhost', str(port)): 1}, 'The connection must be kept alive: %s' % transport.get_metrics()
+    transport.close()
+    device.close()
+    print('Polling and actuation through a kept-alive connection checked.')
+
+
+def test_transport_selection(port=9112):
+    print('\n\nTesting the transport selected by the configuration of the ThermoServer')
+    import json
+    import os
+    import tempfile
+    import xml.etree.ElementTree as ET
+    from Simulators.ThinThermostatServer import ThinThermostatServer
+    from .ThermoServer import ThermoServer
+
+    simulator = ThinThermostatServer(init_temp=20, port=port)
+    simulator.start()
+    time.sleep(0.5)
+
+    tmp_dir = tempfile.mkdtemp()
+    measures = {}
+    for transport in ('async', 'unknown'):
+        tree = ET.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thermoConfig.cfg'))
+        tree.getroot().find('database_name').text = os.path.join(tmp_dir, transport + '.sqlite3')
+        tree.getroot().find('transport').text = transport
+        tree.getroot().find('request_gap').text = '0.2'
+        cfg_path = os.path.join(tmp_dir, transport + '.cfg')
+        tree.write(cfg_path)
+
+        server = ThermoServer(cfg_path)
+        # The bulk endpoint of the new device is detected by a blocking request, while the device is polled
+        registration = {'headers':[], 'content':json.dumps({'ip':'localhost', 'port':port, 'type':'thin'}).encode('utf-8')}
+        assert server.register_new_device(registration) == 200
+        start = time.monotonic()
+        measures[transport] = server.get_devices_measures()['device0']
+        if transport == 'async':
+            assert server._async_transport.scheduler is server.request_scheduler
+            queue = server.request_scheduler.get_metrics()[('localhost', str(port))]
+            assert queue['requests'] >= 2 and queue['max_queue_depth'] >= 2, queue
+            assert time.monotonic() - start >= 0.2, 'The blocking and the async requests to the device must be spaced'
+        else:
+            assert server._async_transport is None, "The 'threads' transport is used by default"
+        server.stop()
+        server.database.close()
+
+    assert {k:v for k, v in measures['async'].items() if k != 'date'} == {k:v for k, v in measures['unknown'].items() if k != 'date'}, measures
+    print('Async transport and fallback to the threads checked.')
+
+
+def bench_async_polling(n_devices=100, latency=0.05, n_cycles=5, base_port=9200):
+    """
+        Polls n_devices simulated thin thermostats, each answering after latency seconds,  
+        with the AsyncTransport (one thread) and with the blocking requests of a pool of 
+        4 threads (the default polling_workers of the ThermoServer).
+    """
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from Simulators.ThinThermostatServer import ThinThermostatServer
+    from .ThermoServer import ThermoConfig, RemoteDevice
+
+    class SlowThinThermostatServer(ThinThermostatServer):
+        def _measures(self):
+            time.sleep(latency)
+            return ThinThermostatServer._measures(self)
+
+    with contextlib.redirect_stdout(io.StringIO()): # The simulators print their start
+        for port in range(base_port, base_port + n_devices):
+            SlowThinThermostatServer(init_temp=20, port=port).start()
+        time.sleep(1)
+
+    sensor_types = ThermoConfig.BASIC_DEVICE_TYPES['thin']
+    devices = [RemoteDevice([s['constructor']('localhost', port) for s in sensor_types], 'localhost', port, 'device%d' % i, 'thin') 
+                for i, port in enumerate(range(base_port, base_port + n_devices))]
+    for device in devices:
+        device.bulk_measures = True
+
+    transport = AsyncTransport(request_gap=0)
+    transport.poll(devices) # Connections opened
+    start = time.perf_counter()
+    for i in range(n_cycles):
+        measures = transport.poll(devices)
+    t_async = (time.perf_counter() - start) / n_cycles
+    assert all(measures[device.name]['temperature'] == '20' for device in devices), measures
+    transport.close()
+
+    pool = ThreadPoolExecutor(max_workers=4)
+    list(pool.map(RemoteDevice.get_measures, devices))
+    start = time.perf_counter()
+    for i in range(n_cycles):
+        measures = dict(zip([device.name for device in devices], pool.map(RemoteDevice.get_measures, devices)))
+    t_threads = (time.perf_counter() - start) / n_cycles
+    assert all(measures[device.name]['temperature'] == '20' for device in devices), measures
+    pool.shutdown()
+    for device in devices:
+        device.close()
+
+    print("Polling of %d devices (%d ms of latency), async transport (1 thread)   : %.2f s" % (n_devices, latency*1e3, t_async))
+    print("Polling of %d devices (%d ms of latency), blocking requests (4 threads) : %.2f s" % (n_devices, latency*1e3, t_threads))
+    return t_async, t_threads
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=getattr(logging, 'WARNING', None))
+    test_decode_chunked()
+    test_async_transport()
+    test_transport_selection()
+    bench_async_polling()
@@ -5,14 +5,27 @@
 
     CREATE TABLE device ('device_id' INTEGER PRIMARY KEY, \
                                                 'name' TEXT UNIQUE, \
-                                                'ip' TEXT);
+                                                'ip' TEXT, \
+                                                'type' TEXT, \
+                                                'port' INTEGER);
     CREATE TABLE measure ('measure_id' INTEGER PRIMARY KEY, \
                                                 'date' INTEGER, \
+                                                'weekday' INTEGER, \
+                                                'sec_of_day' INTEGER, \
                                                 'temperature' REAL, \
                                                 'target_temp' REAL, \
                                                 'presence' INTEGER, \
                                                 'valve' INTEGER)
                                                 'device_id' INTEGER, FOREIGN KEY (device_id) REFERENCES device(device_id));
+    CREATE INDEX measure_device_date ON measure (device_id, date);
+    CREATE INDEX measure_date_presence ON measure (date, presence);
+    CREATE INDEX measure_date_temperature ON measure (date, temperature, target_temp);
+    CREATE INDEX measure_weekday_sec_of_day ON measure (weekday, sec_of_day, device_id, presence, date);
+
+    weekday (0=Sunday, 6=Saturday) and sec_of_day (seconds since midnight) are 
+    derived from date (UTC, like the sqlite date functions) when a measure is added.
+    type and port are saved when a device registers, so that the connected devices 
+    can be rebuilt when the ThermoServer restarts.
 """
  
 __version__ = '2.0'
@@ -21,60 +34,219 @@ __author__ = 'Verstraeten Denis, Sercu Stéphane'
 
 import sqlite3 as s
 
+import collections
 import logging
+import threading
+import queue
 
 import os.path # For tests
+import tempfile # For benchmarks
 
 
 # TODO: what in time?
 import time
 
+def to_sql_value(value, sql_type):
+    """
+        Converts a value (often the text returned by a device: '20.5', 'true', ...) 
+        to the python type matching the sqlite type of its column, so that it's bound 
+        (and stored) with the correct type.
+        Returns None if the value can't be converted.
+    """
+    if value is None:
+        return None
+
+    sql_type = str(sql_type).upper()
+    try:
+        if sql_type in ('INTEGER', 'REAL'):
+            if isinstance(value, str):
+                value = value.strip().lower()
+                value = value == 'true' if value in ('true', 'false') else float(value)
+            number = float(value)
+            if sql_type == 'INTEGER' and number.is_integer():
+                return int(number)
+            return number # A non integer value in an INTEGER column (ex: date) is kept as it is
+        elif sql_type == 'TEXT':
+            return str(value)
+    except (ValueError, TypeError):
+        logging.debug("Value %s can't be converted to %s." % (repr(value), sql_type))
+        return None
+
+    return value
+
+
+def time_columns(date):
+    """
+        Returns the (weekday, sec_of_day) of an epoch date: 
+        weekday = 0 for Sunday to 6 for Saturday, sec_of_day = seconds since midnight.
+        UTC is used, to match strftime('%w', date, 'unixepoch').
+    """
+    t = time.gmtime(date)
+    return (t.tm_wday + 1) % 7, int(date) % (24*3600)
+
+
+class ConnectionManager:
+    """
+        Keeps one sqlite connection alive per thread for a given database.
+
+        The ThermoServer uses the database from several threads (the data 
+        getter RepeatingTimer, the http registration thread and the 24h 
+        analysis thread). A sqlite connection can't be shared between 
+        threads, so each thread gets its own connection, opened on first 
+        use and kept open afterwards (no more connect/close at each query).
+
+        Every new connection is configured with PRAGMAS: WAL journal (readers 
+        don't block the writer), NORMAL synchronous (safe with WAL and far 
+        less fsyncs on the RPi SD card) and a busy timeout so that 2 threads 
+        writing at the same time wait for each other instead of failing.
+    """
+
+    PRAGMAS = [('journal_mode', 'WAL'),
+                ('synchronous', 'NORMAL'),
+                ('temp_store', 'MEMORY'),
+                ('cache_size', -4000), # In KiB when negative
+                ('busy_timeout', 5000)] # In ms
+
+    def __init__(self, db_path, pragmas=None):
+        self.db_path = db_path
+        self.pragmas = pragmas if pragmas != None else self.PRAGMAS
+
+        self._local = threading.local() # Holds the connection of the current thread
+        self._connections = [] # Every opened connection (used by close_all)
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        """
+            Returns the connection of the calling thread (opens it if needed).
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False only allows close_all to close it from another thread, 
+            # a connection is never used by another thread than the one that opened it.
+            conn = s.connect(self.db_path, check_same_thread=False)
+            for pragma, value in self.pragmas:
+                conn.execute("PRAGMA %s=%s" % (pragma, str(value)))
+            logging.debug("New connection to %s opened for thread '%s'." % (self.db_path, threading.current_thread().name))
+
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+            Closes the connection of the calling thread (if any).
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        """
+            Closes the connections of every thread.
+            Must only be called when the database isn't used anymore.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
 class QueryHandler:
     """
         Generic class used to handle the queries sent to a database.
+        The connections are provided by a ConnectionManager (a new one 
+        is created if none is specified).
     """  
-    def __init__(self, db):
+    def __init__(self, db, connection_manager=None):
         self.db_path = db
-        self.conn = None
+        self.connection_manager = connection_manager if connection_manager else ConnectionManager(db)
 
+    @property
+    def conn(self):
+        """
+            Connection of the calling thread.
+        """
+        return self.connection_manager.get_connection()
 
     def get_cursor(self):
-        try:
-            if not self.conn:
-                self.conn = s.connect(self.db_path)
-            cur = self.conn.cursor()
-        except:
-            self.conn = s.connect(self.db_path)
-            cur = self.conn.cursor()
-        finally:
-            return cur 
+        return self.conn.cursor()
+
+    def commit(self):
+        """
+            Commits the pending transaction of the calling thread.
+        """
+        self.conn.commit()
+
+    def explain(self, query, params=()):
+        """
+            Returns the query plan chosen by sqlite for a query, as a list of 
+            str (ex: ['SEARCH measure USING INDEX measure_device_date (device_id=? AND date>?)']).
+        """
+        return [row[-1] for row in self.get_cursor().execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+
+    # ******
+    # Query building
+    # ******
+    # The queries only contain '?' placeholders, the values are bound by sqlite. 
+    # The same query string is thus produced for all the queries with the same 
+    # shape and sqlite can reuse its compiled statement (statement cache).
+
+    def build_insert(self, cols, table_name):
+        """
+            Returns "INSERT INTO table_name (col1, col2) VALUES (?, ?)"
+        """
+        return "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ', '.join(cols), ', '.join(['?']*len(cols)))
+
+    def build_select(self, columns, table_name, cond='', limit=-1, group_by='', order_by='', ascending=False):
+        """
+            Returns "SELECT columns FROM table_name [WHERE cond] [GROUP BY group_by] 
+            [ORDER BY order_by DESC|ASC] [LIMIT ?]" (DESC unless ascending). 
+            cond must use '?' placeholders for its values. 
+            The limit is the last parameter to bind (if any).
+        """
+        req_str = "SELECT %s FROM %s" % (', '.join(columns), table_name)
+
+        if cond:
+            req_str += " WHERE %s" % cond
+
+        if group_by:
+            req_str += " GROUP BY %s" % group_by
+
+        if order_by:
+            req_str += " ORDER BY %s %s" % (order_by, 'ASC' if ascending else 'DESC')
+
+        if limit:
+            req_str += " LIMIT ?"
+
+        return req_str
 
     def insert(self, values, table_name, commit=True):
         """
             Executes an INSERT query.
 
             table_name is the name of the table to be altered 
-            values is a dict {'col_name':'value'}
+            values is a dict {'col_name':value}
 
             Returns the pk of the added row (or None if it fails to add it).
 
-            commit indicates if the transaction must be commited and the 
-            connection closed or not. Optionnal, for optimisation.
-            Warning: commit to False can lead to unexpected result, 
-            especially with multithreading and multiple connection!!
+            commit indicates if the transaction must be commited or not. 
+            Optionnal, for optimisation: the rows are only visible to the other 
+            threads once commit() is called by the same thread.
         """
         last_id = None # Returned value
 
-        # Building request
-        placeholders = ', '.join(values.keys())
-        sql_vals = ', '.join(["'"+str(v)+"'" for v in values.values()])
-        query = "INSERT INTO %s (%s) VALUES (%s)" % (table_name, placeholders, sql_vals)
+        query = self.build_insert(list(values.keys()), table_name)
 
-        logging.debug("SQL Query to be executed in %s: \n%s\n" % (self.db_path, query))
+        logging.debug("SQL Query to be executed in %s: \n%s\n%s\n" % (self.db_path, query, str(list(values.values()))))
 
         try:
             cursor = self.get_cursor()
-            cursor.execute(query)
+            cursor.execute(query, list(values.values()))
             last_id = cursor.lastrowid
             if commit:
                 logging.debug("SQL Query commited.")
@@ -86,70 +258,108 @@ class QueryHandler:
             logging.exception(ex)
 
         finally:
-            if self.conn and commit:
-                self.conn.close()
             return last_id
 
 
 
-    def select(self, columns, table_name, cond='', limit=-1, group_by='', order_by=''):
+    def insert_many(self, rows, table_name, commit=True):
+        """
+            Executes INSERT queries for several rows in a single transaction.
+
+            rows is a list of dict [{'col_name':value}, ...], the rows 
+            having the same columns are sent together with executemany.
+
+            Returns the number of added rows (0 if the transaction failed, 
+            nothing is added in that case).
+        """
+        n_rows = 0
+
+        # Rows sharing the same columns can be sent with the same query
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+        try:
+            cursor = self.get_cursor()
+            for cols, values in groups.items():
+                query = self.build_insert(cols, table_name)
+                logging.debug("SQL Query to be executed in %s for %d rows: \n%s\n" % (self.db_path, len(values), query))
+                cursor.executemany(query, values)
+                n_rows += len(values)
+
+            if commit:
+                logging.debug("SQL Query commited.")
+                self.conn.commit()
+
+        except Exception as ex:
+            logging.error("Exception during the execution of a multiple INSERT query in %s\n\t \
+                            table_name= %s" % (self.db_path, str(table_name)))
+            logging.exception(ex)
+            self.conn.rollback()
+            n_rows = 0
+
+        finally:
+            return n_rows
+
+
+    def select(self, columns, table_name, cond='', limit=-1, group_by='', order_by='', params=(), ascending=False):
         """
             Execute a SELECT request based on the specified args:
                 - colums : List [col1, col2]
-                - cond : string conditions
+                - cond : string conditions, with '?' placeholders for the values
                 - group_by : str columns name
                 - limit : int = maximum field to return
-                - order_by : str = asc / desc 
+                - order_by : str columns name, sorted in descending order (ascending order if ascending)
+                - params : values bound to the placeholders of cond
             Returns a list of dictionnaries
             [{col1:value, col2:value}, {col1:value, col2:value}]
             Returns an empty list ifno results!
-            TODO : method not fully tested!
         """
         rtn = [] # Will contain the value to be returned
 
-        conn = None # Connection to te database
-
         try:
-            conn = s.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Building the sql request
-            req_str = "SELECT %s FROM %s" % (', '.join(columns), table_name)
-
-            if cond:
-                req_str += " WHERE %s" % cond
-
-            if group_by:
-                req_str += " GROUP BY %s" % group_by
-
-            if order_by:
-                req_str += " ORDER BY %s DESC" % order_by
+            cursor = self.get_cursor()
 
-            if limit:
-                req_str += " LIMIT %s" % str(limit)
+            req_str = self.build_select(columns, table_name, cond, limit, group_by, order_by, ascending)
+            bindings = list(params) + ([limit] if limit else [])
 
-            logging.debug("SQL Query to be executed in %s: \n%s\n" % (self.db_path, req_str))
+            logging.debug("SQL Query to be executed in %s: \n%s\n%s\n" % (self.db_path, req_str, str(bindings)))
             
-            sql = cursor.execute(req_str)
+            sql = cursor.execute(req_str, bindings)
             ls = sql.fetchall() # Returns a list of tuple [(t1,),(t2,),...]
             
 
             # Data formatting
-            rtn = []
-            for tup in ls:
-                rtn.append({})
-                for i in range(len(tup)):
-                    rtn[-1:][0][columns[i]] = tup[i]
+            rtn = [dict(zip(columns, tup)) for tup in ls]
 
         except Exception as ex:
             logging.error("Exception during the execution of an SELECT query \
                             in %s\n\t table_name= %s" % (self.db_path, str(table_name)))
             logging.exception(ex)
         finally:
-            if conn:
-                conn.close
             return rtn
 
+    def iter_select(self, columns, table_name, cond='', limit=-1, group_by='', order_by='', params=(), batch_size=256, ascending=False):
+        """
+            Same as select, but yields the rows (dictionnaries {col1:value, ...}) one by one. 
+            They are fetched by batches of batch_size: the result is never loaded in memory at once.
+            The generator must be consumed by the thread that created it (the connections are per thread).
+        """
+        cursor = self.get_cursor()
+        req_str = self.build_select(columns, table_name, cond, limit, group_by, order_by, ascending)
+        bindings = list(params) + ([limit] if limit else [])
+
+        logging.debug("SQL Query to be executed in %s: \n%s\n%s\n" % (self.db_path, req_str, str(bindings)))
+        cursor.execute(req_str, bindings)
+        try:
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield dict(zip(columns, row))
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
 
 class ThermoMeasureHandler(QueryHandler):
     """
@@ -157,14 +367,19 @@ class ThermoMeasureHandler(QueryHandler):
         This class suposes that the structure of the database is a valid ThermoDB structure.
     """
 
-    def __init__(self, db_path, measure_table_name, device_table_name, measure_col_names, device_col_names):
-        super(ThermoMeasureHandler, self).__init__(db_path)
+    def __init__(self, db_path, measure_table_name, device_table_name, measure_col_names, device_col_names, connection_manager=None):
+        super(ThermoMeasureHandler, self).__init__(db_path, connection_manager)
         self.db_path = db_path
         self.measure_table_name = measure_table_name
         self.device_table_name = device_table_name
         self.device_col_names = device_col_names
         self.measure_col_names = measure_col_names
 
+        # Cache {device_name:device_id}, avoids a SELECT on the device table for each measure
+        self._device_ids = {}
+        self._device_ids_lock = threading.Lock()
+        self._load_device_ids()
+
     # ******
     # Measure manipulation
     # ******
@@ -172,19 +387,8 @@ class ThermoMeasureHandler(QueryHandler):
         """
             Add measures related to a device.
         """
-        # SELECT device_id FROM device WHERE name='device_name'
-        sql_device_match = self.get_device_by_name(device_name)
-
-        if sql_device_match: # If martch
-            device_id = sql_device_match['device_id']
-        else:   # No match
-            device_id = self.register_device(device_name)
-            logging.info("Addition of measures related to a unregistered device was \
-                            attemped. %s device was added." % device_name)
-            
-
-        measures['device_id'] = device_id
-        measure_id = self.insert(measures, self.measure_table_name, commit=commit)
+        measures['device_id'] = self.get_device_id(device_name)
+        measure_id = self.insert(self.typed_measures(measures), self.measure_table_name, commit=commit)
         if measure_id:
             logging.debug("New measures were added in the database :\n\t \
                             measures= %s\n\tdevice_name='%s'"%(str(measures), device_name))
@@ -193,37 +397,106 @@ class ThermoMeasureHandler(QueryHandler):
                             measures= %s\n\tdevice_name='%s'"%(str(measures), device_name))
 
 
-    def save_measure_of_all_devices(self, measures):
+    def save_measure_of_all_devices(self, measures, commit=True):
         """
         saves the measures of each remote devices connected to the system into the 
         database.
         measure is a dictionary : - keys : remote devices names
                                   - values : the measures of all the sensors of the 
                                   remote device
+        All the measures are written in a single transaction.
         """ 
-        for device_name in measures.keys():
-            sql_device_match = self.get_device_by_name(device_name)
-            if sql_device_match:
-                device_id = sql_device_match['device_id']
-            else:
-                device_id = self.register_device(device_name)
-                logging.info("Addition of measures related to a unregistered device \
-                                was attemped. %s device was added." % device_name)
+        return self.save_measure_of_cycles([measures], commit)
+
+    def save_measure_of_cycles(self, cycles, commit=True):
+        """
+            Saves the measures of several polling cycles in a single transaction.
+            cycles is a list of measures dictionaries (see save_measure_of_all_devices).
+            Returns the number of added rows.
+        """
+        rows = []
+        for measures in cycles:
+            for device_name, device_measures in measures.items():
+                row = dict(device_measures)
+                row['device_id'] = self.get_device_id(device_name)
+                rows.append(self.typed_measures(row))
+
+        n_rows = self.insert_many(rows, self.measure_table_name, commit=commit)
+        if n_rows:
+            logging.debug("%d new measures added for %d cycle(s)." % (n_rows, len(cycles)))
+        elif rows:
+            logging.error("Addition of measures in the database failed :\n\t \
+                            measures= %s" % str(cycles))
+        return n_rows
 
-            self.add_measure(measures[device_name], device_name)
-            logging.debug("New measures added for '%s'." % device_name)
+    def flush_measure_queue(self, measure_queue, max_cycles=0):
+        """
+            Saves all the cycles buffered in a queue.Queue (each item being a 
+            measures dictionary, see save_measure_of_all_devices) in a single 
+            transaction.
+            max_cycles limits the number of cycles taken from the queue (0 for unlimited).
+            Returns the number of saved cycles, 0 if the transaction failed (ex: the 
+            database stayed locked): the cycles taken from the queue are then lost 
+            (MeasureWriter keeps them until they're saved).
+        """
+        cycles = []
+        while not max_cycles or len(cycles) < max_cycles:
+            try:
+                cycles.append(measure_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if not cycles:
+            return 0
+
+        for i in range(len(cycles)):
+            measure_queue.task_done()
+
+        n_rows = sum(len(measures) for measures in cycles)
+        if n_rows and not self.save_measure_of_cycles(cycles):
+            logging.error("%d cycle(s) couldn't be saved." % len(cycles))
+            return 0
+        return len(cycles)
     
-    def get_measure(self, where=1):
+    def typed_measures(self, measures):
+        """
+            Returns a copy of a measures dict {'col_name':value} in which every 
+            value is converted to the type of its column in the measure table.
+        """
+        rtn = {col: to_sql_value(value, self.measure_col_names.get(col, '')) for col, value in measures.items()}
+
+        if rtn.get('date') is not None and 'weekday' in self.measure_col_names:
+            rtn['weekday'], rtn['sec_of_day'] = time_columns(rtn['date'])
+
+        return rtn
+
+    def get_measure(self, where='1', params=()):
         """
             Gets measure where...
+            where can contain '?' placeholders, bound to params.
+        """
+        return self.select(list(self.measure_col_names.keys()), 'measure', where, params=params)
+
+    def iter_measures_of_device(self, device_name, since=0, limit=-1):
+        """
+            Returns an iterator over the measures of a device saved after the date since, 
+            the most recent first (see iter_select), or None if the device is unknown.
         """
-        return self.select(self.measure_col_names, 'measure', where)
+        device_id = self._device_ids.get(device_name)
+        if device_id is None:
+            device = self.get_device_by_name(device_name)
+            if device is None:
+                return None
+            device_id = device['device_id']
+
+        return self.iter_select(list(self.measure_col_names.keys()), 'measure', 'device_id = ? AND date > ?', limit, 
+                                order_by='date', params=(device_id, since))
 
     def get_measure_by_timestamp(self, start, end):
         """
             returns measures that were collected in the specified tiùestmp
         """
-        return self.get_measure('date > %s AND date < %s'%(str(start), str(end)))
+        return self.get_measure('date > ? AND date < ?', (start, end))
 
     def get_measures_by_day(self, day, n_limit=-1, date_limit=2000000000):
         """
@@ -236,9 +509,9 @@ class ThermoMeasureHandler(QueryHandler):
         """
         COLS = ['date', 'temperature', 'presence', 'valve', 'device_id']
         FROM = 'measure'
-        WHERE = "strftime('%w', date(date, 'unixepoch'))=='"+str(day)+"' AND date < " + str(date_limit)
+        WHERE = "weekday = ? AND date < ?"
 
-        return self.select(COLS, FROM, WHERE, n_limit)
+        return self.select(COLS, FROM, WHERE, n_limit, params=(int(day), date_limit))
 
 
     def get_last_presence(self, max_time=24*3600):
@@ -247,15 +520,18 @@ class ThermoMeasureHandler(QueryHandler):
             containing presence data for the past 'max_time' seconds 
             and for the specified device.
         """
-        WHERE = "date > "+str(time.time()-max_time)+ " AND date <= " + str(time.time())
-        return self.select(['date', 'presence'], 'measure', WHERE, order_by='date')
+        now = time.time()
+        WHERE = "date > ? AND date <= ?"
+        return self.select(['date', 'presence'], 'measure', WHERE, order_by='date', params=(now - max_time, now))
 
     def get_date_of_first_entry(self, device_name):
         """
-            returns the epoch date of the first entry in the measure table
+            returns the epoch date of the first entry of a device in the measure table
+            (None if there's no entry)
             this will be used in a method from the Smart Control
         """
-        return self.select(['date'], 'measure', "measure_id=1")[date]
+        rtn = self.select(['MIN(date)'], 'measure', "device_id = ?", params=(self.get_device_id(device_name),))
+        return rtn[0]['MIN(date)'] if rtn else None
 
 
 
@@ -270,52 +546,160 @@ class ThermoMeasureHandler(QueryHandler):
         """   
         COLS = ['presence']
         FROM = 'measure'
-        WHERE = "strftime('%w', date(date, 'unixepoch'))== '" + str(day) + "' AND \
-         date - strftime('%s', date(date, 'unixepoch', 'start of day')) >= " + str(time_min) + " AND \
-         date - strftime('%s', date(date, 'unixepoch', 'start of day')) <= " + str(time_max) + " AND \
-         presence != 'NULL' AND date < " + str(date_limit) + " AND device.name == " + str(device_name)
+        WHERE = "weekday = ? AND sec_of_day >= ? AND sec_of_day <= ? AND \
+         device_id = ? AND presence IS NOT NULL AND date < ?"
 
-        return self.select(COLS, FROM, WHERE, n_limit)
+        return self.select(COLS, FROM, WHERE, n_limit, params=(int(day), time_min, time_max, self.get_device_id(device_name), date_limit))
 
 
-    def get_relevant_times_of_today(self, today, device_name, n_limit=-1, date_limit=2000000000):
+    def get_presence_histogram(self, device_name, slot_length=15*60, date_limit=2000000000, day=None):
+        """
+            Returns the ratio of presence of a device for every time slot of 
+            every weekday, computed by a single GROUP BY query:
+            histogram[day][slot] = presence ratio between slot*slot_length and 
+            (slot+1)*slot_length seconds after midnight on weekday day (0=Sunday), 
+            None if there's no presence measure in this slot.
+            date_limit (int): only the measures older than date_limit are used
+            day (optional): only this weekday is computed (the others are left to None)
+        """
+        n_slots = (24*3600) // slot_length
+        histogram = [[None]*n_slots for day in range(7)]
+
+        SLOT = "sec_of_day / %d" % int(slot_length)
+        COLS = ['weekday', SLOT, 'AVG(presence)']
+        WHERE = "device_id = ? AND presence IS NOT NULL AND date < ?"
+        params = [self.get_device_id(device_name), date_limit]
+        if day is not None:
+            WHERE += " AND weekday = ?"
+            params.append(int(day))
+
+        rows = self.select(COLS, 'measure', WHERE, group_by='weekday, ' + SLOT, params=params)
+        for row in rows:
+            histogram[row['weekday']][row[SLOT]] = row['AVG(presence)']
+
+        return histogram
+
+
+    def get_relevant_times_of_today(self, today, device_name=None, n_limit=-1, date_limit=2000000000):
         """
             Returns all the measures of a day 
             today is a string formatted to match the sqlite function
-            date(date)
+            date(date, 'unixepoch') ('YYYY-MM-DD')
+            If device_name is specified, only the measures of this device are returned.
         """
         COLS = ['date']
         FROM = 'measure'
-        WHERE = "date(date) == '" + today + "' AND \
-        target_temp != 'NULL' AND temperature != 'NULL' AND date < " + str(date_limit)
+        WHERE = "date(date, 'unixepoch') = ? AND \
+        target_temp IS NOT NULL AND temperature IS NOT NULL AND date < ?"
+        params = [today, date_limit]
+
+        if device_name:
+            WHERE += " AND device_id = ?"
+            params.append(self.get_device_id(device_name))
 
-        return self.select(COLS, FROM, WHERE, n_limit)
+        return self.select(COLS, FROM, WHERE, n_limit, params=params)
           
 
     # ******
     # Device manipulation
     # ******
 
-    def register_device(self, device_name, ip=''):
+    def register_device(self, device_name, ip='', device_type=None, port=None):
         """
-            Add a new device with the specified name (and ip) in the database.
+            Add a new device with the specified name (and ip, type and port) in the database.
+            If a device with this name is already registered, its id is 
+            returned and nothing is added (its ip, type and port are updated 
+            if a type is specified).
         """
-        device_id = self.insert({'name':device_name, 'ip':ip}, 'device')
-        if not device_id: # That means it failed to add it in the database
-            logging.warning("ThermoMeasureHandler failled to register a new \
-                                device (%s)" % device_name)
+        values = {'name':device_name, 'ip':ip}
+        if device_type is not None and 'type' in self.device_col_names:
+            values['type'] = device_type
+            values['port'] = to_sql_value(port, self.device_col_names['port'])
+
+        with self._device_ids_lock:
+            device_id = self._device_ids.get(device_name)
+            if device_id:
+                logging.debug("Device %s is already registered (device_id=%s)." % (device_name, str(device_id)))
+                if 'type' in values:
+                    self.conn.execute("UPDATE device SET ip = ?, type = ?, port = ? WHERE device_id = ?", 
+                                        (ip, values['type'], values['port'], device_id))
+                    self.conn.commit()
+                return device_id
+
+            device_id = self.insert(values, 'device')
+            if device_id:
+                self._device_ids[device_name] = device_id
+            else: # That means it failed to add it in the database
+                logging.warning("ThermoMeasureHandler failled to register a new \
+                                    device (%s)" % device_name)
 
         return device_id
 
+    def get_device_id(self, device_name):
+        """
+            Returns the id of the device with the specified name, using the cache.
+            An unknown device is registered.
+        """
+        device_id = self._device_ids.get(device_name)
+        if not device_id:
+            device_id = self.register_device(device_name)
+            logging.info("Addition of measures related to a unregistered device was \
+                            attemped. %s device was added." % device_name)
+        return device_id
+
+    def _load_device_ids(self):
+        """
+            Fills the device ids cache with the content of the device table.
+        """
+        with self._device_ids_lock:
+            for device in self.select(['device_id', 'name'], self.device_table_name):
+                self._device_ids.setdefault(device['name'], device['device_id'])
+
+    def get_device_names(self):
+        """
+            Returns the names of all the devices of the device table (with or without type).
+        """
+        with self._device_ids_lock:
+            return list(self._device_ids.keys())
+
+    def get_device_name_at(self, ip, port):
+        """
+            Returns the name of the device saved at (ip, port), or None.
+            A device saved by an older version (without port) matches if it's the only one saved at this ip.
+        """
+        if 'port' not in self.device_col_names:
+            rows = self.select(['name'], self.device_table_name, 'ip = ?', params=(str(ip),))
+            return rows[0]['name'] if len(rows) == 1 else None
+
+        port = to_sql_value(port, self.device_col_names['port'])
+        rows = self.select(['name'], self.device_table_name, 'ip = ? AND port = ?', params=(str(ip), port))
+        if rows:
+            return rows[0]['name']
+        rows = self.select(['name', 'port'], self.device_table_name, 'ip = ?', params=(str(ip),))
+        if len(rows) == 1 and rows[0]['port'] is None:
+            return rows[0]['name']
+        return None
+
+    def get_registered_devices(self):
+        """
+            Returns the devices saved with their type and port, in their registration 
+            order: [{'device_id', 'name', 'ip', 'type', 'port'}, ...]
+        """
+        if 'type' not in self.device_col_names:
+            return []
+        return self.select(['device_id', 'name', 'ip', 'type', 'port'], self.device_table_name, 
+                            'type IS NOT NULL AND port IS NOT NULL', order_by='device_id', ascending=True)
+
 
-    def get_device_where(self, where):
+    def get_device_where(self, where, params=()):
         """
-            Return a dictionnary with 3 keys (the three columns in the 
-            database) : 'device_id', 'name' and 'ip', containing the 
-            data about the device matching the specified condition (where)
+            Return a dictionnary with a key per column of the device table 
+            ('device_id', 'name', 'ip', 'type' and 'port'), containing the 
+            data about the device matching the specified condition (where, 
+            its '?' placeholders are bound to params)
         """
-        # SELECT device_id, name, ip FROM device WHERE where
-        matching_devices = self.select(['device_id', 'name', 'ip'], 'device', where)
+        # SELECT device_id, name, ip, type, port FROM device WHERE where
+        matching_devices = self.select(list(self.device_col_names.keys()), 'device', where, params=params)
         if matching_devices:
             rtn = matching_devices[0] # Normally, only one matches, anywayn the first match is returned.
         else:
@@ -324,16 +708,174 @@ class ThermoMeasureHandler(QueryHandler):
 
     def get_device_by_id(self, d_id):
         """
-            Returns a dictionnary with 3 keys (the three columns in the 
-            database) : 'device_id', 'name' and 'ip'.
+            Returns a dictionnary with a key per column of the device table (see get_device_where).
         """
-        # SELECT device_id, name, ip FROM device WHERE id='d_id'
-        return self.get_device_where("id='%s'"%d_id)
+        # SELECT device_id, name, ip, type, port FROM device WHERE device_id=d_id
+        return self.get_device_where("device_id = ?", (d_id,))
         
 
     def get_device_by_name(self, d_name):
-        # SELECT device_id, name, ip FROM device WHERE name='d_name'
-        return self.get_device_where("name='%s'"%d_name)
+        # SELECT device_id, name, ip, type, port FROM device WHERE name='d_name'
+        return self.get_device_where("name = ?", (d_name,))
+
+
+
+class MeasureWriter:
+    """
+        Write-behind buffer of the polling cycles: the measures are queued by the 
+        polling thread (put never waits for the database) and saved by a dedicated 
+        writer thread, which commits all the queued cycles in a single transaction 
+        (see ThermoMeasureHandler.save_measure_of_cycles) every flush_interval seconds, 
+        or earlier when the queue is half full.
+
+        The queue is bounded (max_cycles): when it's full, the oldest cycle is 
+        dropped to make room for the new one (and counted in the metrics).
+        A flush only removes the cycles from the queue once they're committed: the 
+        cycles of a failed flush stay at its head and are saved by the next flush.
+    """
+
+    def __init__(self, query_handler, max_cycles=1000, flush_interval=1.0):
+        """
+            query_handler: ThermoMeasureHandler saving the measures
+            max_cycles: maximal number of cycles waiting to be saved
+            flush_interval: maximal time (in sec.) between the queuing of a cycle and its commit
+        """
+        self.query_handler = query_handler
+        self.flush_interval = flush_interval
+        self.max_cycles = max_cycles
+        self._cycles = collections.deque() # Oldest cycle first
+
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flush_lock = threading.Lock() # Serialises the flushes
+        self._lock = threading.Lock() # Protects the queue and the metrics, never held while writing
+
+        self.queued = 0
+        self.dropped = 0
+        self._evicted = 0 # Cycles dropped from the head of the queue, including the ones being flushed
+        self.max_queue_depth = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.lost = 0 # Cycles left in the queue when the writer stopped
+        self.last_flush_duration = 0
+        self.max_flush_duration = 0
+
+    def start(self):
+        """
+            Starts the writer thread (if it isn't already running).
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(None, self._run, 'MeasureWriterThread')
+            self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self, wait=True):
+        """
+            Stops the writer thread once the queued cycles are saved.
+            If wait, blocks until they are.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self.is_alive():
+            if wait:
+                self._thread.join()
+        else:
+            self.flush()
+
+    def put(self, measures):
+        """
+            Queues the measures of a polling cycle (see save_measure_of_all_devices) without waiting.
+            Returns False if the oldest queued cycle had to be dropped.
+        """
+        with self._lock:
+            dropped = len(self._cycles) >= self.max_cycles
+            if dropped:
+                self._cycles.popleft()
+                self.dropped += 1
+                self._evicted += 1
+            self._cycles.append(measures)
+            depth = len(self._cycles)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+        if dropped:
+            logging.warning("Measure queue full (%d cycles), the oldest cycle was dropped." % self.max_cycles)
+        if depth >= self.max_cycles // 2:
+            self._wakeup.set()
+        return not dropped
+
+    def flush(self):
+        """
+            Saves the queued cycles in a single transaction. Returns the number of saved cycles.
+            The cycles stay in the queue if the transaction fails.
+        """
+        with self._flush_lock:
+            with self._lock:
+                cycles = list(self._cycles)
+                evicted = self._evicted
+            if not cycles:
+                return 0
+
+            start = time.monotonic()
+            n_rows = sum(len(measures) for measures in cycles)
+            saved = not n_rows or self.query_handler.save_measure_of_cycles(cycles)
+            duration = time.monotonic() - start
+
+            with self._lock:
+                if not saved:
+                    self.failed_flushes += 1
+                else:
+                    # The cycles dropped by put during the flush were saved anyway
+                    n_evicted = min(self._evicted - evicted, len(cycles))
+                    self.dropped -= n_evicted
+                    for i in range(len(cycles) - n_evicted):
+                        self._cycles.popleft()
+                    self.last_flush_duration = duration
+                    self.max_flush_duration = max(self.max_flush_duration, duration)
+                    self.flushes += 1
+                    self.flushed += len(cycles)
+
+        if not saved:
+            logging.error("%d cycle(s) couldn't be saved, they are kept in the queue." % len(cycles))
+            return 0
+        return len(cycles)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.error("The queued measures couldn't be saved : %s" % str(ex))
+
+        self.flush() # The cycles queued before the stop
+        with self._lock:
+            remaining = len(self._cycles)
+            self._cycles.clear()
+            self.lost += remaining
+        if remaining:
+            logging.error("%d cycle(s) couldn't be saved before the stop of the writer." % remaining)
+
+    def get_metrics(self):
+        """
+            Returns {'queue_depth', 'max_queue_depth', 'max_cycles', 'queued', 'dropped', 
+            'flushes', 'flushed', 'failed_flushes', 'lost', 'mean_batch', 'last_flush_duration', 
+            'max_flush_duration'}, counted in polling cycles, durations in sec.
+            flushes and flushed only count the saved cycles.
+        """
+        with self._lock:
+            return {'queue_depth':len(self._cycles), 'max_queue_depth':self.max_queue_depth, 
+                    'max_cycles':self.max_cycles, 'queued':self.queued, 'dropped':self.dropped,
+                    'flushes':self.flushes, 'flushed':self.flushed, 
+                    'failed_flushes':self.failed_flushes, 'lost':self.lost,
+                    'mean_batch':self.flushed / self.flushes if self.flushes else 0,
+                    'last_flush_duration':self.last_flush_duration, 'max_flush_duration':self.max_flush_duration}
 
 
 
@@ -348,8 +890,27 @@ class ThermoDB:
 
 
         A valid structure for a database managed
+
+        The time-range queries on the measure table are served by the INDEXES:
+            - measure_device_date : measures of a device in a time range
+            - measure_date_presence : covering index of the presence history (get_last_presence)
+            - measure_date_temperature : covering index of the temperature 
+                lookups by date (PIDHandler)
+            - measure_weekday_sec_of_day : presence of a weekday in a time 
+                interval (ProbabilityModelHandler)
     """
 
+    INDEXES = {'measure_device_date':['device_id', 'date'],
+                'measure_date_presence':['date', 'presence'],
+                'measure_date_temperature':['date', 'temperature', 'target_temp'],
+                'measure_weekday_sec_of_day':['weekday', 'sec_of_day', 'device_id', 'presence', 'date']}
+
+    # Columns derived from the date of the measures
+    TIME_COLS = {'weekday':'INTEGER', 'sec_of_day':'INTEGER'}
+
+    # Columns of the device table needed to rebuild the devices at startup
+    DEVICE_COLS = {'type':'TEXT', 'port':'INTEGER'}
+
     def __init__(self, db_path, device_types, measure_table_name='measure', device_table_name='device'):
         """
             Creates a new database at the specified path. 
@@ -370,9 +931,12 @@ class ThermoDB:
 
         self.query_handler = None
 
+        # Shared by every QueryHandler of this database, keeps the connections alive.
+        self.connection_manager = ConnectionManager(self.db_path)
+
         try:
 
-            conn = s.connect(self.db_path)
+            conn = self.connection_manager.get_connection()
 
             existing_tables = self._get_table_names(conn)
 
@@ -386,30 +950,41 @@ class ThermoDB:
                 existing_cols = self._get_cols(conn, 'measure')
                 specified_cols = self._get_cols_from_device_types(device_types)
 
-                req_alter_str = ''
                 cursor = conn.cursor()
                 for col_name, col_type in specified_cols.items(): # Checks if all the needed columns already exist
                     if not col_name in existing_cols.keys():
-                        req_alter_str += "ALTER TABLE measure ADD COLUMN %s %s;" % (col_name, col_type)
+                        req_alter_str = "ALTER TABLE measure ADD COLUMN %s %s;" % (col_name, col_type)
                         cursor.execute(req_alter_str)
                         logging.debug("Column %s of type %s added to measure." % (col_name, col_type))
 
                 conn.commit()
 
+                self.add_time_columns(conn, existing_cols)
+                self.add_device_columns(conn, self._get_cols(conn, 'device'))
+
             else:
                 logging.error("A file named %s already exists but isn't a valid ThermoDB." % db_path)
                 raise Excpetion("Not valid ThermoDB")
                 pass # TODO; what if a db already exists at db_path but isn't a valid ThermoDB?
                 # Delete it and create a new one? Create a new one with another name?
 
+            self.create_indexes(conn) # Also adds the missing indexes to the databases created by older versions
+
             measure_col_names = self._get_cols(conn, 'measure')
             device_col_names = self._get_cols(conn, 'device')
-            self.query_handler = ThermoMeasureHandler(self.db_path, self.measure_table_name, self.device_table_name, measure_col_names, device_col_names)
+            self.query_handler = ThermoMeasureHandler(self.db_path, self.measure_table_name, self.device_table_name, measure_col_names, device_col_names, self.connection_manager)
 
         except Exception as ex:
             logging.exception(ex)
 
 
+    def close(self):
+        """
+            Closes every connection opened on this database.
+        """
+        self.connection_manager.close_all()
+
+
     def create_tables(self, conn, device_types):
         """
             Adds 2 new tables (measure and device) to the specified database 
@@ -422,12 +997,18 @@ class ThermoDB:
         # Device
         req_str_device = "CREATE TABLE device ('device_id' INTEGER PRIMARY KEY, \
                                                 'name' TEXT, \
-                                                'ip' TEXT);"
+                                                'ip' TEXT"
+        for col_name, col_type in self.DEVICE_COLS.items():
+            req_str_device += ", '%s' %s" % (col_name, col_type)
+        req_str_device += ");"
 
         # Measure
         cols = self._get_cols_from_device_types(device_types)
         req_str_measure = "CREATE TABLE measure ('measure_id' INTEGER PRIMARY KEY, 'date' INTEGER"
 
+        for col_name, col_type in self.TIME_COLS.items():
+            req_str_measure += ", '%s' %s" % (col_name, col_type)
+
         for col_name, col_type in cols.items():
             req_str_measure += ", '%s' %s" % (col_name, col_type)
 
@@ -443,6 +1024,60 @@ class ThermoDB:
 
 
 
+    def add_time_columns(self, conn, existing_cols):
+        """
+            Adds the TIME_COLS to the measure table of a database created by an 
+            older version (existing_cols are the current columns of the table) 
+            and computes them for the already saved measures.
+        """
+        missing_cols = {col: col_type for col, col_type in self.TIME_COLS.items() if col not in existing_cols}
+        if missing_cols:
+            cursor = conn.cursor()
+            for col_name, col_type in missing_cols.items():
+                cursor.execute("ALTER TABLE measure ADD COLUMN %s %s;" % (col_name, col_type))
+                logging.debug("Column %s of type %s added to measure." % (col_name, col_type))
+
+            # Same results as time_columns
+            cursor.execute("UPDATE measure SET weekday = CAST(strftime('%w', date, 'unixepoch') AS INTEGER), \
+                                                sec_of_day = CAST(date AS INTEGER) % 86400 \
+                                                WHERE date IS NOT NULL;")
+            logging.info("weekday and sec_of_day computed for %d existing measures." % cursor.rowcount)
+            conn.commit()
+
+
+    def add_device_columns(self, conn, existing_cols):
+        """
+            Adds the DEVICE_COLS to the device table of a database created by an 
+            older version (existing_cols are the current columns of the table).
+            The devices already saved have no type: they'll be rebuilt once they register again.
+        """
+        missing_cols = {col: col_type for col, col_type in self.DEVICE_COLS.items() if col not in existing_cols}
+        if missing_cols:
+            cursor = conn.cursor()
+            for col_name, col_type in missing_cols.items():
+                cursor.execute("ALTER TABLE device ADD COLUMN %s %s;" % (col_name, col_type))
+                logging.debug("Column %s of type %s added to device." % (col_name, col_type))
+            conn.commit()
+
+
+    def create_indexes(self, conn):
+        """
+            Adds the indexes of INDEXES (if they don't already exist) to the measure 
+            table of the specified database. An index is skipped if one of its 
+            columns doesn't exist in the measure table (the columns depend on 
+            the supported device types).
+        """
+        existing_cols = self._get_cols(conn, 'measure')
+
+        cursor = conn.cursor()
+        for index_name, cols in self.INDEXES.items():
+            if all(col in existing_cols for col in cols):
+                req_str = "CREATE INDEX IF NOT EXISTS %s ON measure (%s);" % (index_name, ', '.join(cols))
+                cursor.execute(req_str)
+                logging.debug("Index checked : \n %s" % req_str)
+        conn.commit()
+
+
     def _get_cols_from_device_types(self, device_types):
         """
             transforms 
@@ -582,6 +1217,11 @@ def test_device_getting_data(TDB):
     print('Using the specific method "get_device_by_name"...')
     print(QH.get_device_by_name('test1'))
 
+    print('Checking the device ids cache...')
+    assert QH.get_device_id('test1') == QH.get_device_by_name('test1')['device_id']
+    QH2 = ThermoDB(TDB.db_path, {}).query_handler # Cache filled from the device table
+    assert QH2.get_device_id('test1') == QH.get_device_id('test1')
+
 def test_measure_getting_data(TDB):
     """
         Adds...
@@ -604,11 +1244,383 @@ def test_devices_measures_saving(TDB):
     data = {'device0':{'temperature':'32.0', 'presence':'1', 'date':'3000000'}, 'device1':{'temperature':'33.0'}}
     TDB.query_handler.save_measure_of_all_devices(data)
 
+def test_measure_queue_flushing(TDB):
+    """
+        Tests the flush_measure_queue method: 3 buffered cycles are saved at once.
+    """
+    QH = TDB.query_handler
+    n_before = len(QH.get_measure())
+
+    measure_queue = queue.Queue()
+    for i in range(3):
+        measure_queue.put({'device0':{'temperature':20.0+i, 'date':time.time()}, 'device1':{'temperature':10.0+i, 'date':time.time()}})
+
+    print("Flushing 3 cycles...")
+    assert QH.flush_measure_queue(measure_queue) == 3
+    assert measure_queue.empty()
+    assert len(QH.get_measure()) == n_before + 6
+    print("6 measures added.")
+
+def test_measure_writer(TDB):
+    """
+        Tests the MeasureWriter class: the queued cycles are saved in batches by the writer thread, 
+        the oldest cycles are dropped when the queue is full, the queue is flushed at stop.
+    """
+    QH = TDB.query_handler
+    n_before = len(QH.get_measure())
+    cycle = lambda i: {'device0':{'temperature':20.0+i, 'date':time.time()}}
+
+    print("Queuing 5 cycles, flushed every 0.2 sec....")
+    writer = MeasureWriter(QH, max_cycles=100, flush_interval=0.2)
+    writer.start()
+    for i in range(5):
+        assert writer.put(cycle(i))
+    time.sleep(0.4)
+    assert len(QH.get_measure()) == n_before + 5
+    assert writer.get_metrics()['flushes'] == 1, writer.get_metrics()
+
+    print("Queuing 5 cycles in a queue of 3 cycles...")
+    writer.stop()
+    writer = MeasureWriter(QH, max_cycles=3, flush_interval=60)
+    results = [writer.put(cycle(i)) for i in range(5)]
+    assert results == [True, True, True, False, False]
+    writer.start()
+    writer.stop()
+    metrics = writer.get_metrics()
+    assert (metrics['dropped'], metrics['flushed'], metrics['queue_depth']) == (2, 3, 0), metrics
+    assert len(QH.get_measure()) == n_before + 8
+    print(metrics)
+
+    print("Queuing 3 cycles while the database is locked by another connection...")
+    TDB2 = ThermoDB(TDB.db_path, {})
+    TDB2.connection_manager.pragmas = [('busy_timeout', 50)] # For the connection of the writer thread
+    locker = s.connect(TDB.db_path)
+    locker.execute("BEGIN IMMEDIATE")
+    writer = MeasureWriter(TDB2.query_handler, max_cycles=10, flush_interval=0.1)
+    for i in range(3):
+        writer.put(cycle(i))
+    writer.start()
+    time.sleep(0.4)
+    metrics = writer.get_metrics()
+    assert metrics['flushed'] == 0 and metrics['failed_flushes'] >= 1 and metrics['queue_depth'] == 3, metrics
+    for i in range(9): # The kept cycles count in the size of the queue
+        writer.put(cycle(i))
+    metrics = writer.get_metrics()
+    assert (metrics['queue_depth'], metrics['dropped']) == (10, 2), metrics
+    locker.commit()
+    time.sleep(0.3)
+    metrics = writer.get_metrics()
+    assert (metrics['flushed'], metrics['flushes'], metrics['lost'], metrics['queue_depth']) == (10, 1, 0, 0), metrics
+    assert len(QH.get_measure()) == n_before + 18
+
+    print("Stopping the writer while the database is locked...")
+    locker.execute("BEGIN IMMEDIATE")
+    writer.put(cycle(0))
+    writer.put(cycle(1))
+    writer.stop()
+    locker.commit()
+    locker.close()
+    metrics = writer.get_metrics()
+    assert (metrics['flushed'], metrics['lost'], metrics['queue_depth']) == (10, 2, 0), metrics
+    assert len(QH.get_measure()) == n_before + 18
+    print(metrics)
+
+    print("Queuing 2 cycles in a full queue while its 3 cycles are flushed...")
+    class QueuingHandler: # Saves the cycles and queues 2 new cycles meanwhile
+        saved = []
+        def save_measure_of_cycles(self, cycles):
+            writer.put(cycle(8))
+            writer.put(cycle(9))
+            self.saved.extend(cycles)
+            return len(cycles)
+    writer = MeasureWriter(QueuingHandler(), max_cycles=3, flush_interval=60)
+    for i in range(3):
+        writer.put(cycle(i))
+    assert writer.flush() == 3 and len(QueuingHandler.saved) == 3
+    metrics = writer.get_metrics()
+    assert (metrics['queue_depth'], metrics['dropped']) == (2, 0), 'The dropped cycles were being saved: %s' % metrics
+    assert writer.flush() == 2 and [c['device0']['temperature'] for c in QueuingHandler.saved[3:5]] == [28.0, 29.0]
+
+def test_query_plans(TDB):
+    """
+        Checks (and prints) that the time-range queries on the measure table 
+        are served by an index instead of a full table scan.
+    """
+    QH = TDB.query_handler
+    queries = {'measures of a device in a time range':
+                    (QH.build_select(['date', 'temperature'], 'measure', 'device_id = ? AND date > ? AND date < ?', 0), (1, 0, 1)),
+                'get_measure_by_timestamp':
+                    (QH.build_select(list(QH.measure_col_names.keys()), 'measure', 'date > ? AND date < ?', 0), (0, 1)),
+                'get_last_presence':
+                    (QH.build_select(['date', 'presence'], 'measure', 'date > ? AND date <= ?', 0, order_by='date'), (0, 1)),
+                'PIDHandler.get_error':
+                    (QH.build_select(['temperature', 'target_temp'], 'measure', 'date = ?', 0), (0,)),
+                'get_presence_by_day_and_by_time_interval':
+                    (QH.build_select(['presence'], 'measure', 'weekday = ? AND sec_of_day >= ? AND sec_of_day <= ? AND \
+                        device_id = ? AND presence IS NOT NULL AND date < ?', 0), (0, 0, 899, 1, 2000000000))}
+
+    for name, (query, params) in queries.items():
+        plan = QH.explain(query, params)
+        print("Query plan of %s : %s" % (name, ' / '.join(plan)))
+        assert any('USING INDEX' in step or 'USING COVERING INDEX' in step for step in plan), "%s is a full table scan" % name
+
+
+def test_presence_histogram():
+    """
+        Saves one week of presence measures (presence from 8h to 12h every 
+        day, absence otherwise) and checks the presence histogram.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), 'histogram.db')
+    QH = ThermoDB(db_path, {'thin':[{'measure_name':'presence', 'measure_type':'INTEGER'}]}).query_handler
+    start = 1451606400 # 01/01/2016 00:00:00 (Friday)
+    cycles = [{'device0':{'date':d, 'presence':int(8*3600 <= d % (24*3600) < 12*3600)}} for d in range(start, start + 7*24*3600, 60)]
+    QH.save_measure_of_cycles(cycles)
+
+    histogram = QH.get_presence_histogram('device0')
+    assert len(histogram) == 7 and all(len(day) == 96 for day in histogram)
+    for day in histogram:
+        assert day == [1.0 if 32 <= slot < 48 else 0.0 for slot in range(96)]
+    assert QH.get_presence_histogram('device0', date_limit=start+60)[5][0] == 0.0
+    assert QH.get_presence_histogram('device0', date_limit=start+60)[5][1] is None
+    assert QH.get_presence_histogram('device0', day=5) == [histogram[5] if day == 5 else [None]*96 for day in range(7)]
+    print("Presence histogram correctly computed.")
+
+
+def test_time_columns_backfill():
+    """
+        Creates a database with the structure of the previous versions (no weekday 
+        and sec_of_day columns), loads it with ThermoDB and checks that the 
+        derived columns were added and computed for the existing measures.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), 'old_structure.db')
+    conn = s.connect(db_path)
+    conn.execute("CREATE TABLE device ('device_id' INTEGER PRIMARY KEY, 'name' TEXT, 'ip' TEXT);")
+    conn.execute("CREATE TABLE measure ('measure_id' INTEGER PRIMARY KEY, 'date' INTEGER, 'presence' INTEGER, \
+                    'device_id' INTEGER, FOREIGN KEY (device_id) REFERENCES device(device_id));")
+    conn.execute("INSERT INTO device (name, ip) VALUES ('device0', '')")
+    dates = [1451606400 + i*3*3600 + 17 for i in range(100)] # 01/01/2016 (Friday) 00:00:17 + 3h steps
+    conn.executemany("INSERT INTO measure (date, presence, device_id) VALUES (?, 1, 1)", [(d,) for d in dates])
+    conn.commit()
+    conn.close()
+
+    print("Loading a database without weekday and sec_of_day columns...")
+    QH = ThermoDB(db_path, {'thin':[{'measure_name':'presence', 'measure_type':'INTEGER'}]}).query_handler
+    for row in QH.select(['date', 'weekday', 'sec_of_day'], 'measure'):
+        assert (row['weekday'], row['sec_of_day']) == time_columns(row['date'])
+
+    assert time_columns(1451606400 + 17) == (5, 17) # Friday
+    assert len(QH.get_presence_by_day_and_by_time_interval(5, 0, 3600, 'device0')) == 2 # 2 Fridays in 100 x 3h
+    print("weekday and sec_of_day correctly computed.")
+
+
+def test_registered_devices():
+    """
+        Loads a database without the type and port columns in the device table 
+        and checks that the devices registered with a type and a port are saved.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), 'old_devices.db')
+    conn = s.connect(db_path)
+    conn.execute("CREATE TABLE device ('device_id' INTEGER PRIMARY KEY, 'name' TEXT, 'ip' TEXT);")
+    conn.execute("CREATE TABLE measure ('measure_id' INTEGER PRIMARY KEY, 'date' INTEGER, \
+                    'device_id' INTEGER, FOREIGN KEY (device_id) REFERENCES device(device_id));")
+    conn.execute("INSERT INTO device (name, ip) VALUES ('device0', '10.0.0.1')")
+    conn.commit()
+    conn.close()
+
+    print("Loading a database without type and port columns in the device table...")
+    QH = ThermoDB(db_path, {}).query_handler
+    assert QH.get_registered_devices() == [], 'A device without type can\'t be rebuilt'
+    QH.register_device('device0', '10.0.0.1', 'thin', '8080')
+    QH.register_device('device1', '10.0.0.2', 'outside', 80)
+    QH.register_device('device2') # Unregistered device (measures received before its registration)
+
+    QH = ThermoDB(db_path, {}).query_handler
+    assert [(d['name'], d['ip'], d['type'], d['port']) for d in QH.get_registered_devices()] == \
+            [('device0', '10.0.0.1', 'thin', 8080), ('device1', '10.0.0.2', 'outside', 80)]
+    assert QH.get_device_by_name('device1')['type'] == 'outside'
+    assert QH.build_select(['name'], 'device', order_by='device_id', ascending=True) == "SELECT name FROM device ORDER BY device_id ASC LIMIT ?"
+    print("Devices correctly saved with their type and port.")
+
+
+def bench_connection_pooling(n=2000):
+    """
+        Compares the latency of a device lookup (get_device_by_name) using 
+        the persistent connections of the ConnectionManager with the 
+        latency of the same query on a brand new connection (previous 
+        behaviour of QueryHandler.select).
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench_pool.db')
+    TDB = ThermoDB(db_path, {'thin':[{'measure_name':'temperature', 'measure_type':'REAL'}]})
+    QH = TDB.query_handler
+    for i in range(10):
+        QH.register_device('device%d' % i, '127.0.0.%d' % i)
+
+    # Connection opened for every query
+    start = time.perf_counter()
+    for i in range(n):
+        conn = s.connect(db_path)
+        conn.execute("SELECT device_id, name, ip FROM device WHERE name='device%d'" % (i % 10)).fetchall()
+        conn.close()
+    t_new_conn = (time.perf_counter() - start) / n
+
+    # Persistent connection
+    start = time.perf_counter()
+    for i in range(n):
+        QH.get_device_by_name('device%d' % (i % 10))
+    t_pooled = (time.perf_counter() - start) / n
+
+    TDB.close()
+    print("Device lookup, new connection per query : %.1f us" % (t_new_conn*1e6))
+    print("Device lookup, persistent connection    : %.1f us" % (t_pooled*1e6))
+    return t_new_conn, t_pooled
+
+
+def bench_batched_ingestion(n_cycles=200, n_devices=4):
+    """
+        Compares the time needed to save polling cycles with one INSERT + commit 
+        per device (add_measure) and with one transaction per cycle 
+        (save_measure_of_all_devices).
+    """
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench_batch.db')
+    TDB = ThermoDB(db_path, {'thin':[{'measure_name':'temperature', 'measure_type':'REAL'}, 
+                                        {'measure_name':'presence', 'measure_type':'INTEGER'}]})
+    QH = TDB.query_handler
+    cycle = {'device%d' % i:{'temperature':20.0, 'presence':1, 'date':time.time()} for i in range(n_devices)}
+
+    start = time.perf_counter()
+    for i in range(n_cycles):
+        for device_name, measures in cycle.items():
+            QH.add_measure(dict(measures), device_name)
+    t_per_row = (time.perf_counter() - start) / n_cycles
+
+    start = time.perf_counter()
+    for i in range(n_cycles):
+        QH.save_measure_of_all_devices(cycle)
+    t_per_cycle = (time.perf_counter() - start) / n_cycles
+
+    TDB.close()
+    print("Cycle of %d devices, one commit per device : %.2f ms" % (n_devices, t_per_row*1e3))
+    print("Cycle of %d devices, one commit per cycle  : %.2f ms" % (n_devices, t_per_cycle*1e3))
+    return t_per_row, t_per_cycle
+
+
+def bench_query_building(n_rows=5000, n_scans=200):
+    """
+        Compares the insertion and the range scan throughputs of queries built 
+        by formatting the values in the sql string (previous behaviour of 
+        QueryHandler) and of the parameterised queries of QueryHandler.
+    """
+    device_types = {'thin':[{'measure_name':'temperature', 'measure_type':'REAL'}, 
+                            {'measure_name':'presence', 'measure_type':'INTEGER'}]}
+    rows = [{'date':1451606400 + 3*i, 'temperature':str(15 + (i % 100)/10), 'presence':'true', 'device_id':1} for i in range(n_rows)]
+
+    # String-built queries
+    TDB = ThermoDB(os.path.join(tempfile.mkdtemp(), 'bench_str.db'), device_types)
+    conn = TDB.connection_manager.get_connection()
+    start = time.perf_counter()
+    for row in rows:
+        sql_vals = ', '.join(["'"+str(v)+"'" for v in row.values()])
+        conn.execute("INSERT INTO measure (%s) VALUES (%s)" % (', '.join(row.keys()), sql_vals))
+    conn.commit()
+    t_insert_str = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n_scans):
+        begin = 1451606400 + 3*(i*n_rows//n_scans)
+        conn.execute("SELECT date, temperature FROM measure WHERE date > %s AND date < %s" % (str(begin), str(begin + 3600))).fetchall()
+    t_scan_str = time.perf_counter() - start
+    TDB.close()
+
+    # Parameterised queries (same sql execution, without the QueryHandler logging and formatting)
+    TDB = ThermoDB(os.path.join(tempfile.mkdtemp(), 'bench_param.db'), device_types)
+    QH = TDB.query_handler
+    conn = TDB.connection_manager.get_connection()
+    typed_rows = [QH.typed_measures(row) for row in rows]
+    start = time.perf_counter()
+    for row in typed_rows:
+        conn.execute(QH.build_insert(list(row.keys()), 'measure'), list(row.values()))
+    conn.commit()
+    t_insert_param = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n_scans):
+        begin = 1451606400 + 3*(i*n_rows//n_scans)
+        conn.execute(QH.build_select(['date', 'temperature'], 'measure', 'date > ? AND date < ?', 0), (begin, begin + 3600)).fetchall()
+    t_scan_param = time.perf_counter() - start
+    TDB.close()
+
+    print("Insert, string-built sql    : %.0f rows/s" % (n_rows/t_insert_str))
+    print("Insert, parameterised sql   : %.0f rows/s" % (n_rows/t_insert_param))
+    print("Range scan, string-built sql  : %.0f scans/s" % (n_scans/t_scan_str))
+    print("Range scan, parameterised sql : %.0f scans/s" % (n_scans/t_scan_param))
+    return t_insert_str, t_insert_param, t_scan_str, t_scan_param
+
+
+def bench_write_behind(n_cycles=50, lock_duration=0.05):
+    """
+        Measures how long the polling thread waits to save a cycle (one device) while another 
+        thread keeps write transactions open (ex: the analysis thread), when it saves the cycle 
+        itself (save_measure_of_all_devices) and when it queues it in a MeasureWriter.
+    """
+    TDB = ThermoDB(os.path.join(tempfile.mkdtemp(), 'bench_writer.db'), 
+                    {'thin':[{'measure_name':'temperature', 'measure_type':'REAL'}]})
+    QH = TDB.query_handler
+    QH.register_device('device0')
+
+    stop = threading.Event()
+    def hold_write_lock():
+        conn = TDB.connection_manager.get_connection()
+        while not stop.is_set():
+            conn.execute("BEGIN IMMEDIATE")
+            time.sleep(lock_duration)
+            conn.commit()
+            time.sleep(lock_duration)
+    locker = threading.Thread(target=hold_write_lock)
+    locker.start()
+
+    def max_wait(save):
+        waits = []
+        for i in range(n_cycles):
+            start = time.perf_counter()
+            save({'device0':{'temperature':20.0, 'date':time.time()}})
+            waits.append(time.perf_counter() - start)
+            time.sleep(0.01)
+        return max(waits)
+
+    t_direct = max_wait(QH.save_measure_of_all_devices)
+    writer = MeasureWriter(QH, flush_interval=0.1)
+    writer.start()
+    t_queued = max_wait(writer.put)
+    writer.stop()
+    stop.set()
+    locker.join()
+
+    assert len(QH.get_measure()) == 2*n_cycles
+    TDB.close()
+    print("Save of a cycle during writes of another thread, direct       : max %.1f ms" % (t_direct*1e3))
+    print("Save of a cycle during writes of another thread, write-behind : max %.3f ms (%d flushes)" 
+            % (t_queued*1e3, writer.get_metrics()['flushes']))
+    return t_direct, t_queued
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=getattr(logging, 'DEBUG', None))
     TDB = test_db_creation()
     test_device_getting_data(TDB)
     test_measure_getting_data(TDB)
     test_devices_measures_saving(TDB)
+    test_measure_queue_flushing(TDB)
+    test_measure_writer(TDB)
+    test_query_plans(ThermoDB(TDB.db_path, {'thin':[{'measure_name':'temperature', 'measure_type':'REAL'}, 
+                                                    {'measure_name':'target_temp', 'measure_type':'REAL'}]}))
+    test_time_columns_backfill()
+    test_registered_devices()
+    test_presence_histogram()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bench_connection_pooling()
+    bench_batched_ingestion()
+    bench_query_building()
+    bench_write_behind()
 
 
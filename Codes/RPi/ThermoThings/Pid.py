@@ -33,6 +33,7 @@ class PID:
         self.date = time.time()
         self.temperature = 18
         self.target_temp = 20
+        self.heating_time = 30*60 # Time (in sec.) needed to reach the target temperature
 
 
     def error(self, target_temp, temperature):
@@ -103,6 +104,14 @@ class PID:
             return valve
 
 
+    def get_heating_time(self):
+        """
+        returns the time (in sec.) needed to reach the target temperature, the valve 
+        is opened this time before a predicted presence
+        """
+        return self.heating_time
+
+
     def set_constants(self, constants):
         """
         this will update the pid constants
@@ -345,7 +354,7 @@ class PIDHandler:
         this will return the initial temperature of the dico_measure
         """
         t = time_vector[0]
-        return self.thermo_measure_handler.select(['temperature'], 'measure', "date == '%s'" % t)[0]['temperature']
+        return self.thermo_measure_handler.select(['temperature'], 'measure', "date = ?", params=(t,))[0]['temperature']
 
     def get_time_vector(self, date):
 
@@ -386,7 +395,7 @@ class PIDHandler:
         """
         returns the error at a given time
         """
-        dico = self.thermo_measure_handler.select(['temperature', 'target_temp'], 'measure', "date == '%s'" % t)[0]
+        dico = self.thermo_measure_handler.select(['temperature', 'target_temp'], 'measure', "date = ?", params=(t,))[0]
 
         return dico['target_temp'] - dico['temperature']
 
@@ -396,8 +405,8 @@ class PIDHandler:
         """
         returns the target temp at a given time
         """
-        #print(self.thermo_measure_handler.select(['target_temp'], 'measure', "date == '%s'" % t))
-        return self.thermo_measure_handler.select(['target_temp'], 'measure', "date == '%s'" % t)[0]['target_temp']
+        #print(self.thermo_measure_handler.select(['target_temp'], 'measure', "date = ?", params=(t,)))
+        return self.thermo_measure_handler.select(['target_temp'], 'measure', "date = ?", params=(t,))[0]['target_temp']
 
     def integrate_on_a_time_vector(self, time_vector):
         """
@@ -0,0 +1,293 @@
+"""
+    Module deciding when the remote devices must be polled.
+
+    Instead of polling every device at the same period, each device type has
+    its own polling period range (min_period, max_period), declared in the
+    device_types of the configuration file. The period of each device is
+    tightened when its measures vary or when a presence is detected, and
+    relaxed when nothing happens: the number of requests and of saved
+    measures follows the amount of information rather than the number of devices.
+
+    The devices that stop answering are polled less and less often (see 
+    DeviceHealthTracker), so that an unreachable device doesn't cost its 
+    timeouts at every polling cycle.
+"""
+
+__version__ = '1.0'
+
+
+import collections
+import logging
+import statistics
+import threading
+import time
+
+
+class AdaptivePollingScheduler:
+    """
+        Keeps the polling period and the time of the next poll of each RemoteDevice.
+
+        After each poll of a device, its period is:
+            - set to min_period if a presence is measured,
+            - halved if the variance of the last WINDOW values of one of its numeric measures exceeds 
+              its threshold (from variance_thresholds, variance_threshold by default),
+            - multiplied by RELAX_FACTOR otherwise,
+        and kept between the min_period and max_period of its type.
+        The presence and the readbacks of the actuators (ex: the valve set by the server) aren't 
+        measured information: their variance is ignored.
+    """
+
+    WINDOW = 5 # Number of values of each measure used to compute the variance
+    RELAX_FACTOR = 1.5
+    PRESENCE = 'presence'
+
+    def __init__(self, polling_periods, default_period):
+        """
+            polling_periods: {device_type:{'min_period', 'max_period', 'variance_threshold', 'variance_thresholds'}},
+                variance_thresholds being the thresholds of specific measures {measure_name:threshold} (optional)
+            default_period: period (in sec.) of the device types without polling periods
+        """
+        self.polling_periods = polling_periods
+        self.default_period = default_period
+        self._states = {} # {device_name:{'period', 'next_poll', 'history':{measure_name:deque}}}
+        self._lock = threading.Lock()
+
+    def get_settings(self, device_type):
+        """
+            Returns the polling settings {'min_period', 'max_period', 'variance_threshold', 'variance_thresholds'} of a device type.
+        """
+        settings = {'min_period':self.default_period, 'max_period':self.default_period, 'variance_threshold':0, 'variance_thresholds':{}}
+        settings.update(self.polling_periods.get(device_type, {}))
+        return settings
+
+    def tick_period(self):
+        """
+            Returns the period (in sec.) at which due_devices should be called: the smallest min_period.
+        """
+        return min([self.default_period] + [self.get_settings(d_type)['min_period'] for d_type in self.polling_periods])
+
+    def due_devices(self, devices, now=None):
+        """
+            Returns the devices that must be polled now. A new device is polled directly.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for device in devices:
+                if device.name not in self._states:
+                    self._states[device.name] = {'period':self.get_settings(device.type)['min_period'],
+                                                    'next_poll':now, 'history':{}}
+            # A small margin avoids to miss a poll because the timer ticked slightly early
+            return [device for device in devices if self._states[device.name]['next_poll'] <= now + 0.01]
+
+    def record(self, device, measures, now=None):
+        """
+            Updates the period of a device with the measures of its last poll and schedules its next poll.
+            Returns the new period.
+        """
+        now = time.monotonic() if now is None else now
+        settings = self.get_settings(device.type)
+
+        with self._lock:
+            state = self._states.setdefault(device.name, {'period':settings['min_period'], 'next_poll':now, 'history':{}})
+
+            ignored = {'date', self.PRESENCE} | {sensor.measure_name for sensor in device.sensors if sensor.is_actuator}
+            varying = False
+            for measure_name, value in measures.items():
+                value = _to_number(value)
+                if measure_name in ignored or value is None:
+                    continue
+                history = state['history'].setdefault(measure_name, collections.deque(maxlen=self.WINDOW))
+                history.append(value)
+                threshold = settings['variance_thresholds'].get(measure_name, settings['variance_threshold'])
+                if len(history) > 1 and statistics.pvariance(history) > threshold:
+                    varying = True
+
+            if is_present(measures.get(self.PRESENCE)):
+                period = settings['min_period']
+            elif varying:
+                period = state['period'] / 2
+            else:
+                period = state['period'] * self.RELAX_FACTOR
+
+            state['period'] = min(max(period, settings['min_period']), settings['max_period'])
+            state['next_poll'] = now + state['period']
+            return state['period']
+
+    def get_periods(self):
+        """
+            Returns the current polling period of each device {device_name:period}.
+        """
+        with self._lock:
+            return {device_name: state['period'] for device_name, state in self._states.items()}
+
+
+class DeviceHealthTracker:
+    """
+        Follows the consecutive failed polls of each RemoteDevice (a poll fails when 
+        no measure of its remote sensors is received).
+
+        A device is 'alive' until SUSPECT_AFTER consecutive failures, then 'suspect', 
+        then 'dead' after DEAD_AFTER failures. Once suspect, the device is only polled 
+        again after a back-off delay, doubled at each new failure (from its polling 
+        period up to max_backoff). A successful poll (or a new registration) makes it alive again.
+    """
+
+    ALIVE, SUSPECT, DEAD = 'alive', 'suspect', 'dead'
+    SUSPECT_AFTER = 2
+    DEAD_AFTER = 5
+
+    def __init__(self, max_backoff=600):
+        """
+            max_backoff: maximal delay (in sec.) between two polls of a device that doesn't answer
+        """
+        self.max_backoff = max_backoff
+        self._states = {} # {device_name:{'state', 'failures', 'next_attempt'}}
+        self._lock = threading.Lock()
+
+    def available_devices(self, devices, now=None):
+        """
+            Returns the devices that can be polled now: the alive ones and the ones whose back-off delay elapsed.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [device for device in devices if self._states.get(device.name, {}).get('next_attempt', now) <= now]
+
+    def record(self, device, measures, period, now=None):
+        """
+            Updates the health of a device with the measures of its last poll (None if the poll failed).
+            period is the polling period of the device, the first back-off delay.
+            Returns the state of the device.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._states.setdefault(device.name, {'state':self.ALIVE, 'failures':0, 'next_attempt':now})
+            previous_state = state['state']
+
+            if not _poll_failed(device, measures):
+                state.update({'state':self.ALIVE, 'failures':0, 'next_attempt':now})
+                if previous_state != self.ALIVE:
+                    logging.info('Device %s answers again, it will be polled normally.' % device.name)
+                return state['state']
+
+            state['failures'] += 1
+            if state['failures'] >= self.DEAD_AFTER:
+                state['state'] = self.DEAD
+            elif state['failures'] >= self.SUSPECT_AFTER:
+                state['state'] = self.SUSPECT
+
+            if state['state'] != self.ALIVE:
+                backoff = min(period * 2**(state['failures'] - self.SUSPECT_AFTER), self.max_backoff)
+                state['next_attempt'] = now + backoff
+                if state['state'] != previous_state:
+                    logging.warning('Device %s is %s (%d failed polls), next poll in %.0f sec.' 
+                                        % (device.name, state['state'], state['failures'], backoff))
+            return state['state']
+
+    def reset(self, device_name):
+        """
+            Makes a device alive again (ex: it registered again).
+        """
+        with self._lock:
+            self._states.pop(device_name, None)
+
+    def get_states(self):
+        """
+            Returns the health of the devices that failed at least once {device_name:{'state', 'failures'}}.
+        """
+        with self._lock:
+            return {device_name: {'state':state['state'], 'failures':state['failures']} 
+                    for device_name, state in self._states.items() if state['failures']}
+
+
+def _poll_failed(device, measures):
+    """
+        A poll failed if it raised (measures is None) or if none of the remote sensors answered.
+    """
+    if measures is None:
+        return True
+    remote_measures = [measures.get(sensor.measure_name) for sensor in device.sensors if not sensor.is_local]
+    return bool(remote_measures) and all(value is None for value in remote_measures)
+
+
+def _to_number(value):
+    """
+        Returns the value (often the text returned by a device) as a float, or None if it isn't numeric.
+    """
+    if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+        return float(value.strip().lower() == 'true')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_present(value):
+    """
+        Returns True if a presence measure (ex: the text 'true' returned by a device, True or 1) reports a presence.
+    """
+    return _to_number(value) == 1
+
+
+def test_adaptive_polling():
+    print('\n\nTesting the AdaptivePollingScheduler class')
+    Sensor = collections.namedtuple('Sensor', ['measure_name', 'is_actuator'])
+    Device = collections.namedtuple('Device', ['name', 'type', 'sensors'])
+    thin_sensors = [Sensor('temperature', False), Sensor('presence', False), Sensor('valve', True), Sensor('humidity', False)]
+    thin, outside = Device('device0', 'thin', thin_sensors), Device('device1', 'outside', [Sensor('temperature', False)])
+    scheduler = AdaptivePollingScheduler({'thin':{'min_period':2, 'max_period':16, 'variance_threshold':0.01, 
+                                                    'variance_thresholds':{'humidity':4}}}, 10)
+
+    assert scheduler.tick_period() == 2
+    assert scheduler.due_devices([thin, outside], now=0) == [thin, outside], 'New devices are polled directly'
+
+    assert scheduler.record(thin, {'temperature':'20', 'presence':'false'}, now=0) == 3
+    assert scheduler.record(thin, {'temperature':'20', 'presence':'false'}, now=3) == 4.5
+    assert scheduler.due_devices([thin, outside], now=5) == [outside]
+    assert scheduler.record(thin, {'temperature':'21', 'presence':'false'}, now=7.5) == 2.25, 'Varying temperature'
+    assert scheduler.record(thin, {'temperature':'21', 'presence':'true'}, now=10) == 2, 'Presence'
+    for i in range(10):
+        period = scheduler.record(thin, {'temperature':'21', 'presence':'false', 'date':i}, now=12 + i)
+    assert period == 16, 'max_period'
+    for valve in ('0', '100', '0', '100'):
+        period = scheduler.record(thin, {'temperature':'21', 'presence':'false', 'valve':valve}, now=30)
+    assert period == 16, 'The valve readback is set by the server, its variance is ignored'
+    assert scheduler.record(thin, {'temperature':'21', 'presence':'false', 'humidity':'40'}, now=30) == 16
+    assert scheduler.record(thin, {'temperature':'21', 'presence':'false', 'humidity':'41'}, now=30) == 16, 'Variance under the humidity threshold'
+    assert scheduler.record(thin, {'temperature':'21', 'presence':'false', 'humidity':'50'}, now=30) == 8, 'Variance over the humidity threshold'
+
+    assert scheduler.record(outside, {'temperature':'-5'}, now=0) == 10, 'Type without polling periods'
+    assert scheduler.record(outside, {'temperature':None}, now=10) == 10
+
+
+def test_device_health():
+    print('\n\nTesting the DeviceHealthTracker class')
+    Sensor = collections.namedtuple('Sensor', ['measure_name', 'is_local'])
+    Device = collections.namedtuple('Device', ['name', 'type', 'sensors'])
+    sensors = [Sensor('temperature', False), Sensor('target_temp', True)]
+    thin, other = Device('device0', 'thin', sensors), Device('device1', 'thin', sensors)
+    health = DeviceHealthTracker(max_backoff=20)
+    failed = {'temperature':None, 'target_temp':20}
+
+    assert health.record(thin, failed, 3, now=0) == 'alive'
+    assert health.available_devices([thin, other], now=0) == [thin, other], 'A single failure is tolerated'
+    assert health.record(thin, None, 3, now=0) == 'suspect'
+    assert health.available_devices([thin, other], now=2.9) == [other]
+    assert health.available_devices([thin, other], now=3) == [thin, other], 'Back-off of one period'
+    assert health.record(thin, failed, 3, now=3) == 'suspect'
+    assert health.available_devices([thin], now=8.9) == [], 'Back-off doubled'
+    health.record(thin, failed, 3, now=9)
+    assert health.record(thin, failed, 3, now=21) == 'dead'
+    assert health.available_devices([thin], now=40.9) == [], 'max_backoff'
+    assert health.get_states() == {'device0':{'state':'dead', 'failures':5}}
+
+    assert health.record(thin, {'temperature':'20', 'target_temp':20}, 3, now=41) == 'alive', 'Answers again'
+    assert health.available_devices([thin], now=41) == [thin] and health.get_states() == {}
+    health.record(other, None, 3, now=0)
+    health.record(other, None, 3, now=0)
+    health.reset('device1')
+    assert health.available_devices([other], now=0) == [other], 'Registered again'
+
+
+if __name__ == '__main__':
+    test_adaptive_polling()
+    test_device_health()
@@ -13,10 +13,12 @@ __author__ = "Denis Verstraeten"
 __version__ = "1.0"
 
 from Utils.Utils import TimeOperator
-from .Data import ThermoDB  # For tests
+from .Data import ThermoDB, time_columns
+import numpy as np
 import logging
 import os.path # For tests
-import time # For tests
+import tempfile # For tests
+import time
 #import matplotlib.pyplot as plt # To show graphics
 
 
@@ -28,6 +30,49 @@ def linear_equation_solver(A, b):
     b = np.array(b)
     return list(np.linalg.solve(A, b))  
 
+def fit_presence_polynomials(histogram, slot_length=15*60, degree=5):
+    """
+    returns the least-squares polynomial fits of the presence ratios of several days
+
+    histogram is a list of days, each day being a list of measured presence ratios 
+    (one per slot of slot_length seconds, None for a slot without measure)
+    returns an array (one row per day) of degree+1 coefficients, highest degree first, 
+    of p(t) with t in seconds since midnight (as expected by ProbabilityModel.set_constants)
+
+    The time is scaled to [0, 1[ (a day) in the Vandermonde matrix, the raw seconds 
+    raised to the 10th power make the system ill-conditioned. The slots without 
+    measure are weighted 0. All the days are solved in one batched pseudo-inverse.
+    """
+    ratios = np.array([[np.nan if r == None else r for r in day] for day in histogram], dtype=float) # (n_days, n_slots)
+    observed = ~np.isnan(ratios)
+
+    scale = 24*3600.
+    t = np.arange(ratios.shape[1]) * slot_length / scale
+    V = np.vander(t, degree + 1) # (n_slots, degree+1), highest power first
+
+    weighted_V = V[np.newaxis, :, :] * observed[:, :, np.newaxis] # (n_days, n_slots, degree+1)
+    y = np.where(observed, ratios, 0)[:, :, np.newaxis]
+
+    coefs = np.matmul(np.linalg.pinv(weighted_V), y)[:, :, 0]
+
+    return coefs / scale**np.arange(degree, -1, -1) # Back to t in seconds
+
+
+def evaluate_probability_models(models, t):
+    """
+    evaluates several ProbabilityModel over an array of times (seconds since midnight)
+    returns an array with one row of clipped probabilities per model
+    """
+    t = np.asarray(t, dtype=float)
+    constants = np.array([model.get_constants() for model in models], dtype=float) # (n_models, 6)
+
+    rtn = np.zeros((len(models),) + t.shape)
+    for k in range(constants.shape[1]): # Horner's scheme
+        rtn = rtn*t + constants[:, k].reshape((-1,) + (1,)*t.ndim)
+
+    return np.clip(rtn, 0, 1)
+
+
 class HeatingPropertiyModel:
     def __init__(self, query_handler, device_name):
         """
@@ -82,6 +127,20 @@ class ProbabilityModel:
         return rtn
 
 
+    def probability_curve(self, t):
+        """
+        vectorised probability_model: returns the probabilities over an array of times (Horner's scheme)
+        """
+        return evaluate_probability_models([self], t)[0]
+
+
+    def get_constants(self):
+        """
+        returns the constants, highest degree first
+        """
+        return [self.A, self.B, self.C, self.D, self.E, self.F]
+
+
     def set_constants(self, constants):
         """
         sets the value of the constants
@@ -103,89 +162,124 @@ class ProbabilityModelHandler:
     This class will handle everything that needs to be done on the probability model
     """
 
+    TABLE_STEP = 60 # resolution (in seconds) of the probability table
+
     def __init__(self, thermo_measures_handler, device_name):
 
         self.list_of_probability_model = [ProbabilityModel(i) for i in range(7)]    
         self.thermo_measures_handler = thermo_measures_handler
+        self.device_name = device_name
         self.time_vector_discrete = [i*15*60 for i in range(96)]
         self.time_vector_continuous = [i for i in range(86400)]
 
-        
-    def update_probality_model(self, day=None):
+        # presence_histogram[day][i] = measured presence ratio in the 15 min slot starting at time_vector_discrete[i]
+        self.presence_histogram = None
+        self.last_update = None # Date of the last fit
+
+        # probability_table[day][i] = probability of presence at i*TABLE_STEP seconds on day (one more column for 86400 itself)
+        self.probability_table = np.zeros((7, 86400//self.TABLE_STEP + 1))
+        self.refresh_probability_table()
+
+
+    def update_presence_histogram(self):
         """
-        this will update the constants to make the model fit the reality better
+        retrieves the measured presence ratio of every 15 min slot of every day (one single query)
         """
-        if day == None:
-            day = TimeOperator.get_current_day() # Today by default
-        A = []
-        b = [None]*6
-        t = self.time_vector_discrete
-
-        for i in range(6):
-            A.append([])
-            b[i] = self.coef_b(5-i, t, day)
-            for j in range(6):
-
-                A[i].append(self.coef_a(10-i-j, t))   #those lines are creating the matrixes
-                     
-        constants = linear_equation_solver(A, b)
-        self.list_of_probability_model[day].set_constants(constants)    
-    
+        self.presence_histogram = self.thermo_measures_handler.get_presence_histogram(self.device_name, 15*60)
 
 
-    def get_probability(self, t):
+    def update_probability_model(self):
         """
-        returns the probability at a given time
+        updates the models of the 7 days of the week, the measured presence is retrieved once for all of them 
+        and the 7 models are fitted together
         """
-        day = self.time_operator.get_current_day()
-        if t > 86400:
-            t = t % 86400
-            day = self.time_operator.increment_day(day)
+        self.last_update = time.time()
+        self.update_presence_histogram()
+        for day, constants in enumerate(fit_presence_polynomials(self.presence_histogram)):
+            self.list_of_probability_model[day].set_constants(list(constants))
+        self.refresh_probability_table()
 
-        return self.list_of_probability_model[day].probability_model(t) 
 
+    def update_new_data(self, now=None):
+        """
+        refits only the days of the week that received measures since the last fit (every day 
+        if the models were never fitted or if the last fit is older than a week)
+        returns the refitted days
+        """
+        now = time.time() if now == None else now
+        if self.last_update == None or now - self.last_update >= 7*86400:
+            self.update_probability_model()
+            return list(range(7))
 
-    def measured_probability(self, day, t):
+        days = {time_columns(date)[0] for date in np.arange(self.last_update, now, 86400)} | {time_columns(now)[0]}
+        for day in sorted(days):
+            self.update_probality_model(day)
+        self.last_update = now
+        return sorted(days)
+
+        
+    def update_probality_model(self, day=None):
         """
-        returns the measured probability of presence at a given time of a day
+        this will update the constants of the model of a day (today by default) to make it fit the reality better
+        only the measured presence of this day is retrieved
         """
-        t_min = t
-        t_max = t + 15*60 - 1
-        list_of_presence_dico = self.thermo_measures_handler.get_presence_by_day_and_by_time_interval(day, t_min, t_max, device_name)
-        return self.probability_ratio(list_of_presence_dico)
+        if day == None:
+            day = TimeOperator.get_current_day() # Today by default
+        if self.presence_histogram == None:
+            self.presence_histogram = [[None]*len(self.time_vector_discrete) for d in range(7)]
+        self.presence_histogram[day] = self.thermo_measures_handler.get_presence_histogram(self.device_name, 15*60, day=day)[day]
 
+        constants = fit_presence_polynomials([self.presence_histogram[day]])[0]
+        self.list_of_probability_model[day].set_constants(list(constants))    
+        self.refresh_probability_table(day)
 
-    def probability_ratio(self, ls):
+
+    def refresh_probability_table(self, day=None):
         """
-        returns the ratio of the number of observed presence
-        on a given time
+        computes the probability table of a day (of every day if day is None) from its model
         """
-        N = len(ls)
-        n = 0
-        for dico in ls:
-            n += dico['presence']
+        days = range(7) if day == None else [day]
+        grid = np.arange(self.probability_table.shape[1]) * self.TABLE_STEP
+        for d in days:
+            self.probability_table[d] = self.list_of_probability_model[d].probability_curve(grid)
+    
 
-        return n/N  
 
-        
-    def coef_a(self, j, ls):
+    def get_probability(self, t):
         """
-        function used to simplify the mathematical expression used in the update model
+        returns the probability at a given time (seconds since midnight today, 
+        a time beyond 86400 belongs to the following days)
+        the probability is interpolated in the probability table
         """
-        rtn = 0
-        for elem in ls:
-            rtn += elem**j
-        return rtn
+        day = (TimeOperator.get_current_day() + int(t // 86400)) % 7
+        t = t % 86400
+
+        i, frac = divmod(t / self.TABLE_STEP, 1)
+        row = self.probability_table[day]
+        i = int(i)
+        return float(row[i] + frac*(row[i+1] - row[i]))
+
+
+    def get_probability_curve(self, t, day=None):
+        """
+        returns the probabilities over an array of times (in seconds since the 
+        midnight of day, a time beyond 86400 belongs to the following days)
+        """
+        if day == None:
+            day = TimeOperator.get_current_day()
+        t = np.asarray(t, dtype=float)
+        days = (day + t // 86400).astype(int) % 7
+        curves = evaluate_probability_models(self.list_of_probability_model, t % 86400) # One curve per day
+        return np.choose(days, curves)
 
 
-    def coef_b(self, r, ls, day):
+    def measured_probability(self, day, t):
         """
-        function used to simplify the mathematical expression used in the update model
+        returns the measured probability of presence at a given time of a day
+        (0 if there's no measure at that time)
         """
-        rtn = 0
-        for elem in ls:
-            rtn += self.measured_probability(day, elem)*(elem**r)
-        return rtn    
+        ratio = self.presence_histogram[day][int(t // (15*60))]
+        return ratio if ratio != None else 0
 
 
 #************************
@@ -216,6 +310,77 @@ def create_test_db():
 
     return TDB
 
+def test_probability_table():
+    """
+    checks get_probability and get_probability_curve against ProbabilityModel.probability_model, 
+    and that update_new_data only refits the days that received measures
+    """
+    print('Testing the probability table of ProbabilityModelHandler')
+    TDB = ThermoDB(os.path.join(tempfile.mkdtemp(), 'presence.db'), {'thin':[{'measure_name':'presence', 'measure_type':'INTEGER'}]})
+    PMH = ProbabilityModelHandler(TDB.query_handler, 'device0')
+
+    today = TimeOperator.get_current_day()
+    tomorrow = (today + 1) % 7
+    PMH.list_of_probability_model[today].set_constants([0, 0, 0, -1.6e-10, 1.4e-5, -0.2]) # Maximum ~0.1 around 12h
+    PMH.list_of_probability_model[tomorrow].set_constants([0, 0, 0, 0, 1/86400., 0])
+    PMH.refresh_probability_table()
+
+    t = np.arange(0, 2*86400, 97)
+    expected = [PMH.list_of_probability_model[today if x < 86400 else tomorrow].probability_model(x % 86400) for x in t]
+    assert np.allclose([PMH.get_probability(x) for x in t], expected, atol=1e-4)
+    assert np.allclose(PMH.get_probability_curve(t), expected, atol=1e-12)
+
+    friday = 1451606400 # 01/01/2016 00:00 (UTC), a Friday
+    PMH.update_probability_model() # No measure yet
+    PMH.last_update = friday
+    TDB.query_handler.save_measure_of_cycles([{'device0':{'date':friday + slot*15*60, 'presence':int(32 <= slot < 80)}} 
+                                                for slot in range(96)]) # Presence from 8h to 20h
+
+    assert PMH.update_new_data(now=friday + 23*3600) == [5], 'Only Friday received measures'
+    assert PMH.presence_histogram[5][56] == 1 and PMH.presence_histogram[5][10] == 0
+    assert PMH.get_probability_curve([14*3600], day=5)[0] > 0.5 and PMH.get_probability_curve([3*3600], day=5)[0] < 0.5
+    assert all(PMH.list_of_probability_model[day].get_constants() == [0]*6 for day in range(7) if day != 5)
+    assert PMH.update_new_data(now=friday + 25*3600) == [5, 6]
+    print('Probability table and refit of the new days checked.')
+
+
+def bench_presence_fit(n_runs=20):
+    """
+    compares the fit of the 7 weekday models with the normal equations built 
+    by python loops over the raw seconds (previous update_probality_model) 
+    and with fit_presence_polynomials: fit time and residual error (RMS 
+    between the measured presence ratios and the fitted polynomial).
+    """
+    rng = np.random.RandomState(0)
+    t = np.arange(96) * 15*60
+    histogram = []
+    for day in range(7): # presence from ~7h to ~9h and from ~18h to ~23h, noisy
+        ratios = ((t > (7 + rng.uniform(-1, 1))*3600) & (t < 9*3600)) | ((t > 18*3600) & (t < (23 + rng.uniform(-1, 1))*3600))
+        histogram.append(list(np.clip(ratios + rng.normal(0, 0.1, 96), 0, 1)))
+
+    def normal_equations_fit(ratios):
+        A = [[sum(float(elem)**(10-i-j) for elem in t) for j in range(6)] for i in range(6)]
+        b = [sum(ratios[k]*float(elem)**(5-i) for k, elem in enumerate(t)) for i in range(6)]
+        return linear_equation_solver(A, b)
+
+    def rms(coefs):
+        return np.sqrt(np.mean([(np.polyval(c, t) - np.array(day))**2 for c, day in zip(coefs, histogram)]))
+
+    start = time.perf_counter()
+    for run in range(n_runs):
+        loop_coefs = [normal_equations_fit(day) for day in histogram]
+    t_loop = (time.perf_counter() - start) / n_runs
+
+    start = time.perf_counter()
+    for run in range(n_runs):
+        vect_coefs = fit_presence_polynomials(histogram)
+    t_vect = (time.perf_counter() - start) / n_runs
+
+    print("7 days fit, python loops + normal equations : %.2f ms, residual RMS %.4f" % (t_loop*1e3, rms(loop_coefs)))
+    print("7 days fit, vectorised least-squares        : %.2f ms, residual RMS %.4f" % (t_vect*1e3, rms(vect_coefs)))
+    return t_loop, t_vect
+
+
 if __name__ == '__main__':
     BASIC_DEVICE_TYPES =  {
                             'presence_test':[{'measure_name':'presence', 
@@ -224,15 +389,18 @@ if __name__ == '__main__':
 
 
     logging.basicConfig(level=getattr(logging, 'WARNING', None))
+    test_probability_table()
+    bench_presence_fit()
+
     #TDB = create_test_db() # Return a ThermoDB with a model of presence
     TDB = ThermoDB('pres_data0.db', BASIC_DEVICE_TYPES)
 
-    PMH = ProbabilityModelHandler(TDB.query_handler)
-    PMH.update_probality_model()
+    PMH = ProbabilityModelHandler(TDB.query_handler, 'presence_dev_1')
+    PMH.update_probability_model()
 
     #print(PMH.get_probability(300))
 
-    y = [PMH.get_probability(t) for t in PMH.time_vector_continuous]
+    y = PMH.get_probability_curve(PMH.time_vector_continuous)
 
     #plt.plot(PMH.time_vector_continuous, y)
     #plt.show()
@@ -7,19 +7,22 @@ __version__ = '1.3'
 __author__ = 'Sercu Stéphane'
 
 
-from http.server import HTTPServer
 import json                             
+import contextlib
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import time
 import logging
 
 from Utils import Utils as u                       # Includes RepeatingTimer and RequestRouter
-from .Data import ThermoDB
+from .Data import ThermoDB, MeasureWriter
 import xml.etree.ElementTree as ET      # For cfg file parsing purpose
 
 from .Pid import PID
 from .ThermoModels import ProbabilityModelHandler
+from .AsyncTransport import AsyncTransport
+from .Polling import AdaptivePollingScheduler, DeviceHealthTracker, is_present
 
 
 class ThermoConfig(dict):
@@ -30,6 +33,16 @@ class ThermoConfig(dict):
             - db_name
             - period
             - device_types
+            - polling_periods : polling period range of each device type {device_type:{'min_period', 'max_period', 'variance_threshold', 'variance_thresholds'}},
+                from the min_period, max_period and variance_threshold elements of the device types and from the variance_threshold 
+                elements of their sensors (see AdaptivePollingScheduler)
+            - polling_workers : maximum number of devices polled at the same time
+            - transport : 'threads' (blocking requests in the polling threads) or 
+                'async' (all the requests on one asyncio event loop, see AsyncTransport)
+            - request_gap : minimal time (in sec.) between 2 requests sent to a same device
+            - http_workers : maximum number of http requests (ex: registrations) handled at the same time
+            - valve_deadband : minimal change of a valve value (in %) to send it to the device
+            - valve_refresh : maximal time (in sec.) between 2 actuations of a same valve, even if its value doesn't change
     """
 
     BASIC_DEVICE_TYPES = {
@@ -53,7 +66,17 @@ class ThermoConfig(dict):
         'port':8080,
         'period':25,
         'db_name':'data.sqlite3',
-        'device_types':BASIC_DEVICE_TYPES
+        'device_types':BASIC_DEVICE_TYPES,
+        'polling_periods':{},
+        'polling_workers':4,
+        'transport':'threads',
+        'request_gap':1.0,
+        'http_workers':8,
+        'valve_deadband':0.0,
+        'valve_refresh':300,
+        'max_backoff':600,
+        'flush_interval':1.0,
+        'write_queue_size':1000
     }
 
 
@@ -63,6 +86,7 @@ class ThermoConfig(dict):
         """
         super(ThermoConfig, self).__init__()
         self.file_path = cfg_file_path
+        self.update(self.DEFAULT_VALUES) # Kept if the file can't be parsed
         self.refresh()
 
     def refresh(self):
@@ -76,6 +100,16 @@ class ThermoConfig(dict):
             self['db_name'] = self._parse_db_name(root)
             self['period'] = self._parse_period(root)
             self['device_types'] = self._parse_device_types(root)
+            self['polling_periods'] = self._parse_polling_periods(root)
+            self['polling_workers'] = self._parse_option(root, 'polling_workers', int)
+            self['transport'] = self._parse_option(root, 'transport', str)
+            self['request_gap'] = self._parse_option(root, 'request_gap', float)
+            self['http_workers'] = self._parse_option(root, 'http_workers', int)
+            self['valve_deadband'] = self._parse_option(root, 'valve_deadband', float)
+            self['valve_refresh'] = self._parse_option(root, 'valve_refresh', float)
+            self['max_backoff'] = self._parse_option(root, 'max_backoff', float)
+            self['flush_interval'] = self._parse_option(root, 'flush_interval', float)
+            self['write_queue_size'] = self._parse_option(root, 'write_queue_size', int)
 
         except FileNotFoundError:
             logging.warning("The specified configuration file doesn't exist, default configuration will be applied.")
@@ -114,6 +148,20 @@ class ThermoConfig(dict):
         finally:
             return rtn
 
+    def _parse_option(self, xml_root, option_name, cast=str):
+        """
+            Finds and returns an option (casted with cast) in the config file.
+            The default value is returned if the option isn't found or isn't valid.
+        """
+        rtn = self.DEFAULT_VALUES[option_name]
+        try:
+            rtn = cast(xml_root.find(option_name).text)
+            logging.debug('%s found in the configutation file : %s\n' % (option_name, str(rtn)))
+        except Exception as ex:
+            logging.warning('No valid %s was found in the cfg file. Default value (%s) will be used.' % (option_name, str(rtn)))
+        finally:
+            return rtn
+
     def _parse_device_types(self, xml_root):
         rtn = self.DEFAULT_VALUES['device_types']
         try:
@@ -147,6 +195,27 @@ class ThermoConfig(dict):
         finally:
             return rtn
 
+    def _parse_polling_periods(self, xml_root):
+        """
+            Finds the polling periods of each device type. 
+            The period range of a device type without min_period is the period option.
+            A sensor can have its own variance_threshold.
+        """
+        rtn = {}
+        for device in xml_root.findall('./device_types/device'):
+            try:
+                if device.find('min_period') != None:
+                    min_period = float(device.find('min_period').text)
+                    max_period = float(device.find('max_period').text) if device.find('max_period') != None else min_period
+                    variance_threshold = float(device.find('variance_threshold').text) if device.find('variance_threshold') != None else 0
+                    variance_thresholds = {sensor.find('measure_name').text: float(sensor.find('variance_threshold').text) 
+                                            for sensor in device.findall('sensor') if sensor.find('variance_threshold') != None}
+                    rtn[device.find('device_name').text] = {'min_period':min_period, 'max_period':max(min_period, max_period), 
+                                                            'variance_threshold':variance_threshold, 'variance_thresholds':variance_thresholds}
+            except Exception as ex:
+                logging.warning('Invalid polling periods in the cfg file, the device type will be polled at the default period : %s' % str(ex))
+        return rtn
+
     def sensor_constructor(self, xml_sensor, *args):
         """
             Returns a sensor constructor based on xml configuration.
@@ -186,21 +255,70 @@ class ThermoServer:
         # self.database_name = 'data.sqlite3'
         # self.remote_device_types = self.BASIC_DEVICE_TYPES
 
-        self.devices = []
+        self.devices = DeviceRegistry()
 
         self.database = ThermoDB(self.cfg['db_name'], self.cfg['device_types']) # TODO: private?
         self.db_query_handler = self.database.query_handler
+        # A new device must not get the name (and the measures) of a device saved in the database
+        self.devices.reserve(self.database.query_handler.get_device_names())
+        # The measures are saved by a writer thread: the polling never waits for the database
+        self.measure_writer = MeasureWriter(self.database.query_handler, self.cfg['write_queue_size'], self.cfg['flush_interval'])
 
 
         self._req_handler_thread = threading.Thread() # This thread will handle the registration requests
         self._http_server = None # 
 
-        self._data_getter_thread = u.RepeatingTimer(self.cfg['period'], self.magic_function) # This thread tetrieve data from devices, save the and update valves
+        self.polling_scheduler = AdaptivePollingScheduler(self.cfg['polling_periods'], self.cfg['period'])
+        # The devices that don't answer anymore are polled with an exponential back-off
+        self.device_health = DeviceHealthTracker(self.cfg['max_backoff'])
+        # This thread tetrieve data from devices, save the and update valves. A late polling cycle coalesces the missed ones.
+        self._data_getter_thread = u.RepeatingTimer(self.polling_scheduler.tick_period(), self.magic_function, on_overrun=u.RepeatingTimer.COALESCE)
         
         self._data_analysis_thread = u.RepeatingTimer(24*3600, self.data_analyse)
 
+        # Serialises and spaces the requests sent to a same device
+        self.request_scheduler = u.RequestScheduler(self.cfg['request_gap'])
+        # Adaptive timeout and circuit breaker of each endpoint of the devices
+        self.endpoint_monitor = u.EndpointMonitor(max_timeout=Sensor.TIMEOUT[1])
+
+        # The devices are polled concurrently (the sensors of a same device are still polled one after another)
+        self._polling_pool = ThreadPoolExecutor(max_workers=self.cfg['polling_workers'])
+        self._async_transport = None
+        if self.cfg['transport'] == 'async':
+            self._async_transport = AsyncTransport(scheduler=self.request_scheduler) # The async and blocking requests to a device never overlap
+        elif self.cfg['transport'] != 'threads':
+            logging.warning("Unknown transport '%s', 'threads' will be used." % self.cfg['transport'])
+        self.last_cycle_time = None # Duration (in sec.) of the last polling of all the devices
+        self.actuation_filter = ActuationFilter(self.cfg['valve_deadband'], self.cfg['valve_refresh'])
+
 
         self.thin_presence_predictors = {}
+        self.time_operator = u.TimeOperator(self.database.query_handler) # Age of the devices, for the presence predictions
+        self.thin_thermal_properties = {}
+
+        # The devices only register when they start: the ones known before a restart are rebuilt from the database
+        self.restore_devices()
+
+    def restore_devices(self):
+        """
+            Rebuilds the devices saved in the database with their type and port and adds them 
+            to the connected devices, so that they're polled from the first polling cycle.
+            Returns the number of restored devices.
+        """
+        n_restored = 0
+        for row in self.database.query_handler.get_registered_devices():
+            if row['name'] in self.devices or self.devices.get_by_address(row['ip'], row['port']) is not None:
+                continue
+            device = self._build_device_of_type(row['type'], row['ip'], row['port'], row['name'])
+            if device is not None:
+                # Checked by its first poll: a device without bulk endpoint falls back to its sensors (see get_bulk_measures)
+                device.bulk_measures = True
+                self.devices.add(device)
+                n_restored += 1
+
+        if n_restored:
+            logging.info('%d device(s) restored from the database.' % n_restored)
+        return n_restored
 
     def data_analyse(self):
         """
@@ -208,10 +326,10 @@ class ThermoServer:
         """
         # Update Presence model constant
         for thin, presence_predictor in self.thin_presence_predictors.items():
-            presence_predictor.update_probability_model()
+            presence_predictor.update_new_data() # Only the days with new measures are fitted again
 
         # Update Thermal Properties
-        for thin, thermal_property_model in self.thin_thermal_properties:
+        for thin, thermal_property_model in self.thin_thermal_properties.items():
             thermal_property_model.update()
 
 
@@ -234,16 +352,41 @@ class ThermoServer:
         """
         server_address = ('', self.cfg['port'])
 
-        # Every supported requested, sorted by type, must be associated to a callback here
-        routes = {'PUT':{'/register':self.register_new_device}}
+        # Every supported requested, sorted by type, must be associated to a callback here (compiled once for all the connections)
+        routes = u.RoutingTable({'PUT':{'/register':self.register_new_device},
+                                    'GET':{'/devices':self.get_devices_api, 
+                                            '/devices/<name>/measures':self.get_device_measures_api}})
 
         handler_class = lambda *args: u.RequestRouter(routes, *args)
         
-        self._http_server = HTTPServer(server_address, handler_class)
+        self._http_server = u.PooledHTTPServer(server_address, handler_class, max_workers=self.cfg['http_workers'])
 
         self._http_server.serve_forever() # This blocks the execution line, the eventual following code will be executed after the request handling process stop
 
 
+    def get_devices_api(self, request_data):
+        """
+            Callback of GET /devices: returns the list of the connected devices [{name, type, ip, port}, ...] (json).
+        """
+        return 200, [{'name':d.name, 'type':d.type, 'ip':d.ip, 'port':d.port} for d in self.devices]
+
+    def get_device_measures_api(self, request_data):
+        """
+            Callback of GET /devices/<name>/measures[?since=date][&limit=n]: 
+            streams the measures of a device (json array, the most recent first).
+            since (timestamp) and limit (number of measures) are optional.
+        """
+        try:
+            since = float(request_data['query'].get('since', 0))
+            limit = int(request_data['query'].get('limit', -1))
+        except ValueError:
+            return 400 # Bad request
+
+        measures = self.database.query_handler.iter_measures_of_device(request_data['params']['name'], since, limit)
+        if measures is None:
+            return 404 # Not found
+        return 200, measures
+
     def register_new_device(self, request_data):
         """
             Callback function who registers a new device from request data.
@@ -263,16 +406,27 @@ class ThermoServer:
                 device_type = json_content['type']
                 device_ip = json_content['ip']
                 device_port = json_content['port']
-                device_name = 'device' + str(len(self.devices))
                 print('Registering...')
-                d = self._build_device_of_type(device_type, device_ip, device_port, device_name)
+                # A device already saved at this address keeps its name (and its measures)
+                known_name = self.database.query_handler.get_device_name_at(device_ip, device_port)
+                d, created = self.devices.register(device_type, device_ip, device_port, 
+                                                    lambda name: self._build_device_of_type(device_type, device_ip, device_port, name),
+                                                    known_name)
                 
                 if d != None:
-                    self.devices.append(d)
+                    # A device registers when it (re)starts: its valve values are lost
+                    self.device_health.reset(d.name)
+                    self.actuation_filter.forget(d.ip, d.port)
+
+                if d != None and not created:
+                    logging.info('Device \'%s\' (%s:%s) was already registered.', d.name, str(d.ip), str(d.port))
+                elif d != None:
+                    # Not awaited: the device may not be able to answer before its registration is acknowledged
+                    self._polling_pool.submit(d.detect_bulk_endpoint)
 
                     cols = {sens.measure_name: sens.measure_type for sens in d.sensors}
 
-                    self.database.query_handler.register_device(d.name, d.ip)
+                    self.database.query_handler.register_device(d.name, d.ip, d.type, d.port)
                     logging.info('Device \'%s\'created and added in database', d.name)
                 else:
                     logging.warning('Device creation failed.')
@@ -290,40 +444,56 @@ class ThermoServer:
 
         
     def get_device_by_name(self, name):
-        # TODO: maybe store RemoteDevices in a dictionnary {str_name:RemoteDevice}?
-        # TODO: what if 2 samely named RemoteDevices?
         """
-            Returns the first connected device matching the specified name.
+            Returns the connected device with the specified name.
             Return None of no device matched.
         """
-        match = None
-        for device in self.devices:
-            if device.name == name:
-                match = device
-                break
-        return match
+        return self.devices.get_by_name(name)
 
 
-    def get_devices_measures(self):
+    def get_devices_measures(self, devices=None):
         """
             Returns a dictionnary of dictionnaries containing the measures of each sensors (for each device). 
             Each measure is associated to his name, and each set of measures is associated to the name of the device they belong.
             Ex of return value : {'device0':{'temperature':20, 'presence':True, 'valve':80}, 'device2':{'Temperature':20}}
+            devices (optional) is the list of the devices to poll, all the devices by default.
         """
-        devices_measures = {} #TODO : detect the not connected devices and remove them from the list.
-        for device in self.devices:
-            logging.debug("Fetching measures for %s." % device.name)
-            devices_measures[device.name] = device.get_measures()
+        devices_measures = {} # The devices that don't answer are skipped by magic_function, see DeviceHealthTracker
+        start = time.monotonic()
+
+        devices = list(self.devices if devices is None else devices)
+
+        if self._async_transport:
+            devices_measures = self._async_transport.poll(devices)
+
+        else:
+            futures = {}
+            for device in devices:
+                logging.debug("Fetching measures for %s." % device.name)
+                futures[device.name] = self._polling_pool.submit(device.get_measures)
+
+            for device_name, future in futures.items():
+                try:
+                    devices_measures[device_name] = future.result()
+                except Exception as ex:
+                    logging.error("Measures of %s couldn't be fetched : %s" % (device_name, str(ex)))
+
+        self.last_cycle_time = time.monotonic() - start
+        tick_period = self.polling_scheduler.tick_period() # Period of the polling cycles
+        if self.last_cycle_time > tick_period:
+            logging.warning("Polling of %d devices took %.2f sec. (period: %s sec.)" % (len(devices), self.last_cycle_time, str(tick_period)))
+        else:
+            logging.debug("Polling of %d devices took %.2f sec." % (len(devices), self.last_cycle_time))
 
         return devices_measures
 
     def save_devices_measures(self):
         """
-            Get all the measures of each connected device and store them in the database.
+            Get all the measures of each connected device and queue them to be stored in the database (see MeasureWriter).
         """
         devices_measures = self.get_devices_measures()
         logging.debug('Saving all measures : ' + str(devices_measures))
-        self.database.query_handler.save_measure_of_all_devices(devices_measures)
+        self.measure_writer.put(devices_measures)
 
     # def update_valves(self):
     #     """
@@ -340,51 +510,81 @@ class ThermoServer:
 
     def magic_function(self):
         """
-            Collects measures, save them, and update valves.
+            Collects measures of the devices that must be polled (see AdaptivePollingScheduler) and 
+            that answer (see DeviceHealthTracker), save them, and update valves.
         """
-        devices_measures = {}
+        due_devices = self.device_health.available_devices(self.polling_scheduler.due_devices(list(self.devices)))
+        if not due_devices:
+            return
+
+        devices_measures = self.get_devices_measures(due_devices)
+        unreachable = set()
+        for device in due_devices:
+            state = self.device_health.record(device, devices_measures.get(device.name), 
+                                                self.polling_scheduler.get_settings(device.type)['min_period'])
+            if state != DeviceHealthTracker.ALIVE:
+                unreachable.add(device.name)
+            if device.name in devices_measures:
+                self.polling_scheduler.record(device, devices_measures[device.name])
+                self.actuation_filter.check_measures(device, devices_measures[device.name])
+
         target_temp = 20.0
         fallback_temp = 15.0
+        actuations = [] # (valve, valve_percent)
 
-        for device in self.devices:
-            logging.debug("Fetching measures for %s." % device.name)
-            devices_measures[device.name] = device.get_measures()
-
-            if device.type == 'thin':# TODO: maybe a way to generalise 'thin' to 'any device that have an interactiveSensor that have to be PID controlled'
+        for device in self.devices.get_by_type('thin'):
+            if device.name in devices_measures and device.name not in unreachable:# TODO: maybe a way to generalise 'thin' to 'any device that have an interactiveSensor that have to be PID controlled'
                 valve = device.get_sensors_by_name('valve')
                 #if valve.pid.set_point != target_temp:
                 #    valve.pid.setPoint(target_temp)
 
                 try:
-                    
+                    measures = devices_measures[device.name]
+                    target = fallback_temp
 
-                    if devices_measures[device.name]['presence']: # If presence...
-                        valve.pid.update(devices_measures[device.name]) # Reactive
-                        #devices_measures[['target_temp'] = target_temp
-                    elif u.TimeOperator.get_number_of_days_since_thermostat_launch() >= 8:    #the code will a wait whole week before becoming predicitive
+                    if is_present(measures['presence']): # The devices send 'true' or 'false'
+                        target = measures['target_temp'] # Reactive
+                    elif self.time_operator.get_number_of_days_since_device_launch(device.name) >= 8:    #the code will a wait whole week before becoming predicitive
                         t = u.TimeOperator.get_elapsed_seconds_since_midnight()
                         delta_t = valve.pid.get_heating_time()
-                        if not device_name in self.thin_presence_predictors:
-                            self.thin_presence_predictors[device.name] = ProbabilityModelHandler(self.database.query_handler)
-                            # TODO: probability model never  updated...
+                        if not device.name in self.thin_presence_predictors:
+                            self.thin_presence_predictors[device.name] = ProbabilityModelHandler(self.database.query_handler, device.name)
+                            self.thin_presence_predictors[device.name].update_probability_model() # Then updated by data_analyse
                         if self.thin_presence_predictors[device.name].get_probability(t + delta_t) >= 0.5:#self.trigger_value
-                            valve.pid.update(devices_measures[device.name])
-
-                    else:
-                        valve.pid.update(fallback_temp)      
+                            target = measures['target_temp'] # Predictive: heated before the presence
 
                     #current_valve = int(devices_measures[device.name]['valve']) # TODO: the rturned value can be None, cast will produce unwanted results
                     #pid_regulation = int(valve.pid.update(float(devices_measures[device.name]['temperature']))) # TODO: (float casting) What if the value returned by the remoteDevice isn't a numeric value?
-                    valve_percent =  valve.pid.update(devices_measures[device.name])
+                    valve_percent =  valve.pid.update(dict(measures, target_temp=target))
 
-                    valve.set_option(valve_percent)
-
-                    logging.info("Valve update for device '%s'"%device.name)
+                    actuations.append((valve, valve_percent))
                 except Exception as e:
                     logging.error("An exception during the valve actuation: \n" + str(e))
 
+        self.set_options(actuations)
+
         logging.debug('Saving all measures : ' + str(devices_measures))
-        self.database.query_handler.save_measure_of_all_devices(devices_measures)
+        if devices_measures:
+            self.measure_writer.put(devices_measures)
+
+    
+    def set_options(self, actuations, force=False):
+        """
+            Sends new values to InteractiveSensors.
+            actuations is a list of tuples (sensor, value).
+            The values that don't differ enough from the last acknowledged ones aren't sent (see ActuationFilter), 
+            unless force (ex: manual actuation). The values sent are acknowledged in both cases.
+        """
+        actuations = self.actuation_filter.filter(actuations, force)
+
+        if self._async_transport:
+            statuses = self._async_transport.set_options(actuations)
+        else:
+            statuses = [sensor.set_option(value) for sensor, value in actuations]
+
+        for (sensor, value), status in zip(actuations, statuses):
+            self.actuation_filter.acknowledge(sensor, value, status)
+            logging.info("%s update for device on %s : %s (status: %s)" % (sensor.measure_name, sensor.ip, str(value), str(status)))
 
     
     def status(self):
@@ -392,12 +592,26 @@ class ThermoServer:
             Returns a dictionnary with those keys : 
                 - req_handling : True or False, indicating if the server is handling requests
                 - connected_devices : int, number of connected devices
+                - last_cycle_time : duration (in sec.) of the last polling of all the devices
+                - request_queues : metrics of the requests sent to each device (queue depth, waiting times), see RequestScheduler
+                - actuations : number of valve values sent and avoided, see ActuationFilter
+                - data_getting_timer : calls, overruns and durations of the polling cycles, see RepeatingTimer.get_metrics
+                - polling_periods : current polling period of each device, see AdaptivePollingScheduler
+                - device_health : state (suspect or dead) and failed polls of the devices that don't answer, see DeviceHealthTracker
+                - endpoints : latencies, timeout and circuit breaker state of each endpoint of the devices, see EndpointMonitor
+                - measure_writer : queue depth, dropped cycles and flushes of the measures waiting to be saved, see MeasureWriter
         """
         req_handling = self._req_handler_thread.is_alive() # As long as the thread is running, the requests handling is operative
         data_getting = self._data_getter_thread.is_alive() 
         connected_devices = len(self.devices)
 
-        status = {'req_handling':req_handling, 'data_getting':data_getting, 'connected_devices':connected_devices}
+        status = {'req_handling':req_handling, 'data_getting':data_getting, 'connected_devices':connected_devices, 
+                    'last_cycle_time':self.last_cycle_time, 'request_queues':self.request_scheduler.get_metrics(),
+                    'actuations':self.actuation_filter.get_metrics(), 'polling_periods':self.polling_scheduler.get_periods(),
+                    'device_health':self.device_health.get_states(),
+                    'endpoints':self.endpoint_monitor.get_metrics(),
+                    'measure_writer':self.measure_writer.get_metrics(),
+                    'data_getting_timer':self._data_getter_thread.get_metrics()}
         return status
 
     def run(self, req_handling=True, data_getting=True):
@@ -420,21 +634,38 @@ class ThermoServer:
             logging.warning("Requests handling is already running.")
 
     def start_data_getting(self):
+        if not self.measure_writer.is_alive():
+            self.measure_writer.start()
+
         if not self.status()['data_getting']:
-            self._data_getter_thread = u.RepeatingTimer(self.cfg['period'], self.magic_function)
+            self._data_getter_thread = u.RepeatingTimer(self.polling_scheduler.tick_period(), self.magic_function, on_overrun=u.RepeatingTimer.COALESCE)
             self._data_getter_thread.start()
             logging.info("Periodic data fetching & saving started.")
         else:
             logging.warning("Periodic ata fetching and saving is already running.")
 
+        if not self._data_analysis_thread.is_alive():
+            self._data_analysis_thread = u.RepeatingTimer(24*3600, self.data_analyse)
+            self._data_analysis_thread.start()
+            logging.info("Daily data analysis started.")
+
 
     def stop(self):
         """
-            Stops the requests handling process.
-            The associated thread will end automatically.
+            Stops the requests handling process and the data getting and analysis timers.
+            The associated threads will end automatically, once the queued measures are saved.
         """
-        self._http_server.shutdown()
-        self._data_getter_thread.stop()
+        if self._http_server:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+        self._data_getter_thread.stop(wait=True) # The current polling cycle ends before the devices are closed
+        self._data_analysis_thread.stop()
+        self.measure_writer.stop() # Saves the queued measures
+        self._polling_pool.shutdown(wait=False)
+        for device in self.devices:
+            device.close()
+        if self._async_transport:
+            self._async_transport.close()
 
 
     def _build_device_of_type(self, d_type, ip, port, name):
@@ -450,7 +681,7 @@ class ThermoServer:
                 sensors.append(obj)
             #sensors = [s['constructor'](ip, port) for s in self.remote_device_types[d_type]]
             
-            device = RemoteDevice(sensors, ip, port, name, d_type)
+            device = RemoteDevice(sensors, ip, port, name, d_type, self.request_scheduler, self.endpoint_monitor)
             logging.info('Device \'%s\' of type %s created (ip: %s, port: %s)' % (device.name, d_type, device.ip, device.port))
         else:
             logging.warning('Device type not supported : %s' % d_type)
@@ -458,17 +689,345 @@ class ThermoServer:
         return device
 
 
+class DeviceRegistry:
+    """
+        Thread-safe registry of the connected RemoteDevices, indexed by name, by address (ip, port) and by type.
+        A device registering again at the same address (with the same type) isn't duplicated.
+        Iterating over the registry gives a snapshot of the devices, in their registration order.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_name = {} # {name:device}
+        self._by_address = {} # {(ip, port):device}
+        self._by_type = {} # {type:{name:device}}
+        self._next_index = 0 # The names of the removed devices are never reused
+        self._reserved = set() # Names that aren't given to new devices (see reserve)
+
+    @staticmethod
+    def _address(ip, port):
+        return (str(ip), str(port))
+
+    def register(self, device_type, ip, port, factory, name=None):
+        """
+            Returns (device, created).
+            If a device of this type is already registered at (ip, port), it's returned (created is False).
+            Otherwise factory(name) builds the new device (or returns None if it fails), named name 
+            (ex: the name saved for this address) if it's not used by another device, 'device<n>' otherwise. 
+            A device of another type at the same address is replaced, and keeps its name.
+        """
+        with self._lock:
+            device = self._by_address.get(self._address(ip, port))
+            if device is not None and device.type == device_type:
+                return device, False
+
+            if device is not None:
+                name = device.name
+                self.remove(name)
+            elif name is None or name in self._by_name:
+                name = self._new_name()
+
+            device = factory(name)
+            if device is not None:
+                self.add(device)
+            return device, device is not None
+
+    def reserve(self, names):
+        """
+            Prevents the names (ex: the ones saved in the database) from being given to new devices.
+        """
+        with self._lock:
+            self._reserved.update(names)
+
+    def _new_name(self):
+        name = 'device' + str(self._next_index)
+        while name in self._by_name or name in self._reserved:
+            self._next_index += 1
+            name = 'device' + str(self._next_index)
+        self._next_index += 1
+        return name
+
+    def add(self, device):
+        """
+            Adds a device (replaces the device with the same name, if any).
+        """
+        with self._lock:
+            if device.name in self._by_name:
+                self.remove(device.name)
+            self._by_name[device.name] = device
+            self._by_address[self._address(device.ip, device.port)] = device
+            self._by_type.setdefault(device.type, {})[device.name] = device
+
+    def remove(self, name):
+        """
+            Removes and returns the device with the specified name (None if it isn't registered).
+            Its connections are closed.
+        """
+        with self._lock:
+            device = self._by_name.pop(name, None)
+            if device is not None:
+                self._by_address.pop(self._address(device.ip, device.port), None)
+                self._by_type.get(device.type, {}).pop(name, None)
+                device.close()
+            return device
+
+    def get_by_name(self, name):
+        return self._by_name.get(name)
+
+    def get_by_address(self, ip, port):
+        return self._by_address.get(self._address(ip, port))
+
+    def get_by_type(self, device_type):
+        """
+            Returns the list of the devices of a type.
+        """
+        with self._lock:
+            return list(self._by_type.get(device_type, {}).values())
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_name.values()))
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+
+class ActuationFilter:
+    """
+        Keeps the last value acknowledged by each InteractiveSensor (ex: valve) 
+        to avoid sending a value that doesn't differ from it by more than a deadband.
+        The value is sent anyway if the last acknowledgement is older than refresh_period 
+        (ex: the device rebooted and lost its value).
+        The acknowledgements of a device are dropped when it registers again (forget) or when 
+        the value it reports differs from the acknowledged one (check_measures).
+    """
+
+    READBACK_TOLERANCE = 1 # The device can round the value it reports
+
+    def __init__(self, deadband=0, refresh_period=300):
+        """
+            deadband: a numeric value is sent if it differs from the acknowledged one by more than deadband
+            refresh_period: time (in sec.) after which a value is sent even if it's in the deadband
+        """
+        self.deadband = deadband
+        self.refresh_period = refresh_period
+        self._acknowledged = {} # {(ip, port, measure_name):(value, monotonic time)}
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.avoided = 0
+
+    @staticmethod
+    def _key(sensor):
+        return (str(sensor.ip), str(sensor.port), sensor.measure_name)
+
+    def needs_update(self, sensor, value):
+        """
+            Returns True if the value must be sent to the sensor.
+        """
+        with self._lock:
+            last = self._acknowledged.get(self._key(sensor))
+        if last is None or time.monotonic() - last[1] >= self.refresh_period:
+            return True
+        try:
+            return abs(float(value) - float(last[0])) > self.deadband
+        except (TypeError, ValueError):
+            return value != last[0]
+
+    def filter(self, actuations, force=False):
+        """
+            Returns the actuations (list of tuples (sensor, value)) that must be sent.
+            If force (ex: manual actuation), they are all sent.
+        """
+        to_send = [(sensor, value) for sensor, value in actuations if force or self.needs_update(sensor, value)]
+        with self._lock:
+            self.sent += len(to_send)
+            self.avoided += len(actuations) - len(to_send)
+        return to_send
+
+    def acknowledge(self, sensor, value, status):
+        """
+            Records the value sent to a sensor if the device accepted it (status 200).
+        """
+        if status == 200:
+            with self._lock:
+                self._acknowledged[self._key(sensor)] = (value, time.monotonic())
+
+    def forget(self, ip, port):
+        """
+            Drops the acknowledged values of the device at (ip, port) (ex: it rebooted).
+        """
+        with self._lock:
+            for key in [key for key in self._acknowledged if key[:2] == (str(ip), str(port))]:
+                del self._acknowledged[key]
+
+    def check_measures(self, device, measures):
+        """
+            Drops the acknowledged value of each sensor of the device whose polled value 
+            (in measures {measure_name:value}) differs from it by more than the deadband 
+            (or READBACK_TOLERANCE): the value will be sent again.
+        """
+        for sensor in device.sensors:
+            measured = measures.get(sensor.measure_name)
+            key = self._key(sensor)
+            with self._lock:
+                last = self._acknowledged.get(key)
+                if last is None or measured is None:
+                    continue
+                try:
+                    differs = abs(float(measured) - float(last[0])) > max(self.deadband, self.READBACK_TOLERANCE)
+                except (TypeError, ValueError):
+                    differs = str(measured) != str(last[0])
+                if differs:
+                    logging.info("%s of device %s is %s instead of %s, it will be sent again." 
+                                    % (sensor.measure_name, device.name, str(measured), str(last[0])))
+                    del self._acknowledged[key]
+
+    def get_metrics(self):
+        with self._lock:
+            return {'sent':self.sent, 'avoided':self.avoided}
+
+
+@contextlib.contextmanager
+def device_request(ip, port, endpoint=None, scheduler=None, monitor=None):
+    """
+        Context manager that must wrap every request sent to a device. It:
+            - raises u.CircuitOpenError, without waiting, if the endpoint (ex: 'GET /temperature') is tripped,
+            - waits for the request slot of the device (see u.RequestScheduler),
+            - gives the (connection, response) timeouts of the request: the response timeout adapts 
+              to the latencies of the endpoint (and is doubled by each timeout), the latency or the failure 
+              of the request is recorded (see u.EndpointMonitor).
+        Without monitor (or endpoint), Sensor.TIMEOUT is used.
+    """
+    key = (str(ip), str(port), endpoint)
+    if monitor and endpoint:
+        monitor.check(key)
+
+    with scheduler.slot(key[:2]) if scheduler else contextlib.nullcontext():
+        if not (monitor and endpoint):
+            yield Sensor.TIMEOUT
+            return
+
+        start = time.monotonic()
+        try:
+            yield (Sensor.TIMEOUT[0], monitor.timeout(key))
+        except Exception as e:
+            # A request without answer doubles the timeout of the endpoint
+            monitor.record_failure(key, timed_out=isinstance(e, requests.exceptions.ReadTimeout))
+            raise
+        monitor.record_success(key, time.monotonic() - start)
+
+
 class RemoteDevice:
     """
         A remoteDevice is composed by several sensors. 
+        Its sensors share one HTTP session: the connection to the device is kept alive between the requests.
+
+        A device can implement the optional bulk endpoint 'GET /measures', returning a json object 
+        with the values of all its sensors ({"temperature": 20.5, "presence": true, ...}). 
+        It's then polled with one request instead of one request per sensor.
     """
 
-    def __init__(self, sensors, ip, port, name, device_type):
+    MAX_CONNECTIONS = 2 # Maximal number of connections kept open with the device
+    BULK_PATH = 'measures'
+
+    def __init__(self, sensors, ip, port, name, device_type, scheduler=None, monitor=None):
+        """
+            scheduler (optional) is the RequestScheduler used by the sensors to send their requests
+            monitor (optional) is the EndpointMonitor giving the timeouts of the requests
+        """
         self.ip = ip
         self.port = port
         self.name = name
         self.sensors = sensors
         self.type = device_type
+        self.scheduler = scheduler
+        self.monitor = monitor
+        self.bulk_measures = None # True if the device implements the bulk endpoint, None if not detected yet
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_CONNECTIONS, max_retries=0)
+        self.session.mount('http://', adapter)
+
+        for sensor in self.sensors:
+            sensor.scheduler = scheduler
+            sensor.monitor = monitor
+            sensor.session = self.session
+
+    def close(self):
+        """
+            Closes the connections kept open with the device.
+        """
+        self.session.close()
+
+    def request_slot(self, endpoint=None):
+        """
+            Context manager that must wrap every request sent to the device, gives its timeout (see device_request).
+        """
+        return device_request(self.ip, self.port, endpoint, self.scheduler, self.monitor)
+
+    def bulk_url(self):
+        return 'http://' + str(self.ip) + ':' + str(self.port) + '/' + self.BULK_PATH
+
+    def detect_bulk_endpoint(self):
+        """
+            Checks if the device implements the bulk endpoint, and sets bulk_measures accordingly.
+            Returns bulk_measures.
+        """
+        try:
+            with self.request_slot('GET /' + self.BULK_PATH) as timeout:
+                response = self.session.get(self.bulk_url(), timeout=timeout)
+            self.bulk_measures = response.status_code == 200 and self.parse_bulk_measures(response.text) != None
+        except (requests.exceptions.RequestException, u.CircuitOpenError) as e:
+            logging.warning("Bulk endpoint of device %s can't be checked, its sensors will be polled one by one : %s" % (self.name, str(e)))
+            self.bulk_measures = False
+
+        logging.info('Device %s is polled %s.' % (self.name, 'with the bulk endpoint' if self.bulk_measures else 'sensor by sensor'))
+        return self.bulk_measures
+
+    def parse_bulk_measures(self, text):
+        """
+            Returns the measures of the remote sensors contained in a response of the bulk endpoint 
+            ({measure_name:value}, with the values as the sensors would return them) 
+            or None if the response is not a json object.
+            A value is None if the measure is missing.
+        """
+        try:
+            values = json.loads(text)
+        except ValueError:
+            return None
+        if not isinstance(values, dict):
+            return None
+
+        measures = {}
+        for sensor in self.sensors:
+            if not sensor.is_local:
+                value = values.get(sensor.measure_name)
+                # Same text as the sensor endpoint : 20.5 => '20.5', true => 'true'
+                measures[sensor.measure_name] = value if value is None or isinstance(value, str) else json.dumps(value)
+        return measures
+
+    def get_bulk_measures(self):
+        """
+            Returns the measures of the remote sensors fetched with the bulk endpoint.
+            The measures are None if the request fails.
+            If the device doesn't implement the endpoint anymore, bulk_measures is reset and None is returned.
+        """
+        measures = None
+        try:
+            with self.request_slot('GET /' + self.BULK_PATH) as timeout:
+                response = self.session.get(self.bulk_url(), timeout=timeout)
+            if response.status_code == 200:
+                measures = self.parse_bulk_measures(response.text)
+            if measures is None:
+                logging.warning('Bulk endpoint of device %s returned an unexpected response (%d), its sensors will be polled one by one.' % (self.name, response.status_code))
+                self.bulk_measures = False
+        except (requests.exceptions.RequestException, u.CircuitOpenError) as e:
+            logging.error('Connection with the device %s failed : %s' % (self.name, str(e)))
+            measures = {sensor.measure_name: None for sensor in self.sensors if not sensor.is_local}
+        return measures
 
     def get_measures(self):
         """
@@ -476,9 +1035,15 @@ class RemoteDevice:
             Date is included.
             {date:now, mesaure1:value, ...}
         """
-        measures = {} # TODO: what if the connection is lost?
-        for sensor in self.sensors:
-            measures[sensor.measure_name] = sensor.get_measure()
+        measures = None # TODO: what if the connection is lost?
+        if self.bulk_measures:
+            measures = self.get_bulk_measures()
+
+        if measures is None:
+            measures = {sensor.measure_name: sensor.get_measure() for sensor in self.sensors}
+        else:
+            measures.update({sensor.measure_name: sensor.get_measure() for sensor in self.sensors if sensor.is_local})
+
         measures['date'] = time.time()
         return measures
 
@@ -495,6 +1060,10 @@ class RemoteDevice:
 
 
 class Sensor:
+    is_local = False # The measure is requested to the device
+    is_actuator = False # The measure is a value set by the server (ex: valve), see InteractiveSensor
+    TIMEOUT = (2, 4) # (connection, response) timeouts in sec.
+
     def __init__(self, measure_name, measure_type, ip, port):
         """
             The measure name must be the path on which all the reaquests should be send.
@@ -503,6 +1072,22 @@ class Sensor:
         self.measure_type = measure_type
         self.ip = ip
         self.port = port
+        self.scheduler = None # RequestScheduler spacing the requests sent to the device (set by RemoteDevice)
+        self.monitor = None # EndpointMonitor giving the timeouts of the requests (set by RemoteDevice)
+        self.session = None # requests.Session shared by the sensors of the device (set by RemoteDevice)
+
+    def request_slot(self, endpoint=None):
+        """
+            Context manager that must wrap every request sent to the device, gives its timeout (see device_request).
+        """
+        return device_request(self.ip, self.port, endpoint, self.scheduler, self.monitor)
+
+    def http(self):
+        """
+            Returns the object sending the requests: the device session or, without session, the requests module 
+            (a new connection for each request).
+        """
+        return self.session or requests
 
     def get_measure(self):
         """
@@ -514,21 +1099,24 @@ class Sensor:
             str_req = 'http://' + str(self.ip) + ':' + str(self.port) + '/' + self.measure_name
             logging.debug('Request will be sent to device on %s : %s' % (self.ip, str_req))
             logging.debug('Waiting for device response...')
-            response = requests.get(str_req, timeout=4) 
-            time.sleep(1) # TODO  : that ensures no other requests will be sent directly after this one. Maybe a queue (kind of fifo stack) system for reqeusts would be nice here.
+            with self.request_slot('GET /' + self.measure_name) as timeout: # Ensures no other requests will be sent to the device directly after this one
+                response = self.http().get(str_req, timeout=timeout) 
             measure = response.text
             logging.debug('Device %s response : %s' % (self.ip, measure))
 
+        except u.CircuitOpenError as e:
+            logging.debug(str(e))
         except requests.exceptions.ConnectionError as e:
-            logging.exception('Connection with the device failed : %s' % str(e))
+            logging.warning('Connection with the device on %s failed (%s) : %s' % (self.ip, self.measure_name, str(e)))
         except requests.exceptions.ReadTimeout as e:
-            logging.exception("More than 4 seconds elapsed. We've no time to wait more!!!!")
+            logging.warning("Device on %s didn't answer in time (%s) : %s" % (self.ip, self.measure_name, str(e)))
         except Exception as e:
             logging.exception('An unexcpected exception handled during the data request for measure %s of device %s'%(self.measure_name, self.ip))
         finally:
             return measure
 
 class InteractiveSensor(Sensor):
+    is_actuator = True
 
     def __init__(self, measure_name, measure_type, ip, port):
         
@@ -544,21 +1132,26 @@ class InteractiveSensor(Sensor):
         status = None
         try:
             req_str = 'http://' + str(self.ip) + ':' + str(self.port) + '/' + self.measure_name+'?value='+str(value)
-            response = requests.put(req_str, data=str(value), headers={'content-type':'text/plain'}, timeout=4) 
+            with self.request_slot('PUT /' + self.measure_name) as timeout:
+                response = self.http().put(req_str, data=str(value), headers={'content-type':'text/plain'}, timeout=timeout) 
             status = response.status_code
 
+        except u.CircuitOpenError as e:
+            logging.debug(str(e))
 
         except requests.exceptions.ConnectionError as e:
             logging.error('Connection with the device failed : ' + str(e))
 
         except requests.exceptions.ReadTimeout as e:
-            logging.exception("More than 4 seconds elapsed. We've no time to wait more!!!!")
+            logging.error("Device on %s didn't answer in time (%s) : %s" % (self.ip, self.measure_name, str(e)))
  
         except Exception as e:
             logging.exception('An unexcpected exception handled during the data request for measure %s of device %s'%(self.measure_name, self.ip))
         return status
 
 class LocalSensor(InteractiveSensor):
+    is_local = True # The measure is kept by the server, no request is sent
+
     def __init__(self, measure_name, measure_type, ip, port):
         
         super().__init__(measure_name, measure_type, ip, port)
@@ -570,4 +1163,339 @@ class LocalSensor(InteractiveSensor):
 
     def set_option(self, new_value):
         self.measure_value = new_value
+        return 200
+
+
+
+def bench_session_pooling(n=200, port=9101):
+    """
+        Polls a simulated thin thermostat (Simulators.ThinThermostatServer) n times
+        with a new connection per request (sensors without session) and with the 
+        kept-alive connection of the RemoteDevice session.
+    """
+    from Simulators.ThinThermostatServer import ThinThermostatServer
+
+    simulator = ThinThermostatServer(init_temp=20, port=port)
+    simulator.start()
+    time.sleep(0.5)
+
+    sensor_types = ThermoConfig.BASIC_DEVICE_TYPES['thin']
+    device = RemoteDevice([s['constructor']('localhost', port) for s in sensor_types], 'localhost', port, 'bench', 'thin')
+
+    sessions = [sensor.session for sensor in device.sensors]
+    for sensor in device.sensors:
+        sensor.session = None
+    start = time.perf_counter()
+    for i in range(n):
+        device.get_measures()
+    t_new_conn = (time.perf_counter() - start) / n
+
+    for sensor, session in zip(device.sensors, sessions):
+        sensor.session = session
+    start = time.perf_counter()
+    for i in range(n):
+        device.get_measures()
+    t_session = (time.perf_counter() - start) / n
+
+    device.close()
+    print("Polling of a thin (%d sensors), new connection per request : %.2f ms" % (len(device.sensors), t_new_conn*1e3))
+    print("Polling of a thin (%d sensors), kept-alive session         : %.2f ms" % (len(device.sensors), t_session*1e3))
+    return t_new_conn, t_session
+
+
+def bench_bulk_measures(n=200, port=9102):
+    """
+        Polls a simulated thin thermostat n times with one request per sensor 
+        and with one request to the bulk endpoint (GET /measures).
+    """
+    from Simulators.ThinThermostatServer import ThinThermostatServer
+
+    simulator = ThinThermostatServer(init_temp=20, port=port)
+    simulator.start()
+    time.sleep(0.5)
 
+    sensor_types = ThermoConfig.BASIC_DEVICE_TYPES['thin']
+    device = RemoteDevice([s['constructor']('localhost', port) for s in sensor_types], 'localhost', port, 'bench', 'thin')
+
+    device.bulk_measures = False
+    per_sensor = device.get_measures()
+    start = time.perf_counter()
+    for i in range(n):
+        device.get_measures()
+    t_per_sensor = (time.perf_counter() - start) / n
+
+    assert device.detect_bulk_endpoint(), 'The simulator should implement the bulk endpoint'
+    bulk = device.get_measures()
+    assert {k:v for k, v in bulk.items() if k != 'date'} == {k:v for k, v in per_sensor.items() if k != 'date'}, (bulk, per_sensor)
+    start = time.perf_counter()
+    for i in range(n):
+        device.get_measures()
+    t_bulk = (time.perf_counter() - start) / n
+
+    device.close()
+    print("Polling of a thin (%d sensors), one request per sensor : %.2f ms" % (len(device.sensors), t_per_sensor*1e3))
+    print("Polling of a thin (%d sensors), bulk endpoint          : %.2f ms" % (len(device.sensors), t_bulk*1e3))
+    return t_per_sensor, t_bulk
+
+
+def bench_warm_restart(n_devices=500):
+    """
+        Measures the startup time of a ThermoServer whose database contains n_devices 
+        registered devices (rebuilt by restore_devices) and of a ThermoServer without device.
+    """
+    import os
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    tree = ET.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thermoConfig.cfg'))
+    tree.getroot().find('database_name').text = os.path.join(tmp_dir, 'bench_restart.sqlite3')
+    cfg_path = os.path.join(tmp_dir, 'bench_restart.cfg')
+    tree.write(cfg_path)
+
+    start = time.perf_counter()
+    server = ThermoServer(cfg_path)
+    t_empty = time.perf_counter() - start
+    for i in range(n_devices):
+        server.database.query_handler.register_device('device%d' % i, '10.0.%d.%d' % (i // 250, i % 250 + 1), 
+                                                        'thin' if i % 4 else 'outside', 80)
+    server.stop()
+    server.database.close()
+
+    logging.disable(logging.INFO)
+    start = time.perf_counter()
+    server = ThermoServer(cfg_path)
+    t_restart = time.perf_counter() - start
+    logging.disable(logging.NOTSET)
+
+    assert len(server.devices) == n_devices, len(server.devices)
+    assert len(server.devices.get_by_type('outside')) == n_devices // 4
+    assert server.devices.register('thin', '10.0.0.2', 80, lambda name: None) == (server.devices.get_by_name('device1'), False)
+    server.stop()
+    server.database.close()
+
+    print("Startup without saved device  : %.1f ms" % (t_empty*1e3))
+    print("Startup with %d saved devices : %.1f ms" % (n_devices, t_restart*1e3))
+    return t_empty, t_restart
+
+
+def bench_adaptive_timeouts(n=5, port=9103):
+    """
+        Polls an outside thermometer that stops answering (its requests hang) n times, with the 
+        fixed Sensor.TIMEOUT and with the adaptive timeouts and circuit breaker of an EndpointMonitor 
+        that measured its usual latency first.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    hanging = threading.Event()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            if hanging.wait(0.005): # ~5 ms of latency, or no answer
+                time.sleep(Sensor.TIMEOUT[1] + 1)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write(b'20.5')
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def poll_device(monitor, n_polls):
+        device = RemoteDevice([Sensor('temperature', 'REAL', 'localhost', port)], 'localhost', port, 'bench', 'outside', monitor=monitor)
+        device.bulk_measures = False
+        hanging.clear()
+        for i in range(20):
+            assert device.get_measures()['temperature'] == '20.5'
+        hanging.set()
+        start = time.perf_counter()
+        for i in range(n_polls):
+            assert device.get_measures()['temperature'] is None
+        device.close()
+        return (time.perf_counter() - start) / n_polls
+
+    t_fixed = poll_device(None, 1)
+    monitor = u.EndpointMonitor(max_timeout=Sensor.TIMEOUT[1])
+    t_adaptive = poll_device(monitor, n)
+    metrics = monitor.get_metrics()[('localhost', str(port), 'GET /temperature')]
+    assert metrics['state'] == 'open' and metrics['rejected'] == n - monitor.failure_threshold, metrics
+    server.shutdown()
+    server.server_close()
+
+    print("Poll of a hanging device, fixed timeout                    : %.2f s" % t_fixed)
+    print("Poll of a hanging device, adaptive timeout + breaker (x%d) : %.2f s (timeout %.2f s, p95 latency %.1f ms)" 
+            % (n, t_adaptive, metrics['timeout'], metrics['p95']*1e3))
+    return t_fixed, t_adaptive
+
+
+def test_legacy_registration():
+    print('\n\nTesting the registrations with a database of an older version (devices without type and port)')
+    import os
+    import sqlite3
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'legacy.sqlite3')
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE device ('device_id' INTEGER PRIMARY KEY, 'name' TEXT, 'ip' TEXT);")
+    conn.execute("CREATE TABLE measure ('measure_id' INTEGER PRIMARY KEY, 'date' INTEGER, 'temperature' REAL, \
+                    'device_id' INTEGER, FOREIGN KEY (device_id) REFERENCES device(device_id));")
+    conn.executemany("INSERT INTO device (name, ip) VALUES (?, ?)", [('device0', '127.0.0.2'), ('device1', '127.0.0.3')])
+    conn.executemany("INSERT INTO measure (date, temperature, device_id) VALUES (?, 20, 1)", [(1000 + i,) for i in range(10)])
+    conn.commit()
+    conn.close()
+
+    tree = ET.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thermoConfig.cfg'))
+    tree.getroot().find('database_name').text = db_path
+    cfg_path = os.path.join(tmp_dir, 'legacy.cfg')
+    tree.write(cfg_path)
+
+    server = ThermoServer(cfg_path)
+    assert len(server.devices) == 0, 'The devices without type can\'t be restored'
+    register = lambda ip, port: server.register_new_device({'content':json.dumps({'ip':ip, 'port':port, 'type':'thin'}).encode()})
+
+    assert register('127.0.0.4', 9001) == 200
+    assert server.devices.get_by_address('127.0.0.4', 9001).name == 'device2', 'Names of the database must not be reused'
+    assert register('127.0.0.2', 9001) == 200
+    assert server.devices.get_by_address('127.0.0.2', 9001).name == 'device0', 'A saved device keeps its name'
+    assert register('127.0.0.2', 9002) == 200
+    assert server.devices.get_by_address('127.0.0.2', 9002).name == 'device3'
+
+    QH = server.database.query_handler
+    rows = {d['name']: (d['ip'], d['type'], d['port']) for d in QH.select(['name', 'ip', 'type', 'port'], 'device')}
+    assert rows == {'device0':('127.0.0.2', 'thin', 9001), 'device1':('127.0.0.3', None, None), 
+                    'device2':('127.0.0.4', 'thin', 9001), 'device3':('127.0.0.2', 'thin', 9002)}, rows
+    assert len(list(QH.iter_measures_of_device('device0'))) == 10
+    server.stop()
+    server.database.close()
+
+
+def test_device_registry():
+    print('\n\nTesting the DeviceRegistry class')
+    registry = DeviceRegistry()
+    factory = lambda d_type, ip, port: lambda name: RemoteDevice([], ip, port, name, d_type)
+
+    thin, created = registry.register('thin', '10.0.0.1', 80, factory('thin', '10.0.0.1', 80))
+    assert created and thin.name == 'device0'
+    assert registry.register('thin', '10.0.0.1', '80', factory('thin', '10.0.0.1', 80)) == (thin, False), 'Registered twice'
+    outside, created = registry.register('outside', '10.0.0.2', 80, factory('outside', '10.0.0.2', 80))
+    assert created and outside.name == 'device1' and len(registry) == 2
+    assert registry.get_by_name('device1') is outside and registry.get_by_address('10.0.0.1', 80) is thin
+    assert registry.get_by_type('thin') == [thin] and registry.get_by_type('unknown') == []
+
+    registry.remove('device0')
+    new_thin, created = registry.register('thin', '10.0.0.3', 80, factory('thin', '10.0.0.3', 80))
+    assert new_thin.name == 'device2', 'The name of a removed device must not be reused'
+    replacing, created = registry.register('thin', '10.0.0.2', 80, factory('thin', '10.0.0.2', 80))
+    assert created and replacing.name == 'device1' and registry.get_by_type('outside') == [], 'Type changed at the same address'
+    assert registry.register('thin', '10.0.0.4', 80, lambda name: None) == (None, False)
+    assert [d.name for d in registry] == ['device2', 'device1'] and 'device2' in registry
+
+    registry.reserve(['device3', 'device4'])
+    assert registry.register('thin', '10.0.0.5', 80, factory('thin', '10.0.0.5', 80))[0].name == 'device5', 'Reserved names'
+    assert registry.register('thin', '10.0.0.6', 80, factory('thin', '10.0.0.6', 80), 'device3')[0].name == 'device3', 'Known name'
+    assert registry.register('thin', '10.0.0.7', 80, factory('thin', '10.0.0.7', 80), 'device3')[0].name == 'device6', 'Name in use'
+
+
+def test_actuation_filter():
+    print('\n\nTesting the ActuationFilter class')
+    valve = LocalSensor('valve', 'INTEGER', '127.0.0.1', 9000)
+    other_valve = LocalSensor('valve', 'INTEGER', '127.0.0.2', 9000)
+    act_filter = ActuationFilter(deadband=2, refresh_period=0.2)
+
+    assert act_filter.filter([(valve, 50), (other_valve, 50)]) == [(valve, 50), (other_valve, 50)], 'Nothing acknowledged yet'
+    act_filter.acknowledge(valve, 50, valve.set_option(50))
+    act_filter.acknowledge(other_valve, 50, None) # Failed request
+    assert act_filter.filter([(valve, 51.5), (other_valve, 50)]) == [(other_valve, 50)], 'In the deadband'
+    assert act_filter.filter([(valve, 53)]) == [(valve, 53)], 'Out of the deadband'
+    time.sleep(0.2)
+    assert act_filter.filter([(valve, 50)]) == [(valve, 50)], 'Refresh period elapsed'
+    assert act_filter.get_metrics() == {'sent':5, 'avoided':1}, act_filter.get_metrics()
+
+    device = RemoteDevice([valve], '127.0.0.1', 9000, 'device0', 'thin')
+    act_filter = ActuationFilter(deadband=2, refresh_period=300)
+    act_filter.acknowledge(valve, 50, 200)
+    act_filter.acknowledge(other_valve, 50, 200)
+    act_filter.forget('127.0.0.1', 9000) # Registered again
+    assert act_filter.filter([(valve, 50), (other_valve, 50)]) == [(valve, 50)], 'Device rebooted'
+
+    act_filter.acknowledge(valve, 50, 200)
+    act_filter.check_measures(device, {'valve':'51', 'date':0}) # Rounded by the device
+    assert act_filter.filter([(valve, 50)]) == [], 'Readback in the tolerance'
+    act_filter.check_measures(device, {'valve':'0', 'date':0})
+    assert act_filter.filter([(valve, 50)]) == [(valve, 50)], 'Readback differs from the acknowledged value'
+
+    act_filter.acknowledge(valve, 50, 200)
+    assert act_filter.filter([(valve, 20)], force=True) == [(valve, 20)], 'Manual actuation'
+    act_filter.acknowledge(valve, 20, 200)
+    assert act_filter.filter([(valve, 50)]) == [(valve, 50)], 'The manual value is acknowledged'
+    device.close()
+
+
+def test_predictive_actuation():
+    """
+        Runs magic_function with a thin that reports no presence: once the thin is 8 days old, 
+        its valve follows the predicted presence (get_probability), the fallback temperature before.
+    """
+    print('\n\nTesting the valve actuation of a thin without presence')
+    import os
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    tree = ET.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thermoConfig.cfg'))
+    tree.getroot().find('database_name').text = os.path.join(tmp_dir, 'predictive.sqlite3')
+    cfg_path = os.path.join(tmp_dir, 'predictive.cfg')
+    tree.write(cfg_path)
+    server = ThermoServer(cfg_path)
+
+    device, created = server.devices.register('thin', '127.0.0.2', 9001, lambda name: server._build_device_of_type('thin', '127.0.0.2', 9001, name))
+    valve = device.get_sensors_by_name('valve')
+    measures = {'temperature':18.0, 'presence':'false', 'valve':'0', 'target_temp':21}
+    server.get_devices_measures = lambda devices=None: {device.name: dict(measures, date=time.time())}
+    actuations = []
+    server.set_options = lambda new_actuations, force=False: actuations.extend(new_actuations)
+
+    def cycle(probability):
+        server.polling_scheduler = AdaptivePollingScheduler({}, 3) # The device is due again
+        predictor = server.thin_presence_predictors.get(device.name)
+        calls = []
+        if predictor:
+            predictor.get_probability = lambda t: calls.append(t) or probability
+        del actuations[:]
+        valve.pid = PID()
+        server.magic_function()
+        return calls, actuations[0] if actuations else None
+
+    server.database.query_handler.add_measure({'date':time.time() - 3*86400, 'presence':0}, device.name)
+    assert cycle(1) == ([], (valve, 0)), 'Fallback temperature (15) for a device younger than 8 days'
+    assert device.name not in server.thin_presence_predictors
+
+    server.database.query_handler.add_measure({'date':time.time() - 9*86400, 'presence':0}, device.name)
+    cycle(1) # First cycle of the week old device: its predictor is created
+    assert device.name in server.thin_presence_predictors, 'data_analyse updates the predictors of the thins'
+    calls, actuation = cycle(1)
+    assert len(calls) == 1 and actuation[0] is valve and actuation[1] > 0, 'Presence predicted: the room is preheated'
+    assert 0 <= calls[0] - valve.pid.get_heating_time() < 86400
+    calls, actuation = cycle(0)
+    assert len(calls) == 1 and actuation == (valve, 0), 'No presence predicted: fallback temperature'
+
+    measures['presence'] = 'true'
+    calls, actuation = cycle(0)
+    assert calls == [] and actuation[1] > 0, 'Reactive'
+    server.stop()
+    server.database.close()
+    print('Actuation of the valves with the predicted presence checked.')
+
+
+if __name__ == '__main__':
+    test_device_registry()
+    test_legacy_registration()
+    test_actuation_filter()
+    test_predictive_actuation()
+    bench_session_pooling()
+    bench_bulk_measures()
+    bench_warm_restart()
+    bench_adaptive_timeouts()
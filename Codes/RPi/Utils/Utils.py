@@ -4,7 +4,15 @@
     This module contains some usefull classes for the ThermoServer
 """
 
+import asyncio
+import collections
+import json
+import select
 import threading
+import time
+from urllib.parse import urlsplit, parse_qsl, unquote
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import logging # used in RequestRouter
@@ -19,42 +27,538 @@ if __name__ == '__main__':
     from time import sleep
 
 
-class RepeatingTimer(threading.Timer):
+class RepeatingTimer(threading.Thread):
     """
         Call a function periodically (following a specified interval) in a new thread.
-        The thread is started by Timer's start method.
+        The thread is started by Thread's start method and stopped by stop.
+
+        The calls are made at fixed deadlines of the monotonic clock (start + interval, 
+        start + 2*interval, ...): the duration of a call doesn't delay the next ones.
+        A call lasting longer than the interval is an overrun: the calls never overlap, 
+        the missed deadlines are either skipped (SKIP, the next call is made at the next 
+        deadline) or coalesced (COALESCE, one call is made directly for all of them).
     """
-    def __init__(self, interval, function, max_=0, *args, **kwargs):
+    SKIP = 'skip'
+    COALESCE = 'coalesce'
+
+    def __init__(self, interval, function, max_=0, *args, on_overrun=SKIP, **kwargs):
         """
             interval is the period (in sec.) between two call of function(*args, **kwargs)
             you can specify a 'max' parameter that limit the number of execution of function (0 for unlimited)
+            on_overrun is SKIP or COALESCE
         """
-        self.reapeatingFunction = function
+        super(RepeatingTimer, self).__init__()
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
         self.max = max_
+        self.on_overrun = on_overrun
+        self.finished = threading.Event()
+
         self.i = 0 # number of times that function has already been executed
-        super(RepeatingTimer, self).__init__(interval, self.repeat, args, kwargs)
-        
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.last_duration = None
+        self.max_duration = 0
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+        wait_until = deadline
+        while not self.finished.wait(max(0, wait_until - time.monotonic())):
+            start = time.monotonic()
+            try:
+                self.function(*self.args, **self.kwargs)
+            except Exception:
+                logging.exception('Exception raised by the function called by the RepeatingTimer')
+            now = time.monotonic()
+
+            self.i += 1
+            self.last_duration = now - start
+            self.max_duration = max(self.max_duration, self.last_duration)
+            if self.max and self.i >= self.max:
+                break
+
+            if wait_until == deadline: # Else it was a coalesced call, deadline is already the next one
+                deadline += self.interval
+            wait_until = deadline
+
+            if now > deadline:
+                missed = int((now - deadline) // self.interval) + 1
+                deadline += missed * self.interval
+                self.overruns += 1
+                if self.on_overrun == self.COALESCE:
+                    self.skipped_ticks += missed - 1
+                    wait_until = now
+                else:
+                    self.skipped_ticks += missed
+                    wait_until = deadline
+                logging.warning('RepeatingTimer overrun: %s took %.2f sec. (interval: %s sec.), %d tick(s) %s.' 
+                                % (getattr(self.function, '__name__', 'function'), self.last_duration, str(self.interval), 
+                                    missed, 'coalesced' if self.on_overrun == self.COALESCE else 'skipped'))
+
+    def stop(self, wait=False):
+        """
+            Stops the timer: no more call will be made. 
+            If wait, blocks until the current call (if any) ends.
+        """
+        self.finished.set()
+        if wait and self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    cancel = stop # threading.Timer compatibility
+
+    def get_metrics(self):
+        """
+            Returns {'calls', 'overruns', 'skipped_ticks', 'last_duration', 'max_duration'}, durations in sec.
+        """
+        return {'calls':self.i, 'overruns':self.overruns, 'skipped_ticks':self.skipped_ticks, 
+                'last_duration':self.last_duration, 'max_duration':self.max_duration}
+
+
+
+class RequestScheduler:
+    """
+        Serialises the requests sent to a same destination (ex: a device ip:port) 
+        and spaces them by at least min_gap seconds. The requests waiting for a 
+        destination are served in their arrival order (FIFO), the requests to 
+        other destinations are not delayed.
+
+        The threads and the coroutines of an asyncio event loop (see AsyncTransport) 
+        can share a scheduler: their requests to a same destination never overlap.
+
+        Usage:
+            with scheduler.slot((ip, port)):
+                requests.get(...)
+            async with scheduler.async_slot((ip, port)):
+                await ...
+    """
+    def __init__(self, min_gap=1):
+        """
+            min_gap is the minimal time (in sec.) between the end of a request and the start of the next one to the same destination
+        """
+        self.min_gap = min_gap
+        self._destinations = {} # key => {'next_ticket', 'serving', 'last_end', 'abandoned', 'waiters', metrics...}
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, key):
+        """
+            Blocks until the calling thread is allowed to send a request to the destination 'key'.
+        """
+        start = time.monotonic()
+        with self._condition:
+            dest, ticket = self._take_ticket(key)
+            self._condition.wait_for(lambda: dest['serving'] == ticket)
+
+        delay = dest['last_end'] + self.min_gap - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        self._record_wait(dest, start)
+        try:
+            yield
+        finally:
+            with self._condition:
+                dest['last_end'] = time.monotonic()
+                self._serve_next(dest)
+
+    @asynccontextmanager
+    async def async_slot(self, key):
+        """
+            Same as slot, for a coroutine: the event loop keeps running while it waits.
+        """
+        start = time.monotonic()
+        with self._condition:
+            dest, ticket = self._take_ticket(key)
+        try:
+            while True:
+                with self._condition:
+                    if dest['serving'] == ticket:
+                        break
+                    waiter = asyncio.get_running_loop().create_future()
+                    dest['waiters'].append(waiter)
+                await waiter
+
+            delay = dest['last_end'] + self.min_gap - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException: # Cancelled: the ticket mustn't block the next requests
+            with self._condition:
+                if dest['serving'] == ticket:
+                    self._serve_next(dest)
+                else:
+                    dest['abandoned'].add(ticket)
+            raise
+
+        self._record_wait(dest, start)
+        try:
+            yield
+        finally:
+            with self._condition:
+                dest['last_end'] = time.monotonic()
+                self._serve_next(dest)
+
+    def _take_ticket(self, key):
+        """
+            Returns the destination 'key' and the next ticket of its queue (the condition must be held).
+        """
+        dest = self._destinations.setdefault(key, {'next_ticket':0, 'serving':0, 'last_end':0, 'abandoned':set(), 'waiters':[], 
+                                                    'requests':0, 'total_wait':0, 'max_wait':0, 'max_queue_depth':0})
+        ticket = dest['next_ticket']
+        dest['next_ticket'] += 1
+        dest['max_queue_depth'] = max(dest['max_queue_depth'], dest['next_ticket'] - dest['serving'])
+        return dest, ticket
+
+    def _serve_next(self, dest):
+        """
+            Gives the destination to its next ticket and wakes up its waiting threads and coroutines (the condition must be held).
+        """
+        dest['serving'] += 1
+        while dest['serving'] in dest['abandoned']:
+            dest['abandoned'].remove(dest['serving'])
+            dest['serving'] += 1
+        self._condition.notify_all()
+        for waiter in dest['waiters']:
+            waiter.get_loop().call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        dest['waiters'] = []
+
+    def _record_wait(self, dest, start):
+        wait = time.monotonic() - start
+        with self._condition:
+            dest['requests'] += 1
+            dest['total_wait'] += wait
+            dest['max_wait'] = max(dest['max_wait'], wait)
+
+    def get_metrics(self):
+        """
+            Returns {key:{'queue_depth', 'max_queue_depth', 'requests', 'mean_wait', 'max_wait'}} 
+            for every destination. Times are in seconds, queue_depth includes the request being sent.
+        """
+        with self._condition:
+            return {key: {'queue_depth':dest['next_ticket'] - dest['serving'] - len(dest['abandoned']),
+                            'max_queue_depth':dest['max_queue_depth'],
+                            'requests':dest['requests'],
+                            'mean_wait':dest['total_wait'] / dest['requests'] if dest['requests'] else 0,
+                            'max_wait':dest['max_wait']}
+                    for key, dest in self._destinations.items()}
+
+
+
+class CircuitOpenError(Exception):
+    """
+        Raised by EndpointMonitor.check when the circuit breaker of an endpoint is open.
+    """
+    pass
+
+
+class EndpointMonitor:
+    """
+        Tracks the latency of the requests sent to each endpoint (ex: (ip, port, 'GET /temperature')) 
+        to give it an adaptive timeout, and trips a circuit breaker on the endpoints that keep failing.
+
+        The timeout of an endpoint is computed like the TCP retransmission timeout: the EWMA of its 
+        latencies plus K times the EWMA of their deviation, kept between min_timeout and max_timeout. 
+        max_timeout is used until a latency is measured.
+        Like the TCP retransmission timeout (Karn's algorithm), the timeout is doubled (up to 
+        max_timeout) by each request that timed out, until a request gets an answer: an endpoint 
+        whose latency rises above its learned timeout isn't locked out.
+
+        After failure_threshold consecutive failures, the breaker opens: the requests to the endpoint 
+        fail immediately (CircuitOpenError) during reset_timeout seconds. Then a single trial request 
+        is let through (half-open), with max_timeout: its success closes the breaker, its failure 
+        opens it again.
+
+        Usage:
+            monitor.check(key)
+            start = time.monotonic()
+            try:
+                requests.get(..., timeout=monitor.timeout(key))
+            except requests.exceptions.RequestException as e:
+                monitor.record_failure(key, timed_out=isinstance(e, requests.exceptions.ReadTimeout))
+            else:
+                monitor.record_success(key, time.monotonic() - start)
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    ALPHA = 0.125 # Weight of a new latency in its EWMA
+    BETA = 0.25 # Weight of a new deviation in its EWMA
+    K = 4
+    WINDOW = 100 # Number of latencies kept for the percentiles
+
+    def __init__(self, min_timeout=0.5, max_timeout=4, failure_threshold=3, reset_timeout=30):
+        """
+            min_timeout, max_timeout: bounds (in sec.) of the adaptive timeouts
+            failure_threshold: number of consecutive failures opening the breaker of an endpoint
+            reset_timeout: time (in sec.) after which an open breaker lets a trial request through
+        """
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._endpoints = {} # key => {'state', 'latency', 'deviation', 'latencies', 'failures', 'opened_at', metrics...}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, key):
+        return self._endpoints.setdefault(key, {'state':self.CLOSED, 'latency':None, 'deviation':0, 
+                                                'latencies':collections.deque(maxlen=self.WINDOW),
+                                                'failures':0, 'backoff':1, 'opened_at':0, 'trial':False, 
+                                                'requests':0, 'errors':0, 'rejected':0})
+
+    def check(self, key, now=None):
+        """
+            Raises CircuitOpenError if no request can be sent to the endpoint now.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            endpoint = self._endpoint(key)
+            if endpoint['state'] == self.OPEN and now - endpoint['opened_at'] >= self.reset_timeout:
+                endpoint['state'] = self.HALF_OPEN
+                endpoint['trial'] = False
+
+            if endpoint['state'] == self.OPEN or (endpoint['state'] == self.HALF_OPEN and endpoint['trial']):
+                endpoint['rejected'] += 1
+                raise CircuitOpenError('Circuit breaker of %s is open.' % str(key))
+
+            if endpoint['state'] == self.HALF_OPEN:
+                endpoint['trial'] = True
+
+    def timeout(self, key):
+        """
+            Returns the timeout (in sec.) of the next request to the endpoint.
+            The trial request of a half-open breaker gets max_timeout.
+        """
+        with self._lock:
+            endpoint = self._endpoint(key)
+            if endpoint['latency'] is None or endpoint['state'] == self.HALF_OPEN:
+                return self.max_timeout
+            timeout = max(endpoint['latency'] + self.K*endpoint['deviation'], self.min_timeout) * endpoint['backoff']
+            return min(timeout, self.max_timeout)
+
+    def record_success(self, key, latency):
+        """
+            Records the latency (in sec.) of a request that got an answer, and closes the breaker.
+        """
+        with self._lock:
+            endpoint = self._endpoint(key)
+            if endpoint['latency'] is None:
+                endpoint['latency'], endpoint['deviation'] = latency, latency / 2
+            else:
+                endpoint['deviation'] += self.BETA * (abs(latency - endpoint['latency']) - endpoint['deviation'])
+                endpoint['latency'] += self.ALPHA * (latency - endpoint['latency'])
+            endpoint['latencies'].append(latency)
+            endpoint['requests'] += 1
+            endpoint['failures'] = 0
+            endpoint['backoff'] = 1
+            if endpoint['state'] != self.CLOSED:
+                logging.info('Endpoint %s answers again, its circuit breaker is closed.' % str(key))
+            endpoint['state'] = self.CLOSED
+
+    def record_failure(self, key, now=None, timed_out=False):
+        """
+            Records a request that failed (timeout or connection error), opens the breaker if needed.
+            timed_out indicates that no answer was received within the timeout: the timeout is doubled.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            endpoint = self._endpoint(key)
+            if timed_out and endpoint['backoff'] * self.min_timeout < self.max_timeout:
+                endpoint['backoff'] *= 2
+            endpoint['requests'] += 1
+            endpoint['errors'] += 1
+            endpoint['failures'] += 1
+            if endpoint['state'] == self.HALF_OPEN or endpoint['failures'] >= self.failure_threshold:
+                if endpoint['state'] == self.CLOSED:
+                    logging.warning('Endpoint %s failed %d times in a row, its circuit breaker is open for %s sec.' 
+                                        % (str(key), endpoint['failures'], str(self.reset_timeout)))
+                endpoint['state'] = self.OPEN
+                endpoint['opened_at'] = now
+
+    def get_metrics(self):
+        """
+            Returns {key:{'state', 'timeout', 'latency', 'p50', 'p95', 'requests', 'errors', 'rejected'}} 
+            for every endpoint. latency is the EWMA of the latencies, times are in seconds.
+        """
+        with self._lock:
+            keys = list(self._endpoints.keys())
+        metrics = {}
+        for key in keys:
+            timeout = self.timeout(key)
+            with self._lock:
+                endpoint = self._endpoints[key]
+                latencies = sorted(endpoint['latencies'])
+                metrics[key] = {'state':endpoint['state'], 'timeout':timeout, 'latency':endpoint['latency'],
+                                'p50':latencies[len(latencies) // 2] if latencies else None,
+                                'p95':latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+                                'requests':endpoint['requests'], 'errors':endpoint['errors'], 'rejected':endpoint['rejected']}
+        return metrics
+
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+        HTTPServer handling each connection in a thread of a bounded pool: 
+        a slow client or a burst of requests doesn't block the other clients, 
+        and the number of threads stays bounded. When max_workers + max_pending 
+        connections are in progress, the new ones wait in the listen backlog.
+    """
+    request_queue_size = 64 # Listen backlog
+
+    def __init__(self, server_address, handler_class, max_workers=8, max_pending=32):
+        super().__init__(server_address, handler_class)
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='HTTPWorker')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._connections = 0 # Connections in progress (handled or waiting for a worker)
+        self._connections_lock = threading.Lock()
+
+    def is_saturated(self):
+        """
+            Returns True if some connections are waiting for a worker.
+        """
+        return self._connections > self.max_workers
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        with self._connections_lock:
+            self._connections += 1
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_lock:
+                self._connections -= 1
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+class RoutingTable:
+    """
+        Compiled routes of a RequestRouter, built from {method:{path:callback}}.
+        A path can be a template with parameters between <>, ex: '/devices/<name>/measures'.
+        The path '*' is the default callback of a method.
+
+        The static paths are found with one dict lookup, the templates in a tree of 
+        path segments: the cost of a lookup depends on the depth of the path, not on 
+        the number of routes. A static segment has priority over a parameter.
+    """
+    def __init__(self, routes):
+        self._static = {} # {method:{path:callback}}
+        self._trees = {} # {method:node}, node = {'segments':{segment:node}, 'param':(name, node) or None, 'callback':callback}
+        self._defaults = {} # {method:callback}
+        for method, method_routes in routes.items():
+            for path, callback in method_routes.items():
+                self.add(method, path, callback)
+
+    @staticmethod
+    def _new_node():
+        return {'segments':{}, 'param':None, 'callback':None}
+
+    def add(self, method, path, callback):
+        self._static.setdefault(method, {})
+        tree = self._trees.setdefault(method, self._new_node())
 
-    def repeat(self, *args, **kwargs):
-        self.reapeatingFunction(*self.args, **self.kwargs)
-        self.i += int(bool(self.max))
-        if not self.max or self.i <= self.max-1:
-            self.run()
+        if path == '*':
+            self._defaults[method] = callback
+        elif '<' not in path:
+            self._static[method][path] = callback
+        else:
+            node = tree
+            for segment in path.strip('/').split('/'):
+                if segment.startswith('<') and segment.endswith('>'):
+                    name = segment[1:-1]
+                    if node['param'] is None:
+                        node['param'] = (name, self._new_node())
+                    elif node['param'][0] != name:
+                        raise ValueError('Route %s: parameter <%s> conflicts with <%s>' % (path, name, node['param'][0]))
+                    node = node['param'][1]
+                else:
+                    node = node['segments'].setdefault(segment, self._new_node())
+            node['callback'] = callback
+
+    def supports(self, method):
+        return method in self._static
+
+    def resolve(self, method, path):
+        """
+            Returns (callback, path parameters) for a path (without query string). 
+            callback is the default callback of the method, or None, if no route matches.
+        """
+        callback = self._static.get(method, {}).get(path)
+        if callback:
+            return callback, {}
 
-    def stop(self):
-        self.cancel()
+        match = self._match(self._trees.get(method), [unquote(s) for s in path.strip('/').split('/')], 0, {})
+        if match:
+            return match
+        return self._defaults.get(method), {}
+
+    def _match(self, node, segments, i, params):
+        if node is None:
+            return None
+        if i == len(segments):
+            return (node['callback'], params) if node['callback'] else None
+
+        match = self._match(node['segments'].get(segments[i]), segments, i+1, params)
+        if not match and node['param'] and segments[i]:
+            name, child = node['param']
+            match = self._match(child, segments, i+1, dict(params, **{name:segments[i]}))
+        return match
 
 
 
 class RequestRouter(BaseHTTPRequestHandler):
     """
     Handles http request and callbacks the specified function. 
-    It only can respond with an http code (no content).
+    The connections are kept alive (HTTP/1.1) until the client closes them or stays idle for timeout sec.
+    (pipelined requests aren't supported)
+
+    A callback receives request_data {'headers', 'content', 'params' (path parameters), 'query' (query string parameters)}
+    and returns either a response code, or a tuple (response code, body):
+        - a dict, list or str body is sent as json,
+        - any other iterable body (ex: a generator) is streamed as a json array, item by item.
     """
+    protocol_version = 'HTTP/1.1'
+    timeout = 5 # An idle kept-alive connection frees its worker after this delay
+    STREAM_CHUNK_SIZE = 8192 # Bytes of json sent at once by a streamed response
+
     def __init__(self, routes, *args):
-        self.routes = routes # Contains the associaton path => callback, a callback must return a response code, 200 will automatically returned otherwise
+        # Contains the associaton path => callback, as a RoutingTable (better compiled once for all the connections) or {method:{path:callback}}
+        self.routes = routes if isinstance(routes, RoutingTable) else RoutingTable(routes)
         super().__init__(*args)
 
+    def handle(self):
+        """
+            Handles the requests of a connection until it's closed. Between 2 requests, an idle 
+            connection is closed after timeout sec., or as soon as other connections wait for 
+            a worker of the server (see PooledHTTPServer.is_saturated).
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        """
+            Returns True when the next request (or the end of the connection) can be read.
+        """
+        deadline = time.monotonic() + self.timeout
+        is_saturated = getattr(self.server, 'is_saturated', lambda: False)
+        while time.monotonic() < deadline:
+            if select.select([self.connection], [], [], 0.05)[0]:
+                return True
+            if is_saturated():
+                return False
+        return False
+
     def do_PUT(self):
         """
             Method called every time a PUT request is handled.
@@ -84,21 +588,33 @@ class RequestRouter(BaseHTTPRequestHandler):
         """
             Associates a (method/path) to callbacks or send an eror code if it fails.
         """
-        if method in self.routes.keys(): # If supported method
-            if path not in self.routes[method].keys(): # if path not supported...
-                path = '*'  # default callback
-            if path in self.routes[method].keys(): # if supported path (or default callback)
-                content = ''
-                if 'Content-Length' in self.headers:
-                    content = self.rfile.read(int(self.headers['Content-Length']))
+        # The content is always read: the next request of a kept-alive connection starts after it
+        content = ''
+        if 'Content-Length' in self.headers:
+            content = self.rfile.read(int(self.headers['Content-Length']))
+
+        url = urlsplit(path)
+        if self.routes.supports(method): # If supported method
+            callback, params = self.routes.resolve(method, url.path)
+            if callback: # if supported path (or default callback)
                 request_data = {'headers':self.headers.items(), 
-                                'content':content}
-                http_code = self.routes[method][path](request_data)
+                                'content':content,
+                                'params':params,
+                                'query':dict(parse_qsl(url.query))}
+                result = callback(request_data)
+                http_code, body = result if isinstance(result, tuple) and len(result) == 2 else (result, None)
                 logging.debug('A supported request have been handled. Produced result : ' + str(http_code))
                 if http_code == None or type(http_code) is not int: # TODO: better check if it's an http status code than just if it's a number...s
                     http_code = 501 # Not implemented
+                    body = None
                     logging.debug('The produced result isn\'t a valid http code. 501 will be sent')
-                self._send_code(http_code)
+
+                if body is None:
+                    self._send_code(http_code)
+                elif isinstance(body, (dict, list, str)):
+                    self._send_json(http_code, body)
+                else:
+                    self._stream_json(http_code, body)
 
             else:
                 logging.debug('A request with a non supported path have been handled. 404 will be send.')
@@ -111,8 +627,59 @@ class RequestRouter(BaseHTTPRequestHandler):
 
     def _send_code(self, code):
         self.send_response(code)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
+    def _send_json(self, code, body):
+        content = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _stream_json(self, code, items):
+        """
+            Sends the items as a json array, without building it in memory: 
+            it's sent by chunks (Transfer-Encoding: chunked) as the items are produced.
+            An HTTP/1.0 client receives the array until the connection is closed.
+        """
+        chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        def write(data):
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        buffer = [b'[']
+        size = 1
+        try:
+            for i, item in enumerate(items):
+                data = (b',' if i else b'') + json.dumps(item, default=str).encode('utf-8')
+                buffer.append(data)
+                size += len(data)
+                if size >= self.STREAM_CHUNK_SIZE:
+                    write(b''.join(buffer))
+                    buffer, size = [], 0
+        except Exception:
+            # The status is already sent, the client will receive an incomplete response
+            logging.exception('Exception during the streaming of a response, the connection will be closed.')
+            self.close_connection = True
+            return
+
+        buffer.append(b']')
+        write(b''.join(buffer))
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
 
     def log_message(self, format, *args):
         """
@@ -143,7 +710,7 @@ class TimeOperator:
         returns the number of seconds elapsed since the beginning of the day
         """ 
         t = time.gmtime(time.time())
-        return int(strftime('%H', t))*3600 + int(strftime('%M', t))*60 + int(strftime('%S', t))
+        return t.tm_hour*3600 + t.tm_min*60 + t.tm_sec
 
     @staticmethod
     def get_elapsed_days_since_epoch(t):
@@ -152,13 +719,14 @@ class TimeOperator:
         """
         return t//(24*60*60)
 
-    @staticmethod
-    def get_number_of_days_since_device_launch(device_name):
+    def get_number_of_days_since_device_launch(self, device_name):
         """
-        returns the number of days since remote device was launched 
+        returns the number of days since remote device was launched (its first measure), 0 without measure
         """
         t = self.thermo_measures_handler.get_date_of_first_entry(device_name)
-        return get_elapsed_days_since_epoch(time.time()) - get_elapsed_days_since_epoch(t)    
+        if t == None:
+            return 0
+        return TimeOperator.get_elapsed_days_since_epoch(time.time()) - TimeOperator.get_elapsed_days_since_epoch(t)
     
     @staticmethod
     def get_current_day():
@@ -184,7 +752,7 @@ class TimeOperator:
         """
         returns the epoch time
         """              
-        return strftime("%Y-%m-%d", time.gmtime())
+        return time.strftime("%Y-%m-%d", time.gmtime())
 
 
 
@@ -207,13 +775,15 @@ class TestRequestRouter(unittest.TestCase):
             Sets up a generic HTTPServer with a RequestRouter as RequestHandlerClass 
             and transmits all the routes needed for thes following tests.
         """
-        cls.routes = {'PUT':{'/puttest':cls.PUT_callback}, 'GET':{'/gettest':cls.GET_callback, '/callbackfailtest':cls.FAIL_callback}, 'POST':{'/posttest':cls.POST_callback}}
+        cls.routes = {'PUT':{'/puttest':cls.PUT_callback}, 'GET':{'/gettest':cls.GET_callback, '/callbackfailtest':cls.FAIL_callback, 
+                        '/devices/<name>':cls.JSON_callback, '/devices/<name>/measures':cls.STREAM_callback, '/devices/all':cls.GET_callback}, 
+                        'POST':{'/posttest':cls.POST_callback}}
 
         server_address = ('localhost', 8081)
 
         handler_class = lambda *args: RequestRouter(cls.routes, *args)
             
-        cls._http_server = HTTPServer(server_address, handler_class)
+        cls._http_server = PooledHTTPServer(server_address, handler_class, max_workers=2)
 
 
         print("Starting test server on port 8081...")
@@ -225,6 +795,7 @@ class TestRequestRouter(unittest.TestCase):
     def tearDownClass(cls):
         print('Server stopping...')
         cls._http_server.shutdown()
+        cls._http_server.server_close()
         print('Server stopped')
 
 
@@ -241,9 +812,49 @@ class TestRequestRouter(unittest.TestCase):
     def FAIL_callback(request_data):
         return 'not a http code'
 
+    def JSON_callback(request_data):
+        return 200, {'name':request_data['params']['name'], 'query':request_data['query']}
+
+    def STREAM_callback(request_data):
+        return 200, ({'name':request_data['params']['name'], 'i':i} for i in range(int(request_data['query']['n'])))
+
     def default_callback(self, request_data):
         return 201 # Random http status code just for testing
 
+    # Are the requests of other clients handled while a slow client sends its request?
+    def test_slow_client(self):
+        print('testing a request sent during the request of a slow client...')
+        import socket
+        with socket.create_connection(('localhost', 8081)) as slow_client:
+            slow_client.sendall(b'GET /gettest HTTP/1.1\r\n')
+            self.assertEqual(requests.get('http://localhost:8081/gettest', timeout=2).status_code, 200)
+
+    # Are the path templates, query strings and json responses handled?
+    def test_json_response(self):
+        print('testing a json response on a path template...')
+        response = requests.get('http://localhost:8081/devices/thin%201?since=10&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'name':'thin 1', 'query':{'since':'10', 'limit':'2'}})
+        self.assertEqual(requests.get('http://localhost:8081/devices/all').status_code, 200) # static path first
+        self.assertEqual(requests.get('http://localhost:8081/devices/a/unknown').status_code, 404)
+
+    def test_streamed_response(self):
+        print('testing a streamed json response...')
+        with requests.Session() as session:
+            for n in (0, 3, 2000): # 2000 items are sent in several chunks
+                response = session.get('http://localhost:8081/devices/thin/measures?n=%d' % n)
+                self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+                self.assertEqual(response.json(), [{'name':'thin', 'i':i} for i in range(n)])
+
+    # Is the connection kept alive between the requests?
+    def test_keep_alive(self):
+        print('testing 2 requests on the same connection...')
+        with requests.Session() as session:
+            self.assertEqual(session.get('http://localhost:8081/gettest').status_code, 200)
+            self.assertEqual(session.put('http://localhost:8081/unknown', 'content').status_code, 404)
+            self.assertEqual(session.get('http://localhost:8081/gettest').status_code, 200)
+            self.assertEqual(len(session.get_adapter('http://').poolmanager.pools), 1)
+
     # Does it handle correctly the GET, POST, PUT request on supported path?
     def test_sup_PUT(self):
         print('testing PUT callback on supported path...')
@@ -306,6 +917,127 @@ def tests():
     t.start()
     sleep(4)
 
+    print('Calls every 0.1 sec. during 1 sec. (each call lasting 0.05 sec.) shouldn\'t drift')
+    calls = []
+    t = RepeatingTimer(0.1, lambda: (calls.append(time.monotonic()), sleep(0.05)))
+    start = time.monotonic()
+    t.start()
+    sleep(1.02)
+    t.stop(wait=True)
+    assert len(calls) == 10, len(calls)
+    assert abs(calls[-1] - start - 1) < 0.02, calls[-1] - start
+
+    print('Calls lasting 0.25 sec. every 0.1 sec. are overruns, the missed ticks are skipped or coalesced')
+    for on_overrun, expected_calls in ((RepeatingTimer.SKIP, 3), (RepeatingTimer.COALESCE, 4)):
+        t = RepeatingTimer(0.1, sleep, 0, 0.25, on_overrun=on_overrun)
+        t.start()
+        sleep(0.93) # skip: calls at 0.1, 0.4, 0.7 / coalesce: calls at 0.1, 0.35, 0.6, 0.85
+        t.stop(wait=True)
+        print(on_overrun, t.get_metrics())
+        assert t.get_metrics()['calls'] == expected_calls and t.overruns == expected_calls, t.get_metrics()
+
+
+    print('\n\nTesting the RequestScheduler class')
+    print('='*60 + '\n')
+    print('3 threads x 2 requests to device A and 1 request to device B, with a gap of 0.5 sec.')
+    scheduler = RequestScheduler(0.5)
+    starts = {'A':[], 'B':[]}
+    def send(key):
+        with scheduler.slot(key):
+            starts[key].append(time.monotonic())
+            sleep(0.1)
+    threads = [threading.Thread(target=lambda: [send('A') for i in range(2)]) for i in range(3)]
+    threads.append(threading.Thread(target=send, args=('B',)))
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gaps = [t2 - t1 for t1, t2 in zip(starts['A'], starts['A'][1:])]
+    assert min(gaps) >= 0.6 - 0.01, 'requests to A not spaced: %s' % str(gaps) # 0.1 sec. of request + 0.5 sec. of gap
+    assert starts['B'][0] - start < 0.1, 'B was delayed by A'
+    print(scheduler.get_metrics())
+
+    print('A thread and 3 coroutines sharing the scheduler, a coroutine is cancelled while waiting for its turn')
+    scheduler = RequestScheduler(0.2)
+    spans = [] # (start, end) of the requests to C
+    def thread_send():
+        with scheduler.slot('C'):
+            spans.append((time.monotonic(), sleep(0.2) or time.monotonic()))
+    async def async_send():
+        async with scheduler.async_slot('C'):
+            spans.append((time.monotonic(), await asyncio.sleep(0.1) or time.monotonic()))
+    async def coroutines():
+        return await asyncio.gather(async_send(), asyncio.wait_for(async_send(), 0.05), async_send(), return_exceptions=True)
+    thread = threading.Thread(target=thread_send)
+    thread.start()
+    sleep(0.02) # The thread takes the first ticket
+    results = asyncio.run(coroutines())
+    thread.join()
+    assert isinstance(results[1], asyncio.TimeoutError) and len(spans) == 3, (results, spans)
+    assert all(next_start >= end + 0.2 - 0.01 for (start, end), (next_start, next_end) in zip(spans, spans[1:])), spans
+    assert scheduler.get_metrics()['C']['queue_depth'] == 0 and scheduler.get_metrics()['C']['requests'] == 3
+    print(scheduler.get_metrics())
+
+
+    print('\n\nTesting the EndpointMonitor class')
+    print('='*60 + '\n')
+    monitor = EndpointMonitor(min_timeout=0.05, max_timeout=4, failure_threshold=3, reset_timeout=10)
+    key = ('10.0.0.1', '80', 'GET /temperature')
+    assert monitor.timeout(key) == 4, 'No latency measured yet'
+    for latency in (0.010, 0.012, 0.011, 0.010, 0.013, 0.011):
+        monitor.check(key)
+        monitor.record_success(key, latency)
+    assert 0.05 <= monitor.timeout(key) < 0.1, monitor.timeout(key)
+    for latency in (0.2, 0.25, 0.22):
+        monitor.record_success(key, latency)
+    assert 0.2 < monitor.timeout(key) < 1, 'The timeout follows the latencies: %s' % monitor.timeout(key)
+
+    for i in range(3):
+        monitor.check(key, now=100)
+        monitor.record_failure(key, now=100)
+    for now in (100, 109.9):
+        try:
+            monitor.check(key, now=now)
+            assert False, 'The breaker should be open'
+        except CircuitOpenError:
+            pass
+    monitor.check(key, now=110) # Trial request
+    try:
+        monitor.check(key, now=110)
+        assert False, 'A single trial request is let through'
+    except CircuitOpenError:
+        pass
+    monitor.record_failure(key, now=110)
+    assert monitor.get_metrics()[key]['state'] == 'open'
+    monitor.check(key, now=120)
+    monitor.record_success(key, 0.01)
+    monitor.check(key, now=120)
+    print(monitor.get_metrics())
+    assert monitor.get_metrics()[key]['rejected'] == 3 and monitor.get_metrics()[key]['errors'] == 4
+
+    print('The latency of the endpoints steps up above their learned timeout, they must recover')
+    for latency, failure_threshold in ((0.8, 3), (3, 2)):
+        monitor = EndpointMonitor(min_timeout=0.5, max_timeout=4, failure_threshold=failure_threshold, reset_timeout=10)
+        for i in range(20):
+            monitor.record_success(key, 0.01)
+        assert monitor.timeout(key) == 0.5
+        answered, now = 0, 0
+        for cycle in range(200):
+            now += 1
+            try:
+                monitor.check(key, now=now)
+            except CircuitOpenError:
+                continue
+            if latency <= monitor.timeout(key):
+                monitor.record_success(key, latency)
+                answered += 1
+            else:
+                monitor.record_failure(key, now=now, timed_out=True)
+        metrics = monitor.get_metrics()[key]
+        print(latency, answered, metrics)
+        assert metrics['state'] == 'closed' and answered > 150 and metrics['timeout'] > latency, metrics
+
 
     print('\n\nTesting the RequestRouter class')
     print('='*60 + '\n')
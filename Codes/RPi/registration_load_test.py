@@ -0,0 +1,101 @@
+"""
+    Load test of the registration front end of a running ThermoServer.
+
+    Several concurrent clients send 'PUT /register' requests (as the devices do at startup)
+    and the throughput and latencies of the registrations are reported.
+    Slow clients (sending the beginning of a request and then nothing) can be added 
+    to check that they don't block the other ones.
+    The registered devices are fake ones (127.0.0.1, on unused ports): use a test database.
+
+    Ex: python3 registration_load_test.py --port 8080 --clients 16 --requests 400
+"""
+
+__version__ = '1.0'
+
+import argparse
+import json
+import socket
+import statistics
+import threading
+import time
+
+import requests
+
+
+def register_devices(host, port, n_requests, first_port, keep_alive, latencies, errors):
+    """
+        Sends n_requests registrations (one after another) and appends their latencies (in sec.) to latencies.
+    """
+    url = 'http://%s:%s/register' % (host, str(port))
+    http = requests.Session() if keep_alive else requests
+    headers = {'content-type': 'application/json'}
+
+    for i in range(n_requests):
+        device = {'ip': '127.0.0.1', 'port': first_port + i, 'type': 'outside'}
+        start = time.perf_counter()
+        try:
+            response = http.put(url, data=json.dumps(device), headers=headers, timeout=30)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        except requests.exceptions.RequestException as e:
+            errors.append(str(e))
+        latencies.append(time.perf_counter() - start)
+
+    if keep_alive:
+        http.close()
+
+
+def open_slow_client(host, port):
+    """
+        Opens a connection and sends only the first line of a registration request.
+    """
+    connection = socket.create_connection((host, port))
+    connection.sendall(b'PUT /register HTTP/1.1\r\n')
+    return connection
+
+
+def run(host, port, clients, n_requests, keep_alive, slow_clients=0):
+    """
+        Runs the load test and returns a dictionnary with the results.
+    """
+    latencies = []
+    errors = []
+    per_client = n_requests // clients
+    threads = [threading.Thread(target=register_devices, args=(host, port, per_client, 20000 + i*per_client, keep_alive, latencies, errors))
+                for i in range(clients)]
+
+    slow_connections = [open_slow_client(host, port) for i in range(slow_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    for connection in slow_connections:
+        connection.close()
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / duration,
+            'p50': statistics.median(latencies),
+            'p95': latencies[int(0.95 * (len(latencies) - 1))],
+            'max': latencies[-1]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the registration throughput of a running ThermoServer.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clients', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=400, help='total number of registrations')
+    parser.add_argument('--no-keep-alive', action='store_true', help='opens a new connection for each request')
+    parser.add_argument('--slow-clients', type=int, default=0, help='number of clients sending an incomplete request during the test')
+    args = parser.parse_args()
+
+    results = run(args.host, args.port, args.clients, args.requests, not args.no_keep_alive, args.slow_clients)
+    print('%d registrations by %d clients (%s, %d slow clients), %d errors'
+            % (results['requests'], args.clients, 'new connection per request' if args.no_keep_alive else 'kept-alive connections', 
+                args.slow_clients, results['errors']))
+    print('Throughput : %.1f registrations/sec.' % results['throughput'])
+    print('Latency    : p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (results['p50']*1e3, results['p95']*1e3, results['max']*1e3))
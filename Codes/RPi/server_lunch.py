@@ -80,7 +80,7 @@ class ThermoServerShell(cmd.Cmd):
             if new_value.isdigit() and 0 <= int(new_value) <= 100:
                 device = self.s.get_device_by_name(device_name)
                 if device:
-                    device.get_sensors_by_name('valve').set_option(int(new_value))
+                    self.s.set_options([(device.get_sensors_by_name('valve'), int(new_value))], force=True)
                 else:
                     print('No device named ' + device_name + ' was found.')
             else: